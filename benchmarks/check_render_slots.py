@@ -0,0 +1,81 @@
+import sys
+import threading
+import time
+
+from utils.render_slots import RenderSlots
+
+WAIT_SECONDS = 5
+
+
+class Interrupted(BaseException):
+    pass
+
+
+def check_interrupted_wait():
+    """
+    Interrupt an acquirer waiting in line, like a KeyboardInterrupt or a shutdown would, and check that the acquirer
+    behind it still gets its slot.
+
+    :return: List of errors.
+    """
+    errors = []
+    render_slots = RenderSlots(slots=1, threads=1)
+    held = threading.Event()
+    release = threading.Event()
+    interrupted = []
+    acquired = threading.Event()
+
+    def holder():
+        with render_slots.acquire():
+            held.set()
+            release.wait()
+
+    def interrupted_waiter():
+        original_wait = render_slots.condition.wait
+
+        def wait(timeout=None):
+            # The interruption arrives while the acquirer is first in line
+            if threading.current_thread().name == "interrupted":
+                raise Interrupted()
+            return original_wait(timeout)
+
+        render_slots.condition.wait = wait
+        try:
+            with render_slots.acquire():
+                pass
+        except Interrupted:
+            interrupted.append(True)
+        finally:
+            render_slots.condition.wait = original_wait
+
+    def waiter():
+        with render_slots.acquire():
+            acquired.set()
+
+    holder_thread = threading.Thread(target=holder)
+    holder_thread.start()
+    held.wait()
+    interrupted_thread = threading.Thread(target=interrupted_waiter, name="interrupted")
+    interrupted_thread.start()
+    interrupted_thread.join()
+    waiter_thread = threading.Thread(target=waiter, daemon=True)
+    waiter_thread.start()
+    time.sleep(0.1)
+    release.set()
+    holder_thread.join()
+    if not interrupted:
+        errors.append("The waiter was not interrupted")
+    if not acquired.wait(WAIT_SECONDS):
+        errors.append(f"The acquirer behind the interrupted one got no slot within {WAIT_SECONDS}s")
+    if render_slots.waiting:
+        errors.append(f"Tickets left in line: {list(render_slots.waiting)}")
+    return errors
+
+
+if __name__ == "__main__":
+    # python3 -m benchmarks.check_render_slots
+    errors = check_interrupted_wait()
+    for error in errors:
+        print(error)
+    print("FAILED" if errors else "OK: an interrupted acquirer leaves the line")
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,94 @@
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+
+from utils.filmstrip import FILMSTRIP_INDEX_FILE, OUTPUT_DIRECTORY, RENDER_MODES, RENDER_MODE_PNG, \
+    generate_filmstrip, list_filmstrip_files, store_filmstrip_index_in_json, S3_KEY_BASE_PATH
+
+CHECK_PROJECT_ID = "sharding-check"
+SYNTHETIC_VIDEO = "downloads/sharding-check/synthetic.mp4"
+
+
+def generate_synthetic_video(output_file, duration, size="640x360", rate=30, gop=60):
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    cmd = [
+        "ffmpeg",
+        "-f",
+        "lavfi",
+        "-i",
+        f"testsrc2=size={size}:rate={rate}",
+        "-t",
+        str(duration),
+        "-c:v",
+        "libx264",
+        "-g",
+        str(gop),
+        "-pix_fmt",
+        "yuv420p",
+        output_file,
+        "-y",
+    ]
+    subprocess.run(cmd, check=True, capture_output=True)
+    return output_file
+
+
+def render_and_index(input_file, content_id, render_mode, shards, shard_min_seconds):
+    stats = generate_filmstrip(input_file, CHECK_PROJECT_ID, content_id, render_mode=render_mode, shards=shards,
+                               shard_min_seconds=shard_min_seconds)
+    output_directory = OUTPUT_DIRECTORY.format(CHECK_PROJECT_ID, content_id)
+    # The index is built for the same S3 prefix so both renders can be compared byte for byte
+    file_keys = [S3_KEY_BASE_PATH.format(CHECK_PROJECT_ID, "content", file)
+                 for file in list_filmstrip_files(output_directory, ".webp")]
+    index_file = os.path.join(output_directory, FILMSTRIP_INDEX_FILE)
+    store_filmstrip_index_in_json(CHECK_PROJECT_ID, "content", index_file, file_keys)
+    return stats, output_directory, index_file
+
+
+def file_digest(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def check_sharded_render(duration, shards, render_mode):
+    input_file = generate_synthetic_video(SYNTHETIC_VIDEO, duration)
+    # Shards of one sheet are allowed so a short synthetic video is still split
+    single_stats, single_directory, single_index = render_and_index(input_file, "single", render_mode, 1, 15)
+    sharded_stats, sharded_directory, sharded_index = render_and_index(input_file, "sharded", render_mode, shards, 15)
+    print(f"single pass: {single_stats}")
+    print(f"sharded: {sharded_stats}")
+
+    errors = []
+    if sharded_stats["shards"] < 2:
+        errors.append(f"Expected the render to be sharded, got {sharded_stats['shards']} shard")
+    if file_digest(single_index) != file_digest(sharded_index):
+        errors.append(f"{FILMSTRIP_INDEX_FILE} differs between the single pass and the sharded render")
+    # The lossless sheets have to match pixel for pixel, the WebP sheets are compared when rendering in webp mode
+    extension = ".png" if render_mode == RENDER_MODE_PNG else ".webp"
+    single_sheets = list_filmstrip_files(single_directory, extension)
+    sharded_sheets = list_filmstrip_files(sharded_directory, extension)
+    if single_sheets != sharded_sheets:
+        errors.append(f"Sheet names differ: {single_sheets} != {sharded_sheets}")
+    for sheet in sorted(set(single_sheets) & set(sharded_sheets)):
+        if file_digest(os.path.join(single_directory, sheet)) != file_digest(os.path.join(sharded_directory, sheet)):
+            errors.append(f"{sheet} differs between the single pass and the sharded render")
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=int, default=100)
+    parser.add_argument("--shards", type=int, default=3)
+    parser.add_argument("--render_mode", type=str, default=RENDER_MODE_PNG, choices=RENDER_MODES)
+    args = parser.parse_args()
+
+    try:
+        errors = check_sharded_render(args.duration, args.shards, args.render_mode)
+    finally:
+        shutil.rmtree(os.path.dirname(OUTPUT_DIRECTORY.format(CHECK_PROJECT_ID, "")), ignore_errors=True)
+    for error in errors:
+        print(error)
+    print("FAILED" if errors else "OK: sharded and single pass renders are identical")
+    sys.exit(1 if errors else 0)
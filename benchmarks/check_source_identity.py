@@ -0,0 +1,46 @@
+import sys
+
+from utils.dedup import source_url_identity
+
+# Links of the same video, they must share one identity
+SAME_SOURCE = [
+    ("https://youtu.be/abc123", "https://www.youtube.com/watch?v=abc123&t=10"),
+    ("https://www.youtube.com/embed/abc123?start=30", "https://m.youtube.com/watch?v=abc123&si=xyz"),
+    ("https://host.example/video.mp4?utm_source=mail&utm_medium=email", "https://HOST.example/video.mp4/"),
+    ("https://host.example/video.mp4?fbclid=1&gclid=2", "https://host.example/video.mp4?feature=share"),
+    ("https://host.example/dl.php?id=1&site=a", "https://host.example/dl.php?site=a&id=1&utm_campaign=x"),
+]
+# Links of different videos, they must keep different identities
+DIFFERENT_SOURCES = [
+    ("https://host.example/dl.php?t=videoA", "https://host.example/dl.php?t=videoB"),
+    ("https://host.example/dl.php?start=videoA", "https://host.example/dl.php?start=videoB"),
+    ("https://host.example/dl.php?site=a&id=1", "https://host.example/dl.php?site=b&id=1"),
+    ("https://host.example/dl.php?sid=1", "https://host.example/dl.php?sid=2"),
+    ("https://host.example/dl.php?size=1", "https://host.example/dl.php?size=2"),
+    ("https://host.example/dl.php?sig=1", "https://host.example/dl.php?sig=2"),
+    ("https://youtu.be/abc123", "https://youtu.be/abc124"),
+]
+
+
+def check_source_identity():
+    """
+    :return: List of the pairs of links whose identities are wrong.
+    """
+    errors = []
+    for first, second in SAME_SOURCE:
+        if source_url_identity(first) != source_url_identity(second):
+            errors.append(f"{first} and {second} are the same video but got "
+                          f"{source_url_identity(first)} and {source_url_identity(second)}")
+    for first, second in DIFFERENT_SOURCES:
+        if source_url_identity(first) == source_url_identity(second):
+            errors.append(f"{first} and {second} are different videos but both got {source_url_identity(first)}")
+    return errors
+
+
+if __name__ == "__main__":
+    # python3 -m benchmarks.check_source_identity
+    errors = check_source_identity()
+    for error in errors:
+        print(error)
+    print("FAILED" if errors else "OK: links of one video share an identity and other links don't")
+    sys.exit(1 if errors else 0)
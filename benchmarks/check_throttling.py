@@ -0,0 +1,84 @@
+import argparse
+import os
+import sys
+import time
+
+from benchmarks.local_s3 import FaultInjection, LocalS3Server
+from utils import aws, pipeline, throttle
+from utils.filmstrip import FILMSTRIP_INDEX_FILE, S3_KEY_BASE_PATH, STATIC_ASSETS_BUCKET, filmstrip_sheet_name
+from utils.pipeline import FilmstripJob, Pipeline, Stage, publish_job
+
+CHECK_PROJECT_ID = "throttling-check"
+SHEET = b"RIFF0000WEBPVP8 " + bytes(4096)
+
+
+def check_throttling(jobs, sheets, publish_workers, rate_limit, slowdown_probability, latency):
+    """
+    Publish in-memory filmstrips against a local S3 stand-in that throttles, and check that every filmstrip still
+    arrives complete.
+
+    :return: Tuple of the list of errors and a dictionary with the run statistics.
+    """
+    faults = FaultInjection(rate_limit, slowdown_probability, latency)
+    server = LocalS3Server(faults=faults).start()
+    os.environ[aws.S3_ENDPOINT_URL_ENV] = server.endpoint_url
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "check")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "check")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    # Without botocore's own retries every SlowDown reaches the limiter and the pipeline
+    aws.configure(max_pool_connections=publish_workers * 8, max_attempts=1)
+
+    def publish(job):
+        job.sheets = [SHEET] * sheets
+        publish_job({}, None, job)
+
+    start_time = time.monotonic()
+    summary = Pipeline([Stage("publish", publish, publish_workers)]).run(
+        FilmstripJob(CHECK_PROJECT_ID, f"content_{index}") for index in range(jobs))
+    wall_time = time.monotonic() - start_time
+    server.shutdown()
+
+    errors = []
+    expected_keys = [S3_KEY_BASE_PATH.format(CHECK_PROJECT_ID, f"content_{index}", name)
+                     for index in range(jobs)
+                     for name in [filmstrip_sheet_name(n) for n in range(1, sheets + 1)] + [FILMSTRIP_INDEX_FILE]]
+    missing = sorted(set(expected_keys) - set(server.store.keys(STATIC_ASSETS_BUCKET)))
+    if missing:
+        errors.append(f"{len(missing)} of {len(expected_keys)} objects are missing, e.g. {missing[:3]}")
+    if summary["failed"]["publish"]:
+        errors.append(f"{summary['failed']['publish']} jobs failed")
+    limiter = throttle.summary().get(f"s3:{STATIC_ASSETS_BUCKET}", {})
+    if faults.throttled and limiter.get("throttles", 0) == 0:
+        errors.append("The server throttled but the limiter never saw it")
+    stats = {
+        "wall_time": round(wall_time, 3),
+        "objects_per_second": round(len(expected_keys) / wall_time, 1),
+        "requests": faults.requests,
+        "throttled": faults.throttled,
+        "jobs_requeued": summary["requeued"]["publish"],
+        "limiter": limiter,
+    }
+    return errors, stats
+
+
+if __name__ == "__main__":
+    # python3 -m benchmarks.check_throttling --jobs 40 --rate_limit 100
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=40)
+    parser.add_argument("--sheets", type=int, default=10)
+    parser.add_argument("--publish_workers", type=int, default=4)
+    parser.add_argument("--rate_limit", type=float, default=100)
+    parser.add_argument("--slowdown_probability", type=float, default=0.02)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--requeue_backoff", type=float, default=0.5)
+    args = parser.parse_args()
+
+    # The production backoff is sized for real S3, the check only needs the requeue to happen
+    pipeline.REQUEUE_BACKOFF_SECONDS = args.requeue_backoff
+    errors, stats = check_throttling(args.jobs, args.sheets, args.publish_workers, args.rate_limit,
+                                     args.slowdown_probability, args.latency)
+    print(stats)
+    for error in errors:
+        print(error)
+    print("FAILED" if errors else "OK: the limiter backed off and no filmstrip was lost")
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,125 @@
+import argparse
+import collections
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from utils.pipeline import FilmstripJob, Pipeline, Stage
+from utils.work_queue import ITEM_DONE, ShardFilter, open_work_queue, shard_of
+
+CHECK_QUEUE = "check"
+
+
+def check_shards(items, shards):
+    """
+    Check that the shards split the items without overlap or gap, and print how even the split is.
+    """
+    rows = [{"project_id": project_id, "content_id": content_id} for project_id, content_id in items]
+    owners = collections.Counter()
+    for index in range(shards):
+        for row in ShardFilter(index, shards).filter_rows(rows, "project_id", "content_id"):
+            owners[(row["project_id"], row["content_id"])] += 1
+    errors = []
+    if len(owners) != len(items) or set(owners.values()) != {1}:
+        errors.append(f"{len(items) - len(owners)} items have no shard, "
+                      f"{sum(1 for count in owners.values() if count > 1)} have several")
+    sizes = collections.Counter(shard_of(project_id, content_id, shards) for project_id, content_id in items)
+    print(f"Items per shard: {[sizes[index] for index in range(shards)]}")
+    return errors
+
+
+def run_worker(queue_path, queue, worker_id, work_seconds, lease_seconds, log_path, die_after):
+    """
+    Process leased items with a stage that only sleeps, like the entry scripts do with their pipeline. A worker
+    with die_after exits without acknowledging anything once it leased that many items.
+    """
+    work_queue = open_work_queue(queue_path, queue, worker_id, lease_seconds=lease_seconds, lease_batch=2)
+    processed = []
+
+    def work(job):
+        if die_after and len(processed) >= die_after:
+            os._exit(1)
+        time.sleep(work_seconds)
+        processed.append(job)
+        with open(log_path, "a") as f:
+            f.write(f"{worker_id} {job.project_id} {job.content_id}\n")
+
+    pipeline = Pipeline([Stage("work", work, 2)], on_finish=work_queue.ack)
+    jobs = work_queue.leased_jobs(poll_seconds=0.2)
+    pipeline.run(jobs)
+    print(f"Worker {worker_id}: {work_queue.summary()}")
+
+
+def check_work_queue(items, workers, work_seconds, lease_seconds, queue_url=None):
+    errors = []
+    with tempfile.TemporaryDirectory() as directory:
+        queue_path = queue_url or os.path.join(directory, "queue.db")
+        # A queue of its own in a shared Postgres database, earlier checks leave theirs behind
+        queue = f"{CHECK_QUEUE}-{os.getpid()}-{int(time.time())}" if queue_url else CHECK_QUEUE
+        log_path = os.path.join(directory, "processed.log")
+        coordinator = open_work_queue(queue_path, queue)
+        coordinator.seal(False)
+        coordinator.publish(FilmstripJob(project_id, content_id, {"project_id": project_id})
+                            for project_id, content_id in items)
+        coordinator.seal()
+
+        start_time = time.monotonic()
+        processes = []
+        for index in range(workers):
+            # The first worker dies holding leases, the others take its items over once the leases run out
+            die_after = 3 if index == 0 else 0
+            cmd = [sys.executable, "-m", "benchmarks.check_work_queue", "--worker", f"worker-{index}",
+                   "--queue_path", queue_path, "--queue", queue, "--log_path", log_path, "--work_seconds", str(work_seconds),
+                   "--lease_seconds", str(lease_seconds), "--die_after", str(die_after)]
+            processes.append(subprocess.Popen(cmd))
+        for process in processes:
+            process.wait()
+        wall_time = time.monotonic() - start_time
+
+        progress = coordinator.progress()
+        with open(log_path) as f:
+            processed = collections.Counter(tuple(line.split()[1:]) for line in f)
+        coordinator.close()
+
+    print(f"Queue progress: {progress}")
+    print(f"{len(items)} items by {workers} workers in {wall_time:.1f}s ({len(items) / wall_time:.1f} items/s), "
+          f"{sum(count - 1 for count in processed.values())} processed twice after the lost leases")
+    if progress.get(ITEM_DONE, 0) != len(items):
+        errors.append(f"Only {progress.get(ITEM_DONE, 0)} of {len(items)} items are done")
+    missing = set(items) - set(processed)
+    if missing:
+        errors.append(f"{len(missing)} items were never processed")
+    return errors
+
+
+if __name__ == "__main__":
+    # python3 -m benchmarks.check_work_queue --items 200 --workers 4
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--work_seconds", type=float, default=0.05)
+    parser.add_argument("--lease_seconds", type=float, default=2)
+    # e.g. postgresql://postgres@localhost/postgres to check the queue shared by several hosts
+    parser.add_argument("--queue_url", type=str, default=None)
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--queue", type=str, default=CHECK_QUEUE, help=argparse.SUPPRESS)
+    parser.add_argument("--queue_path", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--log_path", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--die_after", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.queue_path, args.queue, args.worker, args.work_seconds, args.lease_seconds, args.log_path,
+                   args.die_after)
+        sys.exit(0)
+
+    items = [(f"project_{index % 7}", f"content_{index}") for index in range(args.items)]
+    errors = check_shards(items, args.shards)
+    errors += check_work_queue(items, args.workers, args.work_seconds, args.lease_seconds, args.queue_url)
+    for error in errors:
+        print(error)
+    print("FAILED" if errors else "OK: every item was processed and acknowledged")
+    sys.exit(1 if errors else 0)
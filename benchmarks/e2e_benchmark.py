@@ -0,0 +1,307 @@
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.check_sharded_render import generate_synthetic_video
+from benchmarks.local_hls import LocalHlsServer, package_recording
+from benchmarks.local_s3 import LocalS3Server
+from utils import render_slots
+from utils.aws import S3_ENDPOINT_URL_ENV
+from utils.journal import JobJournal
+from utils.media_processor import STATIC_ASSETS_BUCKET, s3_video_file_key
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = ("uploads", "upload_urls", "recordings", "upload_preseeded")
+# Scripts with --journal, the journal source is named after the script
+JOURNAL_SOURCES = ("uploads", "upload_urls", "recordings")
+BENCHMARK_ENV = "benchmark"
+VES_TOKEN_SECRET_ID = "prod/content-lab-credentials"
+S3_KEY_PRESEEDED_INDEX = "content-lab/filmstrip/pre-seeded/filmstrip_index.json"
+S3_KEY_INDEX = "content-lab/filmstrip/{}/{}/filmstrip_index.json"
+DISK_SAMPLE_SECONDS = 0.2
+PERCENTILES = (50, 90, 99)
+# The columns the queries of the entry scripts select and filter on, times are stored like sqlite3 writes datetimes
+FIXTURE_SCHEMA = """
+CREATE TABLE content_upload (
+    id TEXT PRIMARY KEY,
+    project_id TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    deleted TEXT,
+    av_type TEXT,
+    import_source_type TEXT,
+    import_url TEXT,
+    is_sample_upload TEXT
+);
+CREATE TABLE media_content (
+    id TEXT PRIMARY KEY,
+    project_id TEXT NOT NULL,
+    end_time TIMESTAMP NOT NULL,
+    batch_status TEXT,
+    type TEXT,
+    media_type TEXT
+);
+"""
+
+
+def generate_corpus(directory, durations, sizes):
+    """
+    :return: List of (video file, size) for every combination of duration and resolution.
+    """
+    corpus = []
+    for duration in durations:
+        for size in sizes:
+            output_file = os.path.join(directory, f"synthetic_{duration}s_{size}.mp4")
+            corpus.append((generate_synthetic_video(output_file, duration, size), size))
+    return corpus
+
+
+def seed_fixture(script, corpus, copies, store, hls_root, hls_url, db_path):
+    """
+    Put the sources of the script's rows where it expects them and insert the rows into a SQLite fixture with the
+    tables and columns the query of the script reads. Every script also gets rows its query must not return, deleted
+    or older than the --days window.
+
+    :return: Number of rows the query of the script returns.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    uploads = []
+    recordings = []
+    items = 0
+    for index in range(copies):
+        for video_index, (input_file, size) in enumerate(corpus):
+            project_id = f"{script}-project-{index}"
+            content_id = f"{script}-content-{video_index}"
+            # Distinct times, the watermark orders the rows by them
+            created_at = (now - datetime.timedelta(hours=1, seconds=items)).isoformat(sep=" ")
+            items += 1
+            if script == "uploads":
+                with open(input_file, "rb") as f:
+                    store.put(STATIC_ASSETS_BUCKET, s3_video_file_key.format(project_id=project_id,
+                                                                             content_id=content_id), f.read())
+                uploads.append((content_id, project_id, created_at, None, "VIDEO", None, None, "false"))
+            elif script == "upload_urls":
+                # Hosted links are served by the same HTTP server as the recordings
+                link = os.path.join("links", project_id, f"{content_id}.mp4")
+                os.makedirs(os.path.dirname(os.path.join(hls_root, link)), exist_ok=True)
+                shutil.copyfile(input_file, os.path.join(hls_root, link))
+                uploads.append((content_id, project_id, created_at, None, "VIDEO", "HOSTED_URL", f"{hls_url}/{link}",
+                                "false"))
+            elif script == "recordings":
+                package_recording(input_file, hls_root, BENCHMARK_ENV, project_id, content_id, size)
+                recordings.append((content_id, project_id, created_at, "DONE", "RECORDING", "VIDEO"))
+            else:
+                uploads.append((content_id, project_id, created_at, None, "VIDEO", None, None, "true"))
+    if script == "upload_preseeded":
+        store.put(STATIC_ASSETS_BUCKET, S3_KEY_PRESEEDED_INDEX, b'{"filmstrips": []}', "application/json")
+    stale = (now - datetime.timedelta(days=30)).isoformat(sep=" ")
+    project_id = f"{script}-project-ignored"
+    uploads += [("ignored-deleted", project_id, now.isoformat(sep=" "), "true", "VIDEO", None, None, "false"),
+                ("ignored-stale", project_id, stale, None, "VIDEO", None, None, "false")]
+    recordings += [("ignored-pending", project_id, now.isoformat(sep=" "), "PENDING", "RECORDING", "VIDEO"),
+                   ("ignored-stale", project_id, stale, "DONE", "RECORDING", "VIDEO")]
+    connection = sqlite3.connect(db_path)
+    connection.executescript(FIXTURE_SCHEMA)
+    connection.executemany("INSERT INTO content_upload VALUES (?, ?, ?, ?, ?, ?, ?, ?)", uploads)
+    connection.executemany("INSERT INTO media_content VALUES (?, ?, ?, ?, ?, ?)", recordings)
+    connection.commit()
+    connection.close()
+    return items
+
+
+def directory_size(directory):
+    size = 0
+    for root, _, files in os.walk(directory):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except FileNotFoundError:
+                # Scratch files come and go while the script runs
+                pass
+    return size
+
+
+def sample_disk(directory, stop, high_water):
+    while not stop.wait(DISK_SAMPLE_SECONDS):
+        high_water[0] = max(high_water[0], directory_size(directory))
+
+
+def run_script(script, workdir, db_path, metrics_path, endpoint_url, hls_url, extra_args):
+    """
+    Run an entry script against the fixture and the stand-ins like it runs on a migration host, discovery included.
+    Scripts with a journal run with it, every script with a watermark.
+
+    :return: Dictionary with the return code, wall time, peak RSS and disk high-water mark of the run.
+    """
+    state_path = os.path.join(workdir, "journal.db")
+    cmd = [sys.executable, os.path.join(REPOSITORY_ROOT, f"{script}.py"), "--env", BENCHMARK_ENV,
+           "--db_url", f"sqlite:///{db_path}", "--watermark", state_path, "--metrics_jsonl", metrics_path,
+           *extra_args]
+    if script in JOURNAL_SOURCES:
+        cmd += ["--journal", state_path]
+    if script == "recordings":
+        cmd += ["--simulive_server", hls_url, "--fixed_rendition"]
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": REPOSITORY_ROOT,
+        S3_ENDPOINT_URL_ENV: endpoint_url,
+        "AWS_ENDPOINT_URL_SECRETS_MANAGER": endpoint_url,
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "AWS_DEFAULT_REGION": "us-east-1",
+    })
+    downloads = os.path.join(workdir, "downloads")
+    os.makedirs(downloads, exist_ok=True)
+    stop = threading.Event()
+    high_water = [0]
+    sampler = threading.Thread(target=sample_disk, args=(downloads, stop, high_water), daemon=True)
+    sampler.start()
+    with open(os.path.join(workdir, f"{script}.log"), "a") as log:
+        start_time = time.monotonic()
+        process = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall_time = time.monotonic() - start_time
+    stop.set()
+    sampler.join()
+    return {
+        "returncode": os.waitstatus_to_exitcode(status),
+        "wall_time": round(wall_time, 3),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_bytes": rusage.ru_maxrss * 1024,
+        "disk_high_water_bytes": high_water[0],
+    }
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def stage_latencies(metrics_path):
+    """
+    :return: Dictionary of the latency percentiles in seconds per pipeline stage, from the JSON lines metrics.
+    """
+    seconds = {}
+    with open(metrics_path) as f:
+        for line in f:
+            update = json.loads(line)
+            if update["metric"] == "stage_seconds":
+                seconds.setdefault(update["labels"]["stage"], []).append(update["value"])
+    return {stage: {f"p{percent}": round(percentile(values, percent), 3) for percent in PERCENTILES}
+            for stage, values in seconds.items()}
+
+
+def stage_jobs(metrics_path):
+    with open(metrics_path) as f:
+        return sum(1 for line in f if json.loads(line)["metric"] == "stage_seconds")
+
+
+def benchmark_script(script, corpus, copies, store, hls_root, hls_url, endpoint_url, extra_args):
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, "fixture.db")
+        metrics_path = os.path.join(workdir, "metrics.jsonl")
+        rerun_metrics_path = os.path.join(workdir, "rerun_metrics.jsonl")
+        items = seed_fixture(script, corpus, copies, store, hls_root, hls_url, db_path)
+        result = run_script(script, workdir, db_path, metrics_path, endpoint_url, hls_url, extra_args)
+        result["stages"] = stage_latencies(metrics_path) if os.path.exists(metrics_path) else {}
+        if script in JOURNAL_SOURCES:
+            journal = JobJournal(os.path.join(workdir, "journal.db"), script)
+            result["journal"] = journal.progress()
+            journal.close()
+        # Nothing is left to do in the second run, it only pays for the query, the journal, the S3 listing and the
+        # watermark
+        rerun = run_script(script, workdir, db_path, rerun_metrics_path, endpoint_url, hls_url, extra_args)
+        if os.path.exists(rerun_metrics_path):
+            rerun["stage_jobs"] = stage_jobs(rerun_metrics_path)
+        result["rerun"] = rerun
+        if result["returncode"] != 0 or rerun["returncode"] != 0:
+            with open(os.path.join(workdir, f"{script}.log")) as f:
+                print(f.read()[-4000:])
+    indexed = sum(1 for key in store.keys(STATIC_ASSETS_BUCKET)
+                  if key.startswith("content-lab/filmstrip/") and key.endswith("/filmstrip_index.json")
+                  and key.split("/")[2].startswith(f"{script}-project-"))
+    result.update({
+        "items": items,
+        "indexed": indexed,
+        "items_per_second": round(indexed / result["wall_time"], 3),
+    })
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPOSITORY_ROOT, check=True, capture_output=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results, previous):
+    for script, result in results["scripts"].items():
+        before = previous["scripts"].get(script)
+        if before is None:
+            continue
+        deltas = []
+        for name in ("items_per_second", "peak_rss_bytes", "disk_high_water_bytes"):
+            if before.get(name):
+                deltas.append(f"{name} {(result[name] - before[name]) / before[name]:+.1%}")
+        print(f"{script} vs {previous.get('commit', 'previous')[:12]}: {', '.join(deltas)}")
+
+
+if __name__ == "__main__":
+    # python3 -m benchmarks.e2e_benchmark --durations 30 120 --sizes 640x360 1280x720 --output results.json
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scripts", type=str, nargs="+", default=list(SCRIPTS), choices=SCRIPTS)
+    parser.add_argument("--durations", type=int, nargs="+", default=[30, 120])
+    parser.add_argument("--sizes", type=str, nargs="+", default=["640x360", "1280x720"])
+    # Every video of the corpus is published this many times per script, under different ids
+    parser.add_argument("--copies", type=int, default=2)
+    parser.add_argument("--output", type=str, default="e2e_benchmark.json", help="Write the results to this file")
+    parser.add_argument("--compare", type=str, default=None, help="Results of a previous run to print deltas to")
+    # Everything after -- is passed to every entry script, e.g. -- --render_slots 2
+    parser.add_argument("script_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    extra_args = [arg for arg in args.script_args if arg != "--"]
+
+    errors = []
+    results = {"commit": git_commit(), "cpu_count": render_slots.CPU_COUNT, "durations": args.durations,
+               "sizes": args.sizes, "copies": args.copies, "script_args": extra_args, "scripts": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        hls_root = os.path.join(directory, "hls")
+        os.makedirs(hls_root)
+        corpus = generate_corpus(os.path.join(directory, "corpus"), args.durations, args.sizes)
+        s3_server = LocalS3Server().start()
+        s3_server.store.secrets[VES_TOKEN_SECRET_ID] = "benchmark-token"
+        hls_server = LocalHlsServer(hls_root).start()
+        for script in args.scripts:
+            result = benchmark_script(script, corpus, args.copies, s3_server.store, hls_root, hls_server.url,
+                                      s3_server.endpoint_url, extra_args)
+            results["scripts"][script] = result
+            print(f"{script}: {json.dumps(result)}")
+            if result["returncode"] != 0:
+                errors.append(f"{script} exited with {result['returncode']}")
+            if result["indexed"] != result["items"]:
+                errors.append(f"{script}: {result['indexed']} of {result['items']} items have an index in S3")
+            if result["rerun"]["returncode"] != 0 or result["rerun"].get("stage_jobs"):
+                errors.append(f"{script}: the second run exited with {result['rerun']['returncode']} and ran "
+                              f"{result['rerun'].get('stage_jobs')} stage jobs instead of none")
+        hls_server.shutdown()
+        s3_server.shutdown()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+    for error in errors:
+        print(error)
+    print("FAILED" if errors else "OK: every script processed all of its items")
+    sys.exit(1 if errors else 0)
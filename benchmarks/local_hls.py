@@ -0,0 +1,82 @@
+import argparse
+import functools
+import os
+import subprocess
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.recordings import DEFAULT_RENDITION_PLAYLIST, HLS_BASE_URL, MASTER_PLAYLIST
+
+HLS_SEGMENT_SECONDS = 6
+# Bandwidth listed in the master playlist, the synthetic renditions are far smaller than real ones
+SYNTHETIC_BANDWIDTH = 800 * 1000
+
+
+def recording_directory(root, env, event_id, broadcast_id):
+    # Same layout as the simulive server, HLS_BASE_URL with the server replaced by the root directory
+    return HLS_BASE_URL.format(root, env, event_id, broadcast_id, "").rstrip("/")
+
+
+def package_recording(input_file, root, env, event_id, broadcast_id, size="640x360"):
+    """
+    Cut a video into TS segments with the rendition playlist and master playlist the simulive server publishes.
+
+    :return: Directory of the playlists.
+    """
+    directory = recording_directory(root, env, event_id, broadcast_id)
+    os.makedirs(directory, exist_ok=True)
+    cmd = [
+        "ffmpeg",
+        "-i",
+        input_file,
+        "-c",
+        "copy",
+        "-f",
+        "hls",
+        "-hls_time",
+        str(HLS_SEGMENT_SECONDS),
+        "-hls_playlist_type",
+        "vod",
+        "-hls_segment_filename",
+        os.path.join(directory, "segment_%05d.ts"),
+        os.path.join(directory, DEFAULT_RENDITION_PLAYLIST),
+        "-y",
+    ]
+    subprocess.run(cmd, check=True, capture_output=True)
+    with open(os.path.join(directory, MASTER_PLAYLIST), "w") as f:
+        f.write(f"#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH={SYNTHETIC_BANDWIDTH},RESOLUTION={size}\n"
+                f"{DEFAULT_RENDITION_PLAYLIST}\n")
+    return directory
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalHlsServer(ThreadingHTTPServer):
+    """
+    Serves a directory over HTTP, a stand-in for the simulive server and for hosted video links.
+    """
+    daemon_threads = True
+
+    def __init__(self, root, address=("127.0.0.1", 0)):
+        super().__init__(address, functools.partial(QuietHandler, directory=root))
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", type=str)
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    server = LocalHlsServer(args.root, ("127.0.0.1", args.port))
+    print(f"Serving {args.root} on {server.url}, run recordings.py with --simulive_server={server.url}")
+    server.serve_forever()
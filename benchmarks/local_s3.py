@@ -0,0 +1,268 @@
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+S3_XML_NAMESPACE = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+class LocalS3Store:
+    """
+    In-memory bucket/key store behind LocalS3Server.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.secrets = {}
+
+    def put(self, bucket, key, body, content_type="binary/octet-stream"):
+        with self.lock:
+            self.objects[(bucket, key)] = {
+                "body": body,
+                "etag": f'"{hashlib.md5(body).hexdigest()}"',
+                "content_type": content_type,
+            }
+            return self.objects[(bucket, key)]
+
+    def get(self, bucket, key):
+        with self.lock:
+            return self.objects.get((bucket, key))
+
+    def delete(self, bucket, key):
+        with self.lock:
+            self.objects.pop((bucket, key), None)
+
+    def keys(self, bucket, prefix=""):
+        with self.lock:
+            return sorted(key for object_bucket, key in self.objects if object_bucket == bucket and
+                          key.startswith(prefix))
+
+
+class LocalS3Handler(BaseHTTPRequestHandler):
+    """
+    Path style S3 API subset used by the migration: Get/Head/Put/Delete/CopyObject and ListObjectsV2. Also answers
+    Secrets Manager GetSecretValue, for clients pointed here with AWS_ENDPOINT_URL_SECRETS_MANAGER.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def _bucket_and_key(self):
+        path = urlparse(self.path).path.lstrip("/")
+        bucket, _, key = path.partition("/")
+        return unquote(bucket), unquote(key)
+
+    def _query(self):
+        return {name: values[0] for name, values in parse_qs(urlparse(self.path).query).items()}
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_xml(self, status, xml):
+        self._send(status, f'<?xml version="1.0" encoding="UTF-8"?>{xml}'.encode(),
+                   {"Content-Type": "application/xml"})
+
+    def _send_error(self, status, code, message=""):
+        self._send_xml(status, f"<Error><Code>{code}</Code><Message>{escape(message)}</Message></Error>")
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _inject_fault(self):
+        """
+        Answer the request with a 503 SlowDown when the server's fault injection says so.
+
+        :return: True when the request was answered.
+        """
+        if not self.server.faults.throttle():
+            return False
+        self._send_error(503, "SlowDown", "Please reduce your request rate.")
+        return True
+
+    def do_HEAD(self):
+        if self._inject_fault():
+            return
+        bucket, key = self._bucket_and_key()
+        s3_object = self.store.get(bucket, key)
+        if s3_object is None:
+            return self._send(404)
+        self._send(200, s3_object["body"], self._object_headers(s3_object))
+
+    def _object_headers(self, s3_object):
+        return {"ETag": s3_object["etag"], "Content-Type": s3_object["content_type"], "Accept-Ranges": "bytes"}
+
+    def do_GET(self):
+        if self._inject_fault():
+            return
+        bucket, key = self._bucket_and_key()
+        if not key:
+            return self._list_objects(bucket)
+        s3_object = self.store.get(bucket, key)
+        if s3_object is None:
+            return self._send_error(404, "NoSuchKey", key)
+        body = s3_object["body"]
+        headers = self._object_headers(s3_object)
+        byte_range = self.headers.get("Range")
+        if byte_range and byte_range.startswith("bytes="):
+            start, _, end = byte_range[len("bytes="):].partition("-")
+            start = int(start)
+            end = min(int(end) if end else len(body) - 1, len(body) - 1)
+            if start >= len(body):
+                return self._send_error(416, "InvalidRange", byte_range)
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            return self._send(206, body[start:end + 1], headers)
+        self._send(200, body, headers)
+
+    def _list_objects(self, bucket):
+        query = self._query()
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter", "")
+        max_keys = int(query.get("max-keys", 1000))
+        start_after = query.get("continuation-token") or query.get("start-after", "")
+        contents = []
+        common_prefixes = []
+        is_truncated = False
+        next_token = ""
+        for key in self.store.keys(bucket, prefix):
+            if key <= start_after:
+                continue
+            if len(contents) + len(common_prefixes) >= max_keys:
+                is_truncated = True
+                break
+            if delimiter and delimiter in key[len(prefix):]:
+                common_prefix = prefix + key[len(prefix):].split(delimiter)[0] + delimiter
+                if common_prefix not in common_prefixes:
+                    common_prefixes.append(common_prefix)
+                next_token = key
+                continue
+            s3_object = self.store.get(bucket, key)
+            contents.append(f"<Contents><Key>{escape(key)}</Key><Size>{len(s3_object['body'])}</Size>"
+                            f"<ETag>{escape(s3_object['etag'])}</ETag></Contents>")
+            next_token = key
+        xml = (f'<ListBucketResult xmlns="{S3_XML_NAMESPACE}"><Name>{escape(bucket)}</Name>'
+               f"<Prefix>{escape(prefix)}</Prefix><KeyCount>{len(contents) + len(common_prefixes)}</KeyCount>"
+               f"<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{str(is_truncated).lower()}</IsTruncated>"
+               + "".join(contents)
+               + "".join(f"<CommonPrefixes><Prefix>{escape(p)}</Prefix></CommonPrefixes>" for p in common_prefixes)
+               + (f"<NextContinuationToken>{escape(next_token)}</NextContinuationToken>" if is_truncated else "")
+               + "</ListBucketResult>")
+        self._send_xml(200, xml)
+
+    def do_PUT(self):
+        bucket, key = self._bucket_and_key()
+        body = self._read_body()
+        if self._inject_fault():
+            return
+        if not key:
+            return self._send(200)
+        copy_source = self.headers.get("x-amz-copy-source")
+        if copy_source:
+            source_bucket, _, source_key = unquote(copy_source).lstrip("/").partition("/")
+            source = self.store.get(source_bucket, source_key)
+            if source is None:
+                return self._send_error(404, "NoSuchKey", source_key)
+            s3_object = self.store.put(bucket, key, source["body"], source["content_type"])
+            return self._send_xml(200, f"<CopyObjectResult><ETag>{escape(s3_object['etag'])}</ETag>"
+                                       f"</CopyObjectResult>")
+        s3_object = self.store.put(bucket, key, body, self.headers.get("Content-Type", "binary/octet-stream"))
+        self._send(200, headers={"ETag": s3_object["etag"]})
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.headers.get("X-Amz-Target") != "secretsmanager.GetSecretValue":
+            return self._send_error(400, "InvalidAction", self.headers.get("X-Amz-Target", ""))
+        secret_id = json.loads(body)["SecretId"]
+        secret = self.store.secrets.get(secret_id)
+        headers = {"Content-Type": "application/x-amz-json-1.1"}
+        if secret is None:
+            error = {"__type": "ResourceNotFoundException", "Message": f"Secret {secret_id} not found"}
+            return self._send(400, json.dumps(error).encode(), headers)
+        self._send(200, json.dumps({"Name": secret_id, "SecretString": secret}).encode(), headers)
+
+    def do_DELETE(self):
+        bucket, key = self._bucket_and_key()
+        self.store.delete(bucket, key)
+        self._send(204)
+
+
+class FaultInjection:
+    """
+    Throttles like S3 does under load: requests above rate_limit per second, and a random share of all requests,
+    get a 503 SlowDown. Every request that gets through takes latency seconds.
+    """
+
+    def __init__(self, rate_limit=None, slowdown_probability=0.0, latency=0.0):
+        self.rate_limit = rate_limit
+        self.slowdown_probability = slowdown_probability
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.tokens = rate_limit or 0
+        self.last_refill = time.monotonic()
+        self.requests = 0
+        self.throttled = 0
+
+    def throttle(self):
+        with self.lock:
+            self.requests += 1
+            throttled = random.random() < self.slowdown_probability
+            if self.rate_limit is not None and not throttled:
+                # Token bucket holding at most one second of requests
+                now = time.monotonic()
+                self.tokens = min(self.rate_limit, self.tokens + (now - self.last_refill) * self.rate_limit)
+                self.last_refill = now
+                throttled = self.tokens < 1
+                if not throttled:
+                    self.tokens -= 1
+            if throttled:
+                self.throttled += 1
+        if not throttled and self.latency:
+            time.sleep(self.latency)
+        return throttled
+
+
+class LocalS3Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), handler_class=LocalS3Handler, faults=None):
+        super().__init__(address, handler_class)
+        self.store = LocalS3Store()
+        self.faults = faults or FaultInjection()
+
+    @property
+    def endpoint_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=4566)
+    # Fault injection, e.g. --rate_limit 100 --latency 0.05 to see the S3 limiters back off
+    parser.add_argument("--rate_limit", type=float, default=None, help="Requests per second before 503 SlowDown")
+    parser.add_argument("--slowdown_probability", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    server = LocalS3Server(("127.0.0.1", args.port),
+                           faults=FaultInjection(args.rate_limit, args.slowdown_probability, args.latency))
+    print(f"Local S3 stand-in listening on {server.endpoint_url}, export AWS_ENDPOINT_URL_S3={server.endpoint_url}")
+    server.serve_forever()
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.check_sharded_render import generate_synthetic_video
+from utils.filmstrip import OUTPUT_DIRECTORY, RENDER_ENGINES, RENDER_MODE_WEBP, generate_filmstrip, \
+    list_filmstrip_files
+
+BENCHMARK_PROJECT_ID = "render-engine-benchmark"
+SYNTHETIC_VIDEO = "downloads/render-engine-benchmark/synthetic_{}.mp4"
+# Mean absolute difference per pixel allowed between the sheets of both engines, they tile the same frames but
+# convert and encode them differently
+MAX_SHEET_DIFFERENCE = 8
+
+
+def run_engine(input_file, render_engine):
+    """
+    Render the video in a child process, so the CPU time and peak RSS cover the render and its ffmpeg processes only.
+
+    :return: Dictionary with the wall time and CPU time in seconds and the peak RSS in MB.
+    """
+    cmd = [sys.executable, "-m", "benchmarks.render_engine_benchmark", "--worker", render_engine, input_file]
+    start_time = time.monotonic()
+    process = subprocess.Popen(cmd)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return {
+        "wall_time": round(time.monotonic() - start_time, 3),
+        "cpu_time": round(usage.ru_utime + usage.ru_stime, 3),
+        # Linux reports kilobytes, the maximum is the one of the largest process, python or ffmpeg
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+    }
+
+
+def compare_sheets(first_directory, second_directory):
+    errors = []
+    first_sheets = list_filmstrip_files(first_directory, ".webp")
+    second_sheets = list_filmstrip_files(second_directory, ".webp")
+    if first_sheets != second_sheets:
+        errors.append(f"Sheet names differ: {first_sheets} != {second_sheets}")
+    for sheet in sorted(set(first_sheets) & set(second_sheets)):
+        first = np.asarray(Image.open(os.path.join(first_directory, sheet)).convert("RGB"), dtype=np.int16)
+        second = np.asarray(Image.open(os.path.join(second_directory, sheet)).convert("RGB"), dtype=np.int16)
+        if first.shape != second.shape:
+            errors.append(f"{sheet} is {first.shape} in one render and {second.shape} in the other")
+            continue
+        # The synthetic video shows a running timestamp, tiles out of order differ far more than the encoding does
+        difference = float(np.abs(first - second).mean())
+        if difference > MAX_SHEET_DIFFERENCE:
+            errors.append(f"{sheet} differs by {difference:.1f} per pixel")
+    return errors
+
+
+def benchmark_render_engines(durations):
+    results = []
+    errors = []
+    for duration in durations:
+        input_file = generate_synthetic_video(SYNTHETIC_VIDEO.format(duration), duration)
+        result = {"duration": duration}
+        for render_engine in RENDER_ENGINES:
+            result[render_engine] = run_engine(input_file, render_engine)
+            result[render_engine]["sheets"] = len(list_filmstrip_files(
+                OUTPUT_DIRECTORY.format(BENCHMARK_PROJECT_ID, render_engine), ".webp"))
+        directories = [OUTPUT_DIRECTORY.format(BENCHMARK_PROJECT_ID, engine) for engine in RENDER_ENGINES]
+        errors += [f"{duration}s video: {error}" for error in compare_sheets(*directories)]
+        for directory in directories:
+            shutil.rmtree(directory, ignore_errors=True)
+        print(json.dumps(result))
+        results.append(result)
+    return results, errors
+
+
+if __name__ == "__main__":
+    # python3 -m benchmarks.render_engine_benchmark --durations 60 600
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--durations", type=int, nargs="+", default=[60, 300])
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file")
+    parser.add_argument("--worker", type=str, default=None, choices=RENDER_ENGINES, help=argparse.SUPPRESS)
+    parser.add_argument("input_file", type=str, nargs="?")
+    args = parser.parse_args()
+
+    if args.worker:
+        generate_filmstrip(args.input_file, BENCHMARK_PROJECT_ID, args.worker, render_mode=RENDER_MODE_WEBP,
+                           render_engine=args.worker)
+        sys.exit(0)
+
+    try:
+        results, errors = benchmark_render_engines(args.durations)
+    finally:
+        shutil.rmtree(os.path.dirname(OUTPUT_DIRECTORY.format(BENCHMARK_PROJECT_ID, "")), ignore_errors=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    for error in errors:
+        print(error)
+    print("FAILED" if errors else "OK: both engines render the same sheets")
+    sys.exit(1 if errors else 0)
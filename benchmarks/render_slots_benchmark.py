@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.check_sharded_render import generate_synthetic_video
+from utils import render_slots
+from utils.filmstrip import OUTPUT_DIRECTORY, RENDER_MODES, RENDER_MODE_WEBP, generate_filmstrip
+
+BENCHMARK_PROJECT_ID = "render-slots-benchmark"
+CORPUS_VIDEO = "downloads/render-slots-benchmark/corpus_{}.mp4"
+
+
+def default_sweep():
+    # Powers of two up to the core count, leaving out configurations that oversubscribe the host more than twice
+    cpu_count = render_slots.CPU_COUNT
+    counts = sorted({2 ** exponent for exponent in range(cpu_count.bit_length())} | {cpu_count})
+    return [(slots, threads) for slots in counts for threads in (1, 2, 4)
+            if slots * threads <= 2 * cpu_count]
+
+
+def render_corpus(corpus, slots, threads, render_mode):
+    """
+    Render every video of the corpus with the given slots and thread budget, as many render workers as slots.
+
+    :return: Dictionary with the configuration, wall time and videos rendered per second.
+    """
+    render_slots.configure(slots, threads)
+    content_ids = [f"{slots}x{threads}_{index}" for index in range(len(corpus))]
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=slots) as executor:
+        list(executor.map(
+            lambda input_file, content_id: generate_filmstrip(input_file, BENCHMARK_PROJECT_ID, content_id,
+                                                              render_mode=render_mode),
+            corpus, content_ids))
+    wall_time = time.monotonic() - start_time
+    render_slots.reset()
+    for content_id in content_ids:
+        shutil.rmtree(OUTPUT_DIRECTORY.format(BENCHMARK_PROJECT_ID, content_id), ignore_errors=True)
+    return {
+        "slots": slots,
+        "threads": threads,
+        "wall_time": round(wall_time, 3),
+        "videos_per_second": round(len(corpus) / wall_time, 3),
+    }
+
+
+if __name__ == "__main__":
+    # python3 -m benchmarks.render_slots_benchmark --videos 16 --duration 120
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--videos", type=int, default=2 * render_slots.CPU_COUNT)
+    parser.add_argument("--duration", type=int, default=60)
+    parser.add_argument("--render_mode", type=str, default=RENDER_MODE_WEBP, choices=RENDER_MODES)
+    # Configurations as slots x threads, e.g. --sweep 4x2 8x1, by default a sweep sized for this host
+    parser.add_argument("--sweep", type=str, nargs="+", default=None)
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.sweep:
+        sweep = [tuple(int(value) for value in configuration.split("x")) for configuration in args.sweep]
+    else:
+        sweep = default_sweep()
+
+    # Videos of the corpus differ in resolution, like the sources of a real run do
+    sizes = ["640x360", "1280x720", "1920x1080"]
+    try:
+        corpus = [generate_synthetic_video(CORPUS_VIDEO.format(index), args.duration, size=sizes[index % len(sizes)])
+                  for index in range(args.videos)]
+        results = []
+        for slots, threads in sweep:
+            result = render_corpus(corpus, slots, threads, args.render_mode)
+            result["video_seconds_per_second"] = round(result["videos_per_second"] * args.duration, 1)
+            print(json.dumps(result))
+            results.append(result)
+    finally:
+        shutil.rmtree(os.path.dirname(OUTPUT_DIRECTORY.format(BENCHMARK_PROJECT_ID, "")), ignore_errors=True)
+
+    best = max(results, key=lambda result: result["videos_per_second"])
+    print(f"Best on {render_slots.CPU_COUNT} CPUs: --render_slots={best['slots']} --ffmpeg_threads={best['threads']} "
+          f"({best['videos_per_second']} videos/s)")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"cpu_count": render_slots.CPU_COUNT, "results": results, "best": best}, f, indent=4)
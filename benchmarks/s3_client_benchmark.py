@@ -0,0 +1,58 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+from benchmarks.local_s3 import LocalS3Server
+from utils import aws
+from utils.filmstrip import STATIC_ASSETS_BUCKET
+
+BENCHMARK_KEY = "content-lab/filmstrip/benchmark/benchmark/filmstrip_index.json"
+
+
+def per_call_client_request(_):
+    # How every S3 helper worked before the shared client layer
+    s3 = boto3.client('s3', endpoint_url=os.environ[aws.S3_ENDPOINT_URL_ENV], config=aws.client_config())
+    s3.head_object(Bucket=STATIC_ASSETS_BUCKET, Key=BENCHMARK_KEY)
+
+
+def shared_client_request(_):
+    aws.s3_client().head_object(Bucket=STATIC_ASSETS_BUCKET, Key=BENCHMARK_KEY)
+
+
+def requests_per_second(request, requests, threads):
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(request, range(requests)))
+    return requests / (time.monotonic() - start_time)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=aws.DEFAULT_WORKERS)
+    parser.add_argument("--endpoint_url", type=str, default=None,
+                        help="S3 compatible endpoint to benchmark against, a local stand-in is started if omitted")
+    args = parser.parse_args()
+
+    server = None
+    if args.endpoint_url is None:
+        server = LocalS3Server().start()
+        args.endpoint_url = server.endpoint_url
+    os.environ[aws.S3_ENDPOINT_URL_ENV] = args.endpoint_url
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    aws.configure(max_pool_connections=args.threads)
+    aws.s3_client().put_object(Bucket=STATIC_ASSETS_BUCKET, Key=BENCHMARK_KEY, Body=b'{"filmstrip_file_names": []}')
+
+    before = requests_per_second(per_call_client_request, args.requests, args.threads)
+    after = requests_per_second(shared_client_request, args.requests, args.threads)
+    print(f"{args.requests} HEAD requests with {args.threads} threads against {args.endpoint_url}")
+    print(f"client per call: {before:.1f} requests/s")
+    print(f"shared client:   {after:.1f} requests/s ({after / before:.1f}x)")
+    if server:
+        server.shutdown()
@@ -1,37 +1,49 @@
 import argparse
-import concurrent
 import functools
-import json
 
-import pandas as pd
-from sqlalchemy import create_engine
-import boto3
-
-from utils.cleanup import cleanup_directory
-from utils.filmstrip import generate_filmstrip, upload_filmstrip_to_s3, check_file_in_s3, STATIC_ASSETS_BUCKET, \
-    S3_KEY_BASE_PATH, FILMSTRIP_INDEX_FILE
-from utils.recordings import download_m3u8_and_ts_files
-
-
-def process_row(env, simulive_server, row):
-    event_id = row['event_id']
-    broadcast_id = row['broadcast_id']
-    if not check_file_in_s3(STATIC_ASSETS_BUCKET,
-                            S3_KEY_BASE_PATH.format(event_id, broadcast_id, FILMSTRIP_INDEX_FILE)):
-        try:
-            downloaded_file_name = download_m3u8_and_ts_files(
-                event_id, broadcast_id, env, simulive_server
-            )
-            generate_filmstrip(downloaded_file_name, event_id, broadcast_id)
-            upload_filmstrip_to_s3(event_id, broadcast_id)
-        except Exception as ex:
-            print(f"Exception: {ex}")
-        finally:
-            cleanup_directory(event_id, broadcast_id)
+from utils import aws, metrics, render_slots, source_cache
+from utils.admission import add_admission_arguments, admission_from_args, job_footprint
+from utils.db import add_db_arguments, create_db_engine, stream_row_batches
+from utils.filmstrip import (add_render_arguments, render_options_from_args, FILMSTRIP_TILE_WIDTH, NUM_PARALLEL_UPLOADS,
+                             RENDER_ENGINE_NUMPY, STDIN_INPUT)
+from utils.journal import add_journal_arguments, journal_from_args
+from utils.pipeline import add_pipeline_arguments, discover_jobs, filmstrip_pipeline
+from utils.s3_index import CompletedFilmstripIndex
+from utils.watermark import add_watermark_arguments, query_condition, watermark_from_args
+from utils.work_queue import add_work_queue_arguments, run_jobs, shard_filters_from_args, work_queue_from_args
+from utils.recordings import (close_segment_fetcher, download_m3u8_and_ts_files, estimate_recording_bytes,
+                              read_recording_playlist, stream_m3u8_and_ts_files)
+
+
+def recording_playlist(env, simulive_server, min_width, job):
+    # Read once by the admission estimate or the fetch, whichever comes first, the other one reuses it
+    if job.playlist is None:
+        job.playlist = read_recording_playlist(job.project_id, job.content_id, env, simulive_server, min_width)
+    return job.playlist
+
+
+def fetch_recording(env, simulive_server, stream_segments, min_width, job):
+    playlist = recording_playlist(env, simulive_server, min_width, job)
+    if stream_segments:
+        # Only the playlist is read here, the segments are piped into ffmpeg by the render stage
+        job.input_feed = stream_m3u8_and_ts_files(job.project_id, job.content_id, playlist)
+        if job.input_feed is None:
+            raise ValueError(f"No TS segments found for {job.project_id}/{job.content_id}")
+        job.input_file = STDIN_INPUT
+        return
+    downloaded_file_name = download_m3u8_and_ts_files(job.project_id, job.content_id, playlist)
+    if downloaded_file_name is None:
+        raise ValueError(f"No TS segments found for {job.project_id}/{job.content_id}")
+    job.input_file = downloaded_file_name
+
+
+def estimate_recording(env, simulive_server, stream_segments, min_width, sheets_on_disk, job):
+    size = estimate_recording_bytes(recording_playlist(env, simulive_server, min_width, job))
+    return job_footprint(size, source_on_disk=not stream_segments, sheets_on_disk=sheets_on_disk)
 
 
 if __name__ == "__main__":
-    secrets_manager = boto3.client("secretsmanager")
+    secrets_manager = aws.secrets_manager_client()
 
     VES_TOKEN = secrets_manager.get_secret_value(
         SecretId="prod/content-lab-credentials"
@@ -39,70 +51,104 @@ if __name__ == "__main__":
     mediastore_endpoint = (
         "https://uago73t2my3lb2.data.mediastore.us-east-1.amazonaws.com"
     )
-    simulive_server = "https://stream.goldcast.io"
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--env", type=str, default="prod")
     parser.add_argument("--days", type=str, default="7")
+    add_db_arguments(parser)
+    # Number of index files to read and validate on top of the bulk listing
+    parser.add_argument("--deep_verify", type=int, default=0)
+    # Pipe the segments into ffmpeg as they arrive instead of writing them to disk first
+    parser.add_argument("--stream_segments", action="store_true")
+    # Use the lowest bitrate rendition at least this wide, the 1500 rendition when the flag below is set
+    parser.add_argument("--rendition_min_width", type=int, default=FILMSTRIP_TILE_WIDTH)
+    parser.add_argument("--fixed_rendition", action="store_true")
+    # Server of the recordings, by default the one of --env, e.g. a local stand-in for benchmarks
+    parser.add_argument("--simulive_server", type=str, default=None)
+    add_render_arguments(parser)
+    render_slots.add_render_slot_arguments(parser)
+    add_journal_arguments(parser)
+    add_pipeline_arguments(parser)
+    add_admission_arguments(parser)
+    add_work_queue_arguments(parser)
+    add_watermark_arguments(parser)
+    source_cache.add_source_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
     args = parser.parse_args()
+    metrics.configure(args.metrics_jsonl, args.metrics_prom)
+    # Downloaded sources are kept across runs, a re-run links them from the local disk instead of downloading them
+    source_cache.configure(args.source_cache, args.source_cache_gb)
+    # At most --render_slots ffmpeg processes run at once, each with --ffmpeg_threads threads
+    render_slots.configure(args.render_slots, args.ffmpeg_threads, args.ffmpeg_nice, args.pin_ffmpeg)
+    # Every publish worker uploads up to NUM_PARALLEL_UPLOADS tiles at once through the shared S3 client
+    aws.configure(max_pool_connections=args.fetch_workers + args.publish_workers * NUM_PARALLEL_UPLOADS)
     env = args.env
     days = args.days
-    db_username = None
-    db_password = None
-    db_host = None
-    db_port = None
-    db_name = None
+    render_options = render_options_from_args(args)
 
-    if env == "prod":
+    if args.simulive_server:
+        simulive_server = args.simulive_server
+    elif env == "prod":
         simulive_server = "https://stream.goldcast.io"
-        prod_creds = secrets_manager.get_secret_value(
-            SecretId="prod/content-lab-db/readonly"
-        )["SecretString"]
-        db = json.loads(prod_creds)
-        db_username = db["USER"]
-        db_password = db["PASSWORD"]
-        db_host = db["HOST"]
-        db_port = db["PORT"]
-        db_name = db["NAME"]
-
     else:
         simulive_server = "https://stream.alpha.goldcast.io"
-        alpha_creds = secrets_manager.get_secret_value(
-            SecretId="alpha-content-lab-db/readonly"
-        )["SecretString"]
-        db = json.loads(alpha_creds)
-        db_username = db["USER"]
-        db_password = db["PASSWORD"]
-        db_host = db["HOST"]
-        db_port = db["PORT"]
-        db_name = db["NAME"]
-
-    row_processor = functools.partial(process_row, env, simulive_server)
-    # Ensure that all necessary environment variables are set
-    if not all([db_username, db_password, db_host, db_port, db_name]):
-        raise ValueError("One or more environment variables are missing. Please set DB_USERNAME, DB_PASSWORD, DB_HOST, "
-                         "DB_PORT, and DB_NAME.")
-
-    # Create a connection string for PostgreSQL
-    connection_string = f'postgresql://{db_username}:{db_password}@{db_host}:{db_port}/{db_name}'
-
-    # Create a database engine
-    engine = create_engine(connection_string)
-
-    # Define the SQL query to read data from the content_upload table
-    query = ("select id as broadcast_id, project_id as event_id from media_content WHERE end_time >= NOW() - INTERVAL "
-             "'{}"
-             "days' and batch_status='DONE' and type='RECORDING' and media_type='VIDEO'")
-    # Read the data into a pandas DataFrame
-    df = pd.read_sql(query.format(days), engine)
-
-    # Display the first few rows of the DataFrame
-    print("Data from content_upload table:")
-    print(df.head())
-
-    # Apply the function to each row
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        executor.map(row_processor, [row for _, row in df.iterrows()])
-
-    # Close the connection
-    engine.dispose()
+
+    # Define the SQL query to read data from the media_content table
+    query = ("select id as broadcast_id, project_id as event_id, end_time from media_content WHERE {} and "
+             "batch_status='DONE' and type='RECORDING' and media_type='VIDEO'")
+
+    # Rows finished by a previous run are skipped from the journal without any S3 call, everything that already
+    # has a filmstrip in S3 is skipped before any work is scheduled
+    journal = journal_from_args(args, "recordings")
+    completed_filmstrips = CompletedFilmstripIndex(
+        deep_verify_sample=args.deep_verify,
+        on_completed=journal.mark_uploaded if journal is not None else None,
+    )
+    # Incremental runs only query the rows past the mark of the previous run, the mark advances past the rows
+    # that were published or found completed
+    watermark = watermark_from_args(args, "recordings", "end_time", "id", journal)
+    # Rows of other shards are dropped before anything probes S3 or writes to the journal
+    row_filters = shard_filters_from_args(args)
+    if watermark is not None:
+        row_filters.append(watermark.track_rows)
+    if journal is not None:
+        row_filters.append(journal.filter_rows)
+    row_filters.append(completed_filmstrips.filter_rows)
+    if watermark is not None:
+        row_filters.append(watermark.schedule_rows)
+
+    def discover():
+        # Create a database engine, queue workers never connect to the database
+        engine = create_db_engine(secrets_manager, env, args.db_url)
+        try:
+            # Stream the rows into the pipeline as they are read
+            condition = query_condition(watermark, "end_time", days, engine.dialect.name)
+            row_batches = stream_row_batches(engine, query.format(condition), ("end_time", "broadcast_id"))
+            yield from discover_jobs(row_batches, 'event_id', 'broadcast_id', row_filters)
+        finally:
+            # Close the connection
+            engine.dispose()
+
+    work_queue = work_queue_from_args(args, "recordings")
+    min_width = None if args.fixed_rendition else args.rendition_min_width
+    fetch = functools.partial(fetch_recording, env, simulive_server, args.stream_segments, min_width)
+    # Jobs start only while their estimated scratch disk and memory fit in the budgets
+    admission = admission_from_args(args, functools.partial(
+        estimate_recording, env, simulive_server, args.stream_segments, min_width,
+        args.render_engine != RENDER_ENGINE_NUMPY))
+    pipeline = filmstrip_pipeline(fetch, render_options, args, journal, admission, work_queue, watermark)
+    run_jobs(args, work_queue, discover, pipeline.run)
+    print(f"Admission summary: {admission.summary()}")
+    if source_cache.get_cache() is not None:
+        print(f"Source cache summary: {source_cache.summary()}")
+    # Advanced before the journal is closed, the failures recorded in it hold the mark back
+    if watermark is not None:
+        watermark.advance()
+        watermark.close()
+    close_segment_fetcher()
+    if journal is not None:
+        journal.close()
+    if work_queue is not None:
+        work_queue.close()
+    source_cache.close()
+    metrics.close()
@@ -1,12 +1,13 @@
 import argparse
-import concurrent
-import json
-import os
-import pandas as pd
-from sqlalchemy import create_engine
-import boto3
+import functools
 
-secrets_manager = boto3.client("secretsmanager")
+from utils import aws, metrics, throttle
+from utils.db import add_db_arguments, create_db_engine, stream_row_batches
+from utils.pipeline import Pipeline, Stage, discover_jobs
+from utils.watermark import add_watermark_arguments, query_condition, watermark_from_args
+from utils.work_queue import add_work_queue_arguments, run_jobs, shard_filters_from_args, work_queue_from_args
+
+secrets_manager = aws.secrets_manager_client()
 STATIC_ASSETS_BUCKET = "staticassets.goldcast.com"
 S3_KEY_PRESEEDED_BASE_PATH = "content-lab/filmstrip/pre-seeded/filmstrip_index.json"
 S3_KEY_BASE_PATH = "content-lab/filmstrip/{}/{}/filmstrip_index.json"
@@ -21,75 +22,72 @@ mediastore_endpoint = (
 parser = argparse.ArgumentParser()
 parser.add_argument("--env", type=str, default="prod")
 parser.add_argument("--days", type=str, default="7")
+add_db_arguments(parser)
+parser.add_argument("--publish_workers", type=int, default=aws.DEFAULT_WORKERS)
+add_work_queue_arguments(parser)
+add_watermark_arguments(parser)
+metrics.add_metrics_arguments(parser)
 args = parser.parse_args()
+metrics.configure(args.metrics_jsonl, args.metrics_prom)
+aws.configure(max_pool_connections=args.publish_workers)
 env = args.env
 days = args.days
 
-db_username = None
-db_password = None
-db_host = None
-db_port = None
-db_name = None
-
-if env == "prod":
-    prod_creds = secrets_manager.get_secret_value(
-        SecretId="prod/content-lab-db/readonly"
-    )["SecretString"]
-    db = json.loads(prod_creds)
-    db_username = db["USER"]
-    db_password = db["PASSWORD"]
-    db_host = db["HOST"]
-    db_port = db["PORT"]
-    db_name = db["NAME"]
-
-else:
-    alpha_creds = secrets_manager.get_secret_value(
-        SecretId="alpha-content-lab-db/readonly"
-    )["SecretString"]
-    db = json.loads(alpha_creds)
-    db_username = db["USER"]
-    db_password = db["PASSWORD"]
-    db_host = db["HOST"]
-    db_port = db["PORT"]
-    db_name = db["NAME"]
-
-# Ensure that all necessary environment variables are set
-if not all([db_username, db_password, db_host, db_port, db_name]):
-    raise ValueError("One or more environment variables are missing. Please set DB_USERNAME, DB_PASSWORD, DB_HOST, "
-                     "DB_PORT, and DB_NAME.")
-
-# Create a connection string for PostgreSQL
-connection_string = f'postgresql://{db_username}:{db_password}@{db_host}:{db_port}/{db_name}'
-
-# Create a database engine
-engine = create_engine(connection_string)
-
 # Define the SQL query to read data from the content_upload table
-query = ("select id as content_id, project_id from content_upload WHERE created_at >= NOW() - INTERVAL '{} "
-         "days' and deleted is null and av_type='VIDEO' and is_sample_upload='true'")
-# Read the data into a pandas DataFrame
-df = pd.read_sql(query.format(days), engine)
+query = ("select id as content_id, project_id, created_at from content_upload WHERE {} and deleted is null and "
+         "av_type='VIDEO' and is_sample_upload='true'")
 
 
 def copy_s3_file(source_bucket, source_key, destination_bucket, destination_key):
     try:
-        s3 = boto3.client('s3')
+        s3 = aws.s3_client()
         copy_source = {'Bucket': source_bucket, 'Key': source_key}
-        s3.copy_object(CopySource=copy_source, Bucket=destination_bucket, Key=destination_key)
+        with throttle.get_limiter(f"s3:{destination_bucket}").slot():
+            s3.copy_object(CopySource=copy_source, Bucket=destination_bucket, Key=destination_key)
         print(f'Successfully copied {source_key} from {source_bucket} to {destination_bucket}/{destination_key}')
     except Exception as e:
         print(f"Error: {e}")
+        # The pipeline requeues throttled copies, other failures hold the watermark back
+        raise
+
 
+# The pre-seeded index only has to be copied, so the pipeline has a single publish stage
+def publish_preseeded_index(job):
+    copy_s3_file(STATIC_ASSETS_BUCKET, S3_KEY_PRESEEDED_BASE_PATH, STATIC_ASSETS_BUCKET,
+                 S3_KEY_BASE_PATH.format(job.project_id, job.content_id))
 
-# Function to apply
-def process_row(row):
-    project_id = row['project_id']
-    content_id = row['content_id']
-    copy_s3_file(STATIC_ASSETS_BUCKET, S3_KEY_PRESEEDED_BASE_PATH, STATIC_ASSETS_BUCKET, S3_KEY_BASE_PATH.format(project_id, content_id))
 
+def finish_job(work_queue, watermark, job, err):
+    if watermark is not None:
+        watermark.record_finish(job, err)
+    if work_queue is not None:
+        work_queue.ack(job, err)
 
-# Apply the function to each row
-with concurrent.futures.ThreadPoolExecutor() as executor:
-    executor.map(process_row, [row for _, row in df.iterrows()])
-# Close the connection
-engine.dispose()
+
+def discover():
+    # Create a database engine, queue workers never connect to the database
+    engine = create_db_engine(secrets_manager, env, args.db_url)
+    row_filters = shard_filters_from_args(args)
+    if watermark is not None:
+        row_filters += [watermark.track_rows, watermark.schedule_rows]
+    try:
+        condition = query_condition(watermark, "created_at", days, engine.dialect.name)
+        row_batches = stream_row_batches(engine, query.format(condition), ("created_at", "content_id"))
+        yield from discover_jobs(row_batches, 'project_id', 'content_id', row_filters)
+    finally:
+        # Close the connection
+        engine.dispose()
+
+
+work_queue = work_queue_from_args(args, "preseeded")
+# Incremental runs only query the rows past the mark of the previous run
+watermark = watermark_from_args(args, "preseeded", "created_at", "id")
+pipeline = Pipeline([Stage("publish", publish_preseeded_index, args.publish_workers)],
+                    on_finish=functools.partial(finish_job, work_queue, watermark))
+run_jobs(args, work_queue, discover, pipeline.run)
+if watermark is not None:
+    watermark.advance()
+    watermark.close()
+if work_queue is not None:
+    work_queue.close()
+metrics.close()
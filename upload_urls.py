@@ -1,43 +1,51 @@
 import argparse
-import concurrent
-import json
+import functools
+
+from utils import aws, metrics, render_slots, source_cache
+from utils.admission import add_admission_arguments, admission_from_args, job_footprint
+from utils.db import add_db_arguments, create_db_engine, stream_row_batches
+from utils.dedup import add_dedup_arguments, deduplicator_from_args, run_deduplicated, source_url_identity
+from utils.filmstrip import (add_render_arguments, render_options_from_args, FILMSTRIP_TILE_WIDTH, NUM_PARALLEL_UPLOADS,
+                             RENDER_ENGINE_NUMPY)
+from utils.journal import add_journal_arguments, journal_from_args
+from utils.media_processor import (DOWNLOAD_PROFILE_FULL, DOWNLOAD_PROFILES, ImportSourceType, MediaProcessor,
+                                   url_content_length)
+from utils.pipeline import add_pipeline_arguments, discover_jobs, filmstrip_pipeline
+from utils.s3_index import CompletedFilmstripIndex
+from utils.watermark import add_watermark_arguments, query_condition, watermark_from_args
+from utils.work_queue import add_work_queue_arguments, run_jobs, shard_filters_from_args, work_queue_from_args
+
+
+def fetch_media(mediastore_endpoint, ves_token, download_profile, min_width, job):
+    processor = MediaProcessor(
+        project_id=job.project_id,
+        content_id=job.content_id,
+        media_type='VIDEO',
+        mediastore_endpoint=mediastore_endpoint,
+        ves_token=ves_token,
+        import_url=job.row['import_url'],
+        import_source_type=job.row['import_source_type'],
+        download_profile=download_profile,
+        min_width=min_width,
+    )
+    job.input_file = processor.process_media()
 
-import pandas as pd
-from sqlalchemy import create_engine
-import boto3
 
-from utils.cleanup import cleanup_directory
-from utils.filmstrip import generate_filmstrip, upload_filmstrip_to_s3, check_file_in_s3, STATIC_ASSETS_BUCKET, \
-    S3_KEY_BASE_PATH, FILMSTRIP_INDEX_FILE
-from utils.media_processor import MediaProcessor
+def source_identity(job):
+    # The same video imported into several projects, possibly through different links of it
+    return source_url_identity(job.row['import_url'])
 
 
-def process_row(row):
-    project_id = row['project_id']
-    content_id = row['content_id']
-    if not check_file_in_s3(STATIC_ASSETS_BUCKET,
-                            S3_KEY_BASE_PATH.format(project_id, content_id, FILMSTRIP_INDEX_FILE)):
-        try:
-            processor = MediaProcessor(
-                project_id=row['project_id'],
-                content_id=row['content_id'],
-                media_type='VIDEO',
-                mediastore_endpoint=mediastore_endpoint,
-                ves_token=VES_TOKEN,
-                import_url=row['import_url'],
-                import_source_type=row['import_source_type'],
-            )
-            input_file = processor.process_media()
-            generate_filmstrip(input_file, project_id, content_id)
-            upload_filmstrip_to_s3(project_id, content_id)
-        except Exception as ex:
-            print(f"Exception: {ex}")
-        finally:
-            cleanup_directory(project_id, content_id)
+def estimate_import(sheets_on_disk, job):
+    size = None
+    # Only direct links to a file answer a HEAD request with the size of the video
+    if ImportSourceType(job.row['import_source_type']) in (ImportSourceType.HOSTED_URL, ImportSourceType.ZOOM):
+        size = url_content_length(job.row['import_url'])
+    return job_footprint(size, sheets_on_disk=sheets_on_disk)
 
 
 if __name__ == "__main__":
-    secrets_manager = boto3.client("secretsmanager")
+    secrets_manager = aws.secrets_manager_client()
 
     VES_TOKEN = secrets_manager.get_secret_value(
         SecretId="prod/content-lab-credentials"
@@ -49,68 +57,96 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--env", type=str, default="prod")
     parser.add_argument("--days", type=str, default="7")
-    parser.add_argument("--max_worker", type=int, default=2)
+    add_db_arguments(parser)
+    # Number of index files to read and validate on top of the bulk listing
+    parser.add_argument("--deep_verify", type=int, default=0)
+    # --download_profile filmstrip downloads the smallest video-only format at least --download_min_width pixels wide
+    parser.add_argument("--download_profile", type=str, default=DOWNLOAD_PROFILE_FULL, choices=DOWNLOAD_PROFILES)
+    parser.add_argument("--download_min_width", type=int, default=FILMSTRIP_TILE_WIDTH)
+    add_render_arguments(parser)
+    render_slots.add_render_slot_arguments(parser)
+    # Number of concurrent yt-dlp downloads, kept as an alias of --fetch_workers
+    parser.add_argument("--max_worker", type=int, dest="fetch_workers", default=argparse.SUPPRESS)
+    add_journal_arguments(parser)
+    add_pipeline_arguments(parser, fetch_workers=2)
+    add_admission_arguments(parser)
+    add_work_queue_arguments(parser)
+    add_watermark_arguments(parser)
+    add_dedup_arguments(parser)
+    source_cache.add_source_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
     args = parser.parse_args()
+    metrics.configure(args.metrics_jsonl, args.metrics_prom)
+    # Downloaded sources are kept across runs, a re-run links them from the local disk instead of downloading them
+    source_cache.configure(args.source_cache, args.source_cache_gb)
+    # At most --render_slots ffmpeg processes run at once, each with --ffmpeg_threads threads
+    render_slots.configure(args.render_slots, args.ffmpeg_threads, args.ffmpeg_nice, args.pin_ffmpeg)
+    # Every publish worker uploads up to NUM_PARALLEL_UPLOADS tiles at once through the shared S3 client
+    aws.configure(max_pool_connections=args.fetch_workers + args.publish_workers * NUM_PARALLEL_UPLOADS)
     env = args.env
     days = args.days
-    max_worker = args.max_worker
-    db_username = None
-    db_password = None
-    db_host = None
-    db_port = None
-    db_name = None
-
-    if env == "prod":
-        prod_creds = secrets_manager.get_secret_value(
-        SecretId="prod/content-lab-db/readonly"
-        )["SecretString"]
-        db = json.loads(prod_creds)
-        db_username = db["USER"]
-        db_password = db["PASSWORD"]
-        db_host = db["HOST"]
-        db_port = db["PORT"]
-        db_name = db["NAME"]
-
-    else:
-        alpha_creds = secrets_manager.get_secret_value(
-            SecretId="alpha-content-lab-db/readonly"
-    )["SecretString"]
-        db = json.loads(alpha_creds)
-        db_username = db["USER"]
-        db_password = db["PASSWORD"]
-        db_host = db["HOST"]
-        db_port = db["PORT"]
-        db_name = db["NAME"]
-
-    # Ensure that all necessary environment variables are set
-    if not all([db_username, db_password, db_host, db_port, db_name]):
-        raise ValueError("One or more environment variables are missing. Please set DB_USERNAME, DB_PASSWORD, DB_HOST, "
-                         "DB_PORT, and DB_NAME.")
-
-    # Create a connection string for PostgreSQL
-    connection_string = f'postgresql://{db_username}:{db_password}@{db_host}:{db_port}/{db_name}'
-
-    # Create a database engine
-    engine = create_engine(connection_string)
+    render_options = render_options_from_args(args)
 
     # Define the SQL query to read data from the content_upload table
-    query = ("select id as content_id, project_id, import_source_type, import_url from content_upload WHERE created_at >= "
-             "NOW() - INTERVAL '{}"
-             "days' and deleted is null and av_type='VIDEO' and import_source_type is not null and import_url is not null")
-
-    # Read the data into a pandas DataFrame
-    df = pd.read_sql(query.format(days), engine)
-
-    # Display the first few rows of the DataFrame
-    print("Data from content_upload table:")
-    print(df.head())
-
-    # Count the number of rows
-    num_rows = df.shape[0]
-    print("Number of rows:", num_rows)
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        executor.map(process_row, [row for _, row in df.iterrows()])
-
-    # Close the connection
-    engine.dispose()
\ No newline at end of file
+    query = ("select id as content_id, project_id, import_source_type, import_url, created_at from content_upload "
+             "WHERE {} and deleted is null and av_type='VIDEO' and import_source_type is not null and import_url is not "
+             "null")
+
+    # Rows finished by a previous run are skipped from the journal without any S3 call, everything that already
+    # has a filmstrip in S3 is skipped before any work is scheduled
+    journal = journal_from_args(args, "upload_urls")
+    completed_filmstrips = CompletedFilmstripIndex(
+        deep_verify_sample=args.deep_verify,
+        on_completed=journal.mark_uploaded if journal is not None else None,
+    )
+    # Incremental runs only query the rows past the mark of the previous run, the mark advances past the rows
+    # that were published or found completed
+    watermark = watermark_from_args(args, "upload_urls", "created_at", "id", journal)
+    # Rows of other shards are dropped before anything probes S3 or writes to the journal
+    row_filters = shard_filters_from_args(args)
+    if watermark is not None:
+        row_filters.append(watermark.track_rows)
+    if journal is not None:
+        row_filters.append(journal.filter_rows)
+    row_filters.append(completed_filmstrips.filter_rows)
+    if watermark is not None:
+        row_filters.append(watermark.schedule_rows)
+
+    def discover():
+        # Create a database engine, queue workers never connect to the database
+        engine = create_db_engine(secrets_manager, env, args.db_url)
+        try:
+            # Stream the rows into the pipeline as they are read
+            condition = query_condition(watermark, "created_at", days, engine.dialect.name)
+            row_batches = stream_row_batches(engine, query.format(condition), ("created_at", "content_id"))
+            yield from discover_jobs(row_batches, 'project_id', 'content_id', row_filters)
+        finally:
+            # Close the connection
+            engine.dispose()
+
+    work_queue = work_queue_from_args(args, "upload_urls")
+    fetch = functools.partial(fetch_media, mediastore_endpoint, VES_TOKEN, args.download_profile,
+                              args.download_min_width)
+    # Jobs start only while their estimated scratch disk and memory fit in the budgets
+    admission = admission_from_args(
+        args, functools.partial(estimate_import, args.render_engine != RENDER_ENGINE_NUMPY))
+    # Every linked video is downloaded and rendered once, the filmstrip is copied to the other contents importing it
+    deduplicator = deduplicator_from_args(args, source_identity)
+    pipeline = filmstrip_pipeline(fetch, render_options, args, journal, admission, work_queue, watermark,
+                                  deduplicator)
+    run_jobs(args, work_queue, discover, run_deduplicated(pipeline.run, deduplicator))
+    print(f"Admission summary: {admission.summary()}")
+    if source_cache.get_cache() is not None:
+        print(f"Source cache summary: {source_cache.summary()}")
+    if deduplicator is not None:
+        print(f"Deduplication summary: {deduplicator.summary()}")
+    # Advanced before the journal is closed, the failures recorded in it hold the mark back
+    if watermark is not None:
+        watermark.advance()
+        watermark.close()
+    if journal is not None:
+        journal.close()
+    if work_queue is not None:
+        work_queue.close()
+    source_cache.close()
+    metrics.close()
@@ -1,41 +1,54 @@
 import argparse
-import concurrent
-import json
+import functools
+
+from utils import aws, metrics, render_slots, source_cache
+from utils.admission import add_admission_arguments, admission_from_args, job_footprint
+from utils.db import add_db_arguments, create_db_engine, stream_row_batches
+from utils.dedup import add_dedup_arguments, deduplicator_from_args, run_deduplicated
+from utils.filmstrip import add_render_arguments, render_options_from_args, NUM_PARALLEL_UPLOADS, RENDER_ENGINE_NUMPY
+from utils.journal import add_journal_arguments, journal_from_args
+from utils.media_processor import MediaProcessor, s3_object_head, s3_object_identity, s3_video_file_key
+from utils.pipeline import add_pipeline_arguments, discover_jobs, filmstrip_pipeline
+from utils.s3_index import CompletedFilmstripIndex
+from utils.watermark import add_watermark_arguments, query_condition, watermark_from_args
+from utils.work_queue import add_work_queue_arguments, run_jobs, shard_filters_from_args, work_queue_from_args
+
+
+def fetch_media(mediastore_endpoint, ves_token, stream_source, job):
+    processor = MediaProcessor(
+        project_id=job.project_id,
+        content_id=job.content_id,
+        media_type='VIDEO',
+        mediastore_endpoint=mediastore_endpoint,
+        ves_token=ves_token,
+        stream_source=stream_source,
+        source_head=job.source_head,
+    )
+    job.input_file = processor.process_media()
 
-import pandas as pd
-from sqlalchemy import create_engine
-import boto3
 
-from utils.cleanup import cleanup_directory
-from utils.filmstrip import generate_filmstrip, upload_filmstrip_to_s3, check_file_in_s3, STATIC_ASSETS_BUCKET, \
-    S3_KEY_BASE_PATH, FILMSTRIP_INDEX_FILE
-from utils.media_processor import MediaProcessor
+def source_head(job):
+    # One HEAD request per upload by the deduplication or the admission, whichever comes first, the fetch reuses it
+    # for the source cache key
+    if job.source_head is None:
+        job.source_head = s3_object_head(s3_video_file_key.format(project_id=job.project_id,
+                                                                  content_id=job.content_id))
+    return job.source_head
 
 
-def process_row(row):
-    project_id = row['project_id']
-    content_id = row['content_id']
-    s3_index_key = S3_KEY_BASE_PATH.format(project_id, content_id, FILMSTRIP_INDEX_FILE)
-    if not check_file_in_s3(STATIC_ASSETS_BUCKET, s3_index_key):
-        try:
-            processor = MediaProcessor(
-                project_id=project_id,
-                content_id=content_id,
-                media_type='VIDEO',
-                mediastore_endpoint=mediastore_endpoint,
-                ves_token=VES_TOKEN,
-            )
-            input_file = processor.process_media()
-            generate_filmstrip(input_file, project_id, content_id)
-            upload_filmstrip_to_s3(project_id, content_id)
-        except Exception as ex:
-            print(f"Exception: {ex}")
-        finally:
-            cleanup_directory(project_id, content_id)
+def source_identity(job):
+    # Uploads of the same file share the ETag and size of the S3 object
+    return s3_object_identity(None, source_head(job))
+
+
+def estimate_media(sheets_on_disk, job):
+    _, size = source_head(job)
+    # Streamed sources are still downloaded when the MP4 is not fast-start, so they are counted on disk
+    return job_footprint(size, sheets_on_disk=sheets_on_disk)
 
 
 if __name__ == "__main__":
-    secrets_manager = boto3.client("secretsmanager")
+    secrets_manager = aws.secrets_manager_client()
 
     VES_TOKEN = secrets_manager.get_secret_value(
         SecretId="prod/content-lab-credentials"
@@ -47,62 +60,91 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--env", type=str, default="prod")
     parser.add_argument("--days", type=str, default="7")
+    add_db_arguments(parser)
+    parser.add_argument("--stream_source", action="store_true")
+    # Number of index files to read and validate on top of the bulk listing
+    parser.add_argument("--deep_verify", type=int, default=0)
+    add_render_arguments(parser)
+    render_slots.add_render_slot_arguments(parser)
+    add_journal_arguments(parser)
+    add_pipeline_arguments(parser)
+    add_admission_arguments(parser)
+    add_work_queue_arguments(parser)
+    add_watermark_arguments(parser)
+    add_dedup_arguments(parser)
+    source_cache.add_source_cache_arguments(parser)
+    metrics.add_metrics_arguments(parser)
     args = parser.parse_args()
+    metrics.configure(args.metrics_jsonl, args.metrics_prom)
+    # Downloaded sources are kept across runs, a re-run links them from the local disk instead of downloading them
+    source_cache.configure(args.source_cache, args.source_cache_gb)
+    # At most --render_slots ffmpeg processes run at once, each with --ffmpeg_threads threads
+    render_slots.configure(args.render_slots, args.ffmpeg_threads, args.ffmpeg_nice, args.pin_ffmpeg)
+    # Every publish worker uploads up to NUM_PARALLEL_UPLOADS tiles at once through the shared S3 client
+    aws.configure(max_pool_connections=args.admission_workers + args.fetch_workers
+                  + args.publish_workers * NUM_PARALLEL_UPLOADS)
     env = args.env
     days = args.days
-    db_username = None
-    db_password = None
-    db_host = None
-    db_port = None
-    db_name = None
-
-    if env == "prod":
-        prod_creds = secrets_manager.get_secret_value(
-        SecretId="prod/content-lab-db/readonly"
-        )["SecretString"]
-        db = json.loads(prod_creds)
-        db_username = db["USER"]
-        db_password = db["PASSWORD"]
-        db_host = db["HOST"]
-        db_port = db["PORT"]
-        db_name = db["NAME"]
-
-    else:
-        alpha_creds = secrets_manager.get_secret_value(
-            SecretId="alpha-content-lab-db/readonly"
-    )["SecretString"]
-        db = json.loads(alpha_creds)
-        db_username = db["USER"]
-        db_password = db["PASSWORD"]
-        db_host = db["HOST"]
-        db_port = db["PORT"]
-        db_name = db["NAME"]
-
-    # Ensure that all necessary environment variables are set
-    if not all([db_username, db_password, db_host, db_port, db_name]):
-        raise ValueError("One or more environment variables are missing. Please set DB_USERNAME, DB_PASSWORD, DB_HOST, "
-                         "DB_PORT, and DB_NAME.")
-
-    # Create a connection string for PostgreSQL
-    connection_string = f'postgresql://{db_username}:{db_password}@{db_host}:{db_port}/{db_name}'
-
-    # Create a database engine
-    engine = create_engine(connection_string)
+    render_options = render_options_from_args(args)
 
     # Define the SQL query to read data from the content_upload table
-    query = ("select id as content_id, project_id from content_upload WHERE created_at >= NOW() - INTERVAL '{} "
-             "days' and deleted is null and av_type='VIDEO' and import_source_type is null and import_url is null and "
-             "is_sample_upload='false'")
-
-    # Read the data into a pandas DataFrame
-    df = pd.read_sql(query.format(days), engine)
-
-    # Display the first few rows of the DataFrame
-    print("Data from content_upload table:")
-    print(df.head())
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        executor.map(process_row, [row for _, row in df.iterrows()])
-
-    # Close the connection
-    engine.dispose()
+    query = ("select id as content_id, project_id, created_at from content_upload WHERE {} and deleted is null and "
+             "av_type='VIDEO' and import_source_type is null and import_url is null and is_sample_upload='false'")
+
+    # Rows finished by a previous run are skipped from the journal without any S3 call, everything that already
+    # has a filmstrip in S3 is skipped before any work is scheduled
+    journal = journal_from_args(args, "uploads")
+    completed_filmstrips = CompletedFilmstripIndex(
+        deep_verify_sample=args.deep_verify,
+        on_completed=journal.mark_uploaded if journal is not None else None,
+    )
+    # Incremental runs only query the rows past the mark of the previous run, the mark advances past the rows
+    # that were published or found completed
+    watermark = watermark_from_args(args, "uploads", "created_at", "id", journal)
+    # Rows of other shards are dropped before anything probes S3 or writes to the journal
+    row_filters = shard_filters_from_args(args)
+    if watermark is not None:
+        row_filters.append(watermark.track_rows)
+    if journal is not None:
+        row_filters.append(journal.filter_rows)
+    row_filters.append(completed_filmstrips.filter_rows)
+    if watermark is not None:
+        row_filters.append(watermark.schedule_rows)
+
+    def discover():
+        # Create a database engine, queue workers never connect to the database
+        engine = create_db_engine(secrets_manager, env, args.db_url)
+        try:
+            # Stream the rows into the pipeline as they are read
+            condition = query_condition(watermark, "created_at", days, engine.dialect.name)
+            row_batches = stream_row_batches(engine, query.format(condition), ("created_at", "content_id"))
+            yield from discover_jobs(row_batches, 'project_id', 'content_id', row_filters)
+        finally:
+            # Close the connection
+            engine.dispose()
+
+    work_queue = work_queue_from_args(args, "uploads")
+    fetch = functools.partial(fetch_media, mediastore_endpoint, VES_TOKEN, args.stream_source)
+    # Jobs start only while their estimated scratch disk and memory fit in the budgets
+    admission = admission_from_args(
+        args, functools.partial(estimate_media, args.render_engine != RENDER_ENGINE_NUMPY))
+    # Every source file is rendered once, the filmstrip is copied to the other contents uploading the same file
+    deduplicator = deduplicator_from_args(args, source_identity)
+    pipeline = filmstrip_pipeline(fetch, render_options, args, journal, admission, work_queue, watermark,
+                                  deduplicator)
+    run_jobs(args, work_queue, discover, run_deduplicated(pipeline.run, deduplicator))
+    print(f"Admission summary: {admission.summary()}")
+    if source_cache.get_cache() is not None:
+        print(f"Source cache summary: {source_cache.summary()}")
+    if deduplicator is not None:
+        print(f"Deduplication summary: {deduplicator.summary()}")
+    # Advanced before the journal is closed, the failures recorded in it hold the mark back
+    if watermark is not None:
+        watermark.advance()
+        watermark.close()
+    if journal is not None:
+        journal.close()
+    if work_queue is not None:
+        work_queue.close()
+    source_cache.close()
+    metrics.close()
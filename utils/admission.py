@@ -0,0 +1,200 @@
+import logging
+import os
+import shutil
+import threading
+
+from utils import source_cache
+from utils.filmstrip import OUTPUT_DIRECTORY
+
+logger = logging.getLogger(__name__)
+MB = 1024 * 1024
+# Size assumed for sources whose size can't be found out before the download
+DEFAULT_SOURCE_BYTES = 2048 * MB
+# Memory of one ffmpeg decode and the sheets it tiles, on top of the source when the source is held in memory
+RENDER_MEMORY_BYTES = 512 * MB
+# The WebP sheets are a small fraction of the source
+SHEET_BYTES_RATIO = 0.05
+# Share of the free disk space and available memory used when no budget is given
+BUDGET_FRACTION = 0.8
+DEFAULT_TMPFS_MAX_JOB_MB = 512
+DEFAULT_ADMISSION_WORKERS = 4
+DOWNLOADS_DIRECTORY = os.path.dirname(os.path.dirname(OUTPUT_DIRECTORY))
+
+
+def job_footprint(source_bytes, source_on_disk=True, sheets_on_disk=True):
+    """
+    Estimate the scratch disk and memory a job needs while it runs.
+
+    :param source_bytes: Size of the source in bytes, None when it is not known.
+    :param source_on_disk: False when the source is streamed into ffmpeg instead of downloaded.
+    :param sheets_on_disk: False when the sheets are rendered in memory.
+    :return: Dictionary with the disk and memory bytes.
+    """
+    if source_bytes is None:
+        source_bytes = DEFAULT_SOURCE_BYTES
+    sheet_bytes = int(source_bytes * SHEET_BYTES_RATIO)
+    disk = (source_bytes if source_on_disk else 0) + (sheet_bytes if sheets_on_disk else 0)
+    memory = RENDER_MEMORY_BYTES + (0 if sheets_on_disk else sheet_bytes)
+    return {"disk": disk, "memory": memory}
+
+
+def available_memory_bytes():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+class AdmissionController:
+    """
+    Starts a job only while the footprints of all running jobs, plus its own, stay within the disk and memory
+    budgets. A job larger than a whole budget still runs, alone. Small jobs can get their scratch directory on tmpfs,
+    where it counts against the memory budget instead of the disk budget.
+    """
+
+    def __init__(self, estimate, disk_budget, memory_budget, tmpfs_directory=None,
+                 tmpfs_max_job_bytes=DEFAULT_TMPFS_MAX_JOB_MB * MB):
+        """
+        :param estimate: Called with a job before it is admitted, returns the footprint from job_footprint.
+        :param disk_budget: Bytes of scratch disk the running jobs may use together.
+        :param memory_budget: Bytes of memory the running jobs may use together.
+        :param tmpfs_directory: Directory on a tmpfs for the scratch of small jobs, None to keep everything on disk.
+        :param tmpfs_max_job_bytes: Largest disk footprint of a job placed on tmpfs.
+        """
+        self.estimate = estimate
+        self.disk_budget = disk_budget
+        self.memory_budget = memory_budget
+        self.tmpfs_directory = tmpfs_directory
+        self.tmpfs_max_job_bytes = tmpfs_max_job_bytes
+        self.condition = threading.Condition()
+        self.reserved = {}
+        self.disk_used = 0
+        self.memory_used = 0
+        self.peak_disk = 0
+        self.peak_memory = 0
+        self.waits = 0
+        self.tmpfs_jobs = 0
+
+    def admit(self, job):
+        """
+        Estimate the footprint of the job and block until the budgets have room for it.
+        """
+        try:
+            footprint = self.estimate(job)
+        except Exception as err:
+            logger.exception(f"Could not estimate the size of {job}, assuming {DEFAULT_SOURCE_BYTES // MB} MB: {err}")
+            footprint = job_footprint(None)
+        on_tmpfs = self._reserve(job, footprint, allow_tmpfs=True)
+        if on_tmpfs and not self._place_on_tmpfs(job):
+            # The scratch directory already exists on disk, the job waits for room in the disk budget instead
+            self.release(job)
+            self._reserve(job, footprint, allow_tmpfs=False)
+        elif on_tmpfs:
+            with self.condition:
+                self.tmpfs_jobs += 1
+
+    def _reserve(self, job, footprint, allow_tmpfs):
+        """
+        Block until the budgets have room for the footprint and reserve it for the job.
+
+        :return: True when the scratch of the job was reserved on tmpfs.
+        """
+        waited = False
+        with self.condition:
+            while True:
+                reservation = self._reservation(footprint, allow_tmpfs)
+                if reservation is not None:
+                    break
+                waited = True
+                self.condition.wait()
+            if waited:
+                self.waits += 1
+            disk, memory, on_tmpfs = reservation
+            self.reserved[(job.project_id, job.content_id)] = (disk, memory)
+            self.disk_used += disk
+            self.memory_used += memory
+            self.peak_disk = max(self.peak_disk, self.disk_used)
+            self.peak_memory = max(self.peak_memory, self.memory_used)
+        return on_tmpfs
+
+    def _reservation(self, footprint, allow_tmpfs):
+        disk, memory = footprint["disk"], footprint["memory"]
+        if (allow_tmpfs and self.tmpfs_directory and disk <= self.tmpfs_max_job_bytes
+                and self.memory_used + memory + disk <= self.memory_budget):
+            return 0, memory + disk, True
+        if self.disk_used + disk <= self.disk_budget and self.memory_used + memory <= self.memory_budget:
+            return disk, memory, False
+        if not self.reserved:
+            return disk, memory, False
+        return None
+
+    def _place_on_tmpfs(self, job):
+        scratch_directory = OUTPUT_DIRECTORY.format(job.project_id, job.content_id)
+        if os.path.lexists(scratch_directory):
+            return False
+        tmpfs_scratch_directory = os.path.join(self.tmpfs_directory, str(job.project_id), str(job.content_id))
+        os.makedirs(tmpfs_scratch_directory, exist_ok=True)
+        os.makedirs(os.path.dirname(scratch_directory), exist_ok=True)
+        # Everything keeps writing to downloads/, the link sends the files of this job to tmpfs
+        os.symlink(os.path.abspath(tmpfs_scratch_directory), scratch_directory)
+        return True
+
+    def release(self, job):
+        with self.condition:
+            disk, memory = self.reserved.pop((job.project_id, job.content_id), (0, 0))
+            self.disk_used -= disk
+            self.memory_used -= memory
+            self.condition.notify_all()
+
+    def summary(self):
+        return {
+            "disk_budget_mb": round(self.disk_budget / MB),
+            "memory_budget_mb": round(self.memory_budget / MB),
+            "peak_disk_mb": round(self.peak_disk / MB),
+            "peak_memory_mb": round(self.peak_memory / MB),
+            "jobs_waited": self.waits,
+            "jobs_on_tmpfs": self.tmpfs_jobs,
+        }
+
+
+def add_admission_arguments(parser):
+    # Budgets default to BUDGET_FRACTION of the free space of downloads/ and of the available memory
+    parser.add_argument("--disk_budget_mb", type=int, default=None)
+    parser.add_argument("--memory_budget_mb", type=int, default=None)
+    # Scratch of jobs up to --tmpfs_max_job_mb goes to this directory, e.g. /dev/shm/filmstrip
+    parser.add_argument("--tmpfs_dir", type=str, default=None)
+    parser.add_argument("--tmpfs_max_job_mb", type=int, default=DEFAULT_TMPFS_MAX_JOB_MB)
+    parser.add_argument("--admission_workers", type=int, default=DEFAULT_ADMISSION_WORKERS)
+
+
+def source_cache_reserve_bytes():
+    """
+    :return: Bytes the source cache can still grow by on the filesystem of downloads/, 0 without a cache or when it
+        is on another filesystem.
+    """
+    cache = source_cache.get_cache()
+    if cache is None or os.stat(cache.directory).st_dev != os.stat(DOWNLOADS_DIRECTORY).st_dev:
+        return 0
+    return max(0, cache.max_bytes - cache.size())
+
+
+def admission_from_args(args, estimate):
+    if args.disk_budget_mb is not None:
+        disk_budget = args.disk_budget_mb * MB
+    else:
+        os.makedirs(DOWNLOADS_DIRECTORY, exist_ok=True)
+        # A cached source keeps its space once the job that downloaded it cleaned up, up to the cap of the cache
+        free = shutil.disk_usage(DOWNLOADS_DIRECTORY).free - source_cache_reserve_bytes()
+        disk_budget = int(max(0, free) * BUDGET_FRACTION)
+    if args.memory_budget_mb is not None:
+        memory_budget = args.memory_budget_mb * MB
+    else:
+        memory_budget = int(available_memory_bytes() * BUDGET_FRACTION)
+    admission = AdmissionController(estimate, disk_budget, memory_budget, args.tmpfs_dir,
+                                    args.tmpfs_max_job_mb * MB)
+    print(f"Admission budgets: {admission.summary()}")
+    return admission
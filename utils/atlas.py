@@ -0,0 +1,84 @@
+import struct
+
+ATLAS_FORMAT = "atlas"
+ATLAS_VERSION = 1
+ATLAS_CONTENT_TYPE = "application/octet-stream"
+SHEET_CONTENT_TYPE = "image/webp"
+
+
+def webp_dimensions(data):
+    """
+    Read the width and height of a WebP image from its header, for lossy, lossless and extended files.
+
+    :return: Tuple of the width and height in pixels.
+    """
+    if len(data) < 30 or data[:4] != b"RIFF" or data[8:12] != b"WEBP":
+        raise ValueError("Not a WebP image")
+    chunk = data[12:16]
+    if chunk == b"VP8X":
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+    elif chunk == b"VP8 ":
+        width, height = struct.unpack("<HH", data[26:30])
+        width &= 0x3fff
+        height &= 0x3fff
+    elif chunk == b"VP8L":
+        bits = int.from_bytes(data[21:25], "little")
+        width = (bits & 0x3fff) + 1
+        height = ((bits >> 14) & 0x3fff) + 1
+    else:
+        raise ValueError(f"Unknown WebP chunk {chunk!r}")
+    return width, height
+
+
+def pack_atlas(sheets, chunk_key, chunk_bytes, columns, rows, fps):
+    """
+    Pack the WebP sheets of a filmstrip into one object, or into chunks of up to chunk_bytes, with an index giving
+    the byte range, size and time range of every sheet, so clients fetch a sheet with one HTTP range request. A sheet
+    is never split over two chunks.
+
+    :param chunk_key: Function returning the S3 key of the chunk with the given number, numbered from 1.
+    :param chunk_bytes: Maximum size of a chunk, 0 to pack every sheet into a single object.
+    :return: Tuple of the list of (key, bytes) of the chunks and the index.
+    """
+    sheet_seconds = columns * rows / fps
+    chunks = []
+    index_sheets = []
+    current = []
+    current_size = 0
+    for sheet_number, sheet in enumerate(sheets):
+        if current and chunk_bytes and current_size + len(sheet) > chunk_bytes:
+            chunks.append(b"".join(current))
+            current = []
+            current_size = 0
+        width, height = webp_dimensions(sheet)
+        index_sheets.append({
+            "chunk": len(chunks),
+            "offset": current_size,
+            "length": len(sheet),
+            "width": width,
+            "height": height,
+            "start_time": sheet_number * sheet_seconds,
+            "end_time": (sheet_number + 1) * sheet_seconds,
+        })
+        current.append(sheet)
+        current_size += len(sheet)
+    if current:
+        chunks.append(b"".join(current))
+    chunk_keys = [chunk_key(chunk_number) for chunk_number in range(1, len(chunks) + 1)]
+    index = {
+        "format": ATLAS_FORMAT,
+        "version": ATLAS_VERSION,
+        "content_type": SHEET_CONTENT_TYPE,
+        "fps": fps,
+        "columns": columns,
+        "rows": rows,
+        "sheet_seconds": sheet_seconds,
+        "chunks": chunk_keys,
+        "sheets": index_sheets,
+    }
+    return list(zip(chunk_keys, chunks)), index
+
+
+def is_atlas_index(index):
+    return index.get("format") == ATLAS_FORMAT
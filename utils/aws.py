@@ -0,0 +1,109 @@
+import os
+import threading
+
+import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
+
+# Matches the default number of workers of ThreadPoolExecutor
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+DEFAULT_RETRY_MODE = "standard"
+DEFAULT_MAX_ATTEMPTS = 5
+# Largest object S3 takes in a single PUT. The transfer manager uploads everything up to it in one part, so the ETag
+# of every filmstrip object is its MD5 and interrupted uploads are skipped by comparing the two
+SINGLE_PUT_MAX_BYTES = 5 * 1024 ** 3
+# Set to point S3 at a local stand-in, e.g. for benchmarks
+S3_ENDPOINT_URL_ENV = "AWS_ENDPOINT_URL_S3"
+
+_lock = threading.Lock()
+_settings = {
+    "max_pool_connections": DEFAULT_MAX_POOL_CONNECTIONS,
+    "retry_mode": DEFAULT_RETRY_MODE,
+    "max_attempts": DEFAULT_MAX_ATTEMPTS,
+}
+_pid = None
+_session = None
+_clients = {}
+_transfer_manager = None
+
+
+def configure(max_pool_connections=None, retry_mode=None, max_attempts=None):
+    """
+    Configure the clients shared by this process, clients created before are dropped.
+
+    :param max_pool_connections: HTTP connections kept per client, size it to the number of threads using it.
+    :param retry_mode: botocore retry mode, "standard" or "adaptive".
+    :param max_attempts: Maximum attempts of a request including retries.
+    """
+    global _transfer_manager
+    with _lock:
+        if max_pool_connections is not None:
+            _settings["max_pool_connections"] = max_pool_connections
+        if retry_mode is not None:
+            _settings["retry_mode"] = retry_mode
+        if max_attempts is not None:
+            _settings["max_attempts"] = max_attempts
+        _clients.clear()
+        _transfer_manager = None
+
+
+def client_config():
+    config = Config(
+        max_pool_connections=_settings["max_pool_connections"],
+        # botocore's max_attempts counts the retries only, total_max_attempts includes the first attempt
+        retries={"mode": _settings["retry_mode"], "total_max_attempts": _settings["max_attempts"]},
+        tcp_keepalive=True,
+    )
+    if os.environ.get(S3_ENDPOINT_URL_ENV):
+        # Local stand-ins only understand path style requests
+        config = config.merge(Config(s3={"addressing_style": "path"}))
+    return config
+
+
+def get_session():
+    global _pid, _session, _transfer_manager
+    with _lock:
+        # Sessions and clients are not shared with forked child processes
+        if _pid != os.getpid():
+            _pid = os.getpid()
+            _session = boto3.session.Session()
+            _clients.clear()
+            _transfer_manager = None
+        return _session
+
+
+def get_client(service_name):
+    """
+    Return the client of a service shared by every thread of this process. botocore clients are thread safe,
+    sharing them avoids resolving credentials and opening new TLS connections for every call.
+    """
+    session = get_session()
+    with _lock:
+        if service_name not in _clients:
+            endpoint_url = os.environ.get(S3_ENDPOINT_URL_ENV) if service_name == "s3" else None
+            _clients[service_name] = session.client(service_name, endpoint_url=endpoint_url, config=client_config())
+        return _clients[service_name]
+
+
+def s3_client():
+    return get_client("s3")
+
+
+def transfer_manager():
+    """
+    Return the S3 transfer manager shared by every thread of this process. Its threads upload through the shared S3
+    client, as many at once as the client has connections.
+    """
+    global _transfer_manager
+    client = s3_client()
+    with _lock:
+        if _transfer_manager is None:
+            config = TransferConfig(max_concurrency=_settings["max_pool_connections"],
+                                    multipart_threshold=SINGLE_PUT_MAX_BYTES)
+            _transfer_manager = create_transfer_manager(client, config)
+        return _transfer_manager
+
+
+def secrets_manager_client():
+    return get_client("secretsmanager")
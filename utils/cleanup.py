@@ -23,4 +23,10 @@ def cleanup_directory(project_id, content_id):
         elif os.path.isdir(item_path):
             shutil.rmtree(item_path)
 
+    # Scratch placed on tmpfs by the admission controller is a link to a directory there, drop both
+    if os.path.islink(output_dir):
+        tmpfs_dir = os.path.realpath(output_dir)
+        os.unlink(output_dir)
+        shutil.rmtree(tmpfs_dir, ignore_errors=True)
+
     print(f"Directory {output_dir} has been cleaned up.")
\ No newline at end of file
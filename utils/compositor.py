@@ -0,0 +1,159 @@
+import io
+import subprocess
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from utils import metrics
+
+PPM_MAGIC = b"P6"
+
+
+class TileCompositor:
+    """
+    Composites frames into sheets of columns x rows tiles, in row-major order like ffmpeg's tile filter. The sheet
+    buffer is allocated once and reused, a finished sheet is encoded to WebP in memory.
+    """
+
+    def __init__(self, columns, rows, quality, method):
+        """
+        :param quality: WebP quality, 0 to 100.
+        :param method: WebP compression method, 0 (fast) to 6 (small), the compression_level of ffmpeg's libwebp.
+        """
+        self.columns = columns
+        self.rows = rows
+        self.quality = quality
+        self.method = method
+        self.sheet = None
+        self.tile_height = None
+        self.tile_width = None
+        self.tiles = 0
+
+    def add(self, frame):
+        """
+        Copy the frame into the next tile of the sheet.
+
+        :return: The encoded sheet once the frame completed it, None otherwise.
+        """
+        height, width, _ = frame.shape
+        if self.sheet is None:
+            self.tile_height, self.tile_width = height, width
+            self.sheet = np.zeros((self.rows * height, self.columns * width, 3), dtype=np.uint8)
+        elif (height, width) != (self.tile_height, self.tile_width):
+            raise ValueError(f"Frame size changed from {self.tile_width}x{self.tile_height} to {width}x{height}")
+
+        row, column = divmod(self.tiles, self.columns)
+        self.sheet[row * height:(row + 1) * height, column * width:(column + 1) * width] = frame
+        self.tiles += 1
+        if self.tiles == self.columns * self.rows:
+            return self._encode()
+        return None
+
+    def flush(self):
+        """
+        :return: The encoded last sheet with its empty tiles left black, None if it has no frames.
+        """
+        if not self.tiles:
+            return None
+        height, width = self.tile_height, self.tile_width
+        for tile in range(self.tiles, self.columns * self.rows):
+            row, column = divmod(tile, self.columns)
+            self.sheet[row * height:(row + 1) * height, column * width:(column + 1) * width] = 0
+        return self._encode()
+
+    def _encode(self):
+        self.tiles = 0
+        output = io.BytesIO()
+        Image.fromarray(self.sheet).save(output, format="WEBP", quality=self.quality, method=self.method)
+        return output.getvalue()
+
+
+def read_ppm_frame(stream, frame):
+    """
+    Read the next binary PPM image of the stream into the frame buffer, the buffer is replaced only when the image
+    size changes.
+
+    :return: The frame buffer holding the image, None at the end of the stream.
+    """
+    magic = stream.readline()
+    if not magic:
+        return None
+    if magic.strip() != PPM_MAGIC:
+        raise ValueError(f"Unexpected PPM header {magic!r}")
+    width, height = (int(value) for value in stream.readline().split())
+    stream.readline()  # Maximum value, always 255 for rgb24
+    if frame is None or frame.shape != (height, width, 3):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+    view = memoryview(frame).cast("B")
+    received = 0
+    while received < len(view):
+        size = stream.readinto(view[received:])
+        if not size:
+            raise EOFError(f"PPM image ended after {received} of {len(view)} bytes")
+        received += size
+    return frame
+
+
+def composite_sheets(cmd, columns, rows, quality, method, feed_input=None):
+    """
+    Run an ffmpeg command writing rgb24 PPM frames to stdout and composite them into WebP sheets.
+
+    :param feed_input: Optional function writing the video into the stdin of ffmpeg, it runs in its own thread.
+    :return: Tuple of the list of the encoded sheets in timeline order and the wall and CPU time of ffmpeg.
+    """
+    start_time = time.monotonic()
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE if feed_input else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE)
+    feed_errors = []
+    feeder = None
+    if feed_input is not None:
+        feeder = threading.Thread(target=_feed, args=(feed_input, process.stdin, feed_errors), daemon=True)
+        feeder.start()
+
+    compositor = TileCompositor(columns, rows, quality, method)
+    sheets = []
+    frame = None
+    try:
+        while True:
+            frame = read_ppm_frame(process.stdout, frame)
+            if frame is None:
+                break
+            sheet = compositor.add(frame)
+            if sheet is not None:
+                sheets.append(sheet)
+    except Exception:
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        returncode, usage = metrics.wait_process(process, start_time)
+        metrics.observe_process(usage)
+        if feeder is not None:
+            feeder.join()
+
+    if feed_errors:
+        raise feed_errors[0]
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    last_sheet = compositor.flush()
+    if last_sheet is not None:
+        sheets.append(last_sheet)
+    return sheets, usage
+
+
+def _feed(feed_input, stdin, feed_errors):
+    try:
+        feed_input(stdin)
+    except BrokenPipeError:
+        # ffmpeg exited early, its return code tells why
+        pass
+    except Exception as err:
+        feed_errors.append(err)
+    finally:
+        # Closed on errors as well, ffmpeg would otherwise wait for more input forever
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
@@ -0,0 +1,72 @@
+import json
+import sqlite3
+
+from sqlalchemy import create_engine, text
+
+DB_SECRET_IDS = {
+    "prod": "prod/content-lab-db/readonly",
+    "alpha": "alpha-content-lab-db/readonly",
+}
+# The first batch is small so the first job starts right after connecting, later batches grow up to the maximum
+FIRST_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 1000
+KEYSET_PAGE_QUERY = "SELECT * FROM ({query}) AS keyset_rows {condition} ORDER BY {order} LIMIT {limit}"
+
+
+def create_db_engine(secrets_manager, env, url=None):
+    """
+    :param url: Optional SQLAlchemy URL read instead of the read-only replica of env, e.g. a local fixture.
+    """
+    if url:
+        if url.startswith("sqlite"):
+            # Columns declared TIMESTAMP come back as datetimes, like they do from Postgres
+            return create_engine(url, connect_args={"detect_types": sqlite3.PARSE_DECLTYPES})
+        return create_engine(url)
+    secret_id = DB_SECRET_IDS["prod"] if env == "prod" else DB_SECRET_IDS["alpha"]
+    db = json.loads(secrets_manager.get_secret_value(SecretId=secret_id)["SecretString"])
+    db_username = db["USER"]
+    db_password = db["PASSWORD"]
+    db_host = db["HOST"]
+    db_port = db["PORT"]
+    db_name = db["NAME"]
+
+    # Ensure that all necessary environment variables are set
+    if not all([db_username, db_password, db_host, db_port, db_name]):
+        raise ValueError("One or more environment variables are missing. Please set DB_USERNAME, DB_PASSWORD, DB_HOST, "
+                         "DB_PORT, and DB_NAME.")
+
+    # Create a connection string for PostgreSQL
+    connection_string = f'postgresql://{db_username}:{db_password}@{db_host}:{db_port}/{db_name}'
+    return create_engine(connection_string)
+
+
+def add_db_arguments(parser):
+    # e.g. sqlite:///fixture.db, the end-to-end benchmark runs the queries of the scripts against a local fixture
+    parser.add_argument("--db_url", type=str, default=None, help="Database to read instead of the one of --env")
+
+
+def stream_row_batches(engine, query, key_columns, first_batch_size=FIRST_BATCH_SIZE, max_batch_size=MAX_BATCH_SIZE):
+    """
+    Page through the result of the query in the order of key_columns and yield it in batches. Every batch is read
+    with a keyset query in its own short transaction, so nothing stays open on the database while the pipeline works
+    through the rows, and only one batch is held in memory no matter how many rows the query matches.
+
+    :param key_columns: Columns of the query that identify a row and give the order, e.g. ("created_at", "content_id").
+    :return: Generator of lists of dictionaries, one per row.
+    """
+    order = ", ".join(key_columns)
+    placeholders = ", ".join(f":key_{index}" for index in range(len(key_columns)))
+    last_key = None
+    batch_size = first_batch_size
+    while True:
+        condition = f"WHERE ({order}) > ({placeholders})" if last_key is not None else ""
+        params = dict(zip((f"key_{index}" for index in range(len(key_columns))), last_key or ()))
+        page_query = KEYSET_PAGE_QUERY.format(query=query, condition=condition, order=order, limit=batch_size)
+        with engine.connect() as connection:
+            rows = [dict(row._mapping) for row in connection.execute(text(page_query), params)]
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            break
+        last_key = tuple(rows[-1][column] for column in key_columns)
+        batch_size = min(batch_size * 2, max_batch_size)
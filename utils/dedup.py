@@ -0,0 +1,180 @@
+import collections
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+YOUTUBE_HOSTS = ("youtube.com", "youtu.be", "youtube-nocookie.com")
+# Query parameters that only track where a link was shared, they don't change the video. Names are compared exactly,
+# only the utm_ parameters are matched by their prefix
+TRACKING_PARAMETERS = {"si", "feature", "fbclid", "gclid"}
+TRACKING_PARAMETER_PREFIX = "utm_"
+# Identities looked up at once ahead of the jobs handed to the pipeline, e.g. HEAD requests of uploads
+DEFAULT_IDENTITY_WORKERS = 8
+
+
+def source_url_identity(url):
+    """
+    Normalize a link so the same video imported through different links of it has one identity, e.g. youtu.be/<id>
+    and www.youtube.com/watch?v=<id>&t=10.
+    """
+    parsed = urlsplit(url.strip())
+    host = parsed.netloc.lower().rsplit("@", 1)[-1].split(":")[0]
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    query = parse_qsl(parsed.query, keep_blank_values=True)
+    if host in YOUTUBE_HOSTS:
+        video_id = dict(query).get("v")
+        path_parts = [part for part in parsed.path.split("/") if part]
+        if host == "youtu.be" and path_parts:
+            video_id = path_parts[0]
+        elif len(path_parts) == 2 and path_parts[0] in ("embed", "shorts", "live", "v"):
+            video_id = path_parts[1]
+        if video_id:
+            return f"youtube:{video_id}"
+    # Other hosts may name the video with any parameter, e.g. dl.php?t=<id>, only tracking parameters are dropped
+    query = sorted((name, value) for name, value in query
+                   if name not in TRACKING_PARAMETERS and not name.startswith(TRACKING_PARAMETER_PREFIX))
+    return f"url:{host}{parsed.path.rstrip('/')}" + (f"?{urlencode(query)}" if query else "")
+
+
+class SourceDeduplicator:
+    """
+    Groups the jobs of a run by the identity of their source, so every source is downloaded and rendered once. The
+    first job of a source goes through the pipeline, the other jobs of the source wait on it and get the published
+    filmstrip copied to their prefix. Jobs discovered once their source was published go through the pipeline with
+    fanout_source set, only their publish stage runs and copies the filmstrip.
+    """
+
+    def __init__(self, identity, identity_workers=DEFAULT_IDENTITY_WORKERS):
+        """
+        :param identity: Called with a job, returns the identity of its source, None to never deduplicate the job.
+        :param identity_workers: Threads calling identity ahead of the jobs, so slow lookups don't hold up the
+            thread feeding the pipeline.
+        """
+        self.identity = identity
+        self.identity_workers = max(1, identity_workers)
+        self.lock = threading.Lock()
+        # Identity -> job rendering the source, until it published or failed
+        self.leaders = {}
+        # Identity -> job whose published filmstrip later jobs of the source copy
+        self.published = {}
+        self.sources = 0
+        self.deduplicated = 0
+        self.copied = 0
+        self.copy_failures = 0
+
+    def filter_jobs(self, jobs):
+        """
+        Yield the jobs that go through the pipeline, the jobs of a source that is being rendered are held back as
+        followers of the job rendering it.
+        """
+        for job in self._identified_jobs(jobs):
+            if job.source_identity is None:
+                yield job
+                continue
+            with self.lock:
+                leader = self.leaders.get(job.source_identity)
+                if leader is not None:
+                    leader.followers.append(job)
+                    self.deduplicated += 1
+                    continue
+                source = self.published.get(job.source_identity)
+                if source is not None:
+                    job.fanout_source = source
+                    self.deduplicated += 1
+                else:
+                    self.leaders[job.source_identity] = job
+                    self.sources += 1
+            yield job
+
+    def _identified_jobs(self, jobs):
+        """
+        Yield the jobs in their order with job.source_identity set, looked up by the identity workers a bounded
+        number of jobs ahead.
+        """
+        with ThreadPoolExecutor(self.identity_workers, thread_name_prefix="identity") as executor:
+            lookups = collections.deque()
+            for job in jobs:
+                lookups.append(executor.submit(self._identify, job))
+                if len(lookups) >= 2 * self.identity_workers:
+                    yield lookups.popleft().result()
+            while lookups:
+                yield lookups.popleft().result()
+
+    def _identify(self, job):
+        try:
+            job.source_identity = self.identity(job)
+        except Exception as err:
+            logger.exception(f"Could not identify the source of {job}, rendering it on its own: {err}")
+            job.source_identity = None
+        return job
+
+    def close(self, job, published):
+        """
+        Stop adding followers to a job once it published its filmstrip or failed, job.followers then get its
+        filmstrip copied or fail with it. Later jobs of the source copy the published filmstrip or render it again.
+        """
+        with self.lock:
+            if self.leaders.get(job.source_identity) is job:
+                del self.leaders[job.source_identity]
+                if published:
+                    self.published[job.source_identity] = job
+
+    def record_copy(self, err):
+        with self.lock:
+            if err is None:
+                self.copied += 1
+            else:
+                self.copy_failures += 1
+        metrics.increment("fanout_copies_total", outcome="failed" if err is not None else "succeeded")
+
+    def summary(self):
+        with self.lock:
+            return {
+                "sources": self.sources,
+                "deduplicated": self.deduplicated,
+                # Every deduplicated job is one download and one render less
+                "downloads_saved": self.deduplicated,
+                "renders_saved": self.deduplicated,
+                "copied": self.copied,
+                "copy_failures": self.copy_failures,
+            }
+
+
+def unless_fanned_out(func):
+    """
+    Wrap a stage function so it skips the jobs that only get the filmstrip of another job copied.
+    """
+    @functools.wraps(func)
+    def stage_func(job):
+        if job.fanout_source is None:
+            return func(job)
+    return stage_func
+
+
+def run_deduplicated(run, deduplicator):
+    """
+    :return: Function running the jobs with run, e.g. Pipeline.run, deduplicated when a deduplicator is given.
+    """
+    if deduplicator is None:
+        return run
+    return lambda jobs: run(deduplicator.filter_jobs(jobs))
+
+
+def add_dedup_arguments(parser):
+    # Jobs with the same source are rendered once and the filmstrip is copied to the other jobs
+    parser.add_argument("--no_dedup", action="store_true")
+    parser.add_argument("--identity_workers", type=int, default=DEFAULT_IDENTITY_WORKERS)
+
+
+def deduplicator_from_args(args, identity):
+    if args.no_dedup:
+        return None
+    return SourceDeduplicator(identity, args.identity_workers)
@@ -1,86 +1,733 @@
+import hashlib
+import io
 import json
 import logging
+import math
+import multiprocessing
 import os
+import shutil
 import subprocess
-from concurrent.futures import ThreadPoolExecutor
-import boto3
-from botocore.exceptions import NoCredentialsError, ClientError
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from s3transfer.subscribers import BaseSubscriber
+
+from utils import atlas, aws, metrics, render_slots, throttle
+from utils.compositor import composite_sheets
 
 logger = logging.getLogger(__name__)
 FILMSTRIP_FPS = 2
+FILMSTRIP_TILE_WIDTH = 200
 FILMSTRIP_INDEX_FILE = "filmstrip_index.json"
 FILMSTRIP_INDEX_KEY = "filmstrip_file_names"
 S3_KEY_BASE_PATH = "content-lab/filmstrip/{}/{}/{}"
 OUTPUT_DIRECTORY = "downloads/{}/{}"
 STATIC_ASSETS_BUCKET = "staticassets.goldcast.com"
+# Uploads per publish worker the shared transfer manager is sized for, the limiter of the bucket caps all of them
 NUM_PARALLEL_UPLOADS = 5
+TILE_CONTENT_TYPE = "image/webp"
+INDEX_CONTENT_TYPE = "application/json"
+# Tiles keep their keys when a filmstrip is rendered again, so they are not cached for longer than a day
+TILE_CACHE_CONTROL = "public, max-age=86400"
+# Readers check the index to know whether a filmstrip exists, it is only cached briefly
+INDEX_CACHE_CONTROL = "public, max-age=300"
+# One WebP object per sheet, or every sheet packed into an atlas the index gives the byte range of each sheet in
+FILMSTRIP_FORMAT_TILES = "tiles"
+FILMSTRIP_FORMAT_ATLAS = atlas.ATLAS_FORMAT
+FILMSTRIP_FORMATS = (FILMSTRIP_FORMAT_TILES, FILMSTRIP_FORMAT_ATLAS)
+FILMSTRIP_ATLAS_FILE = "filmstrip_atlas_{:04d}.bin"
+FILMSTRIP_FILE_PREFIX = "filmstrip_"
+# Each 5x6 sheet holds 30 frames, i.e. 15 seconds of video at FILMSTRIP_FPS
+FILMSTRIP_COLUMNS = 5
+FILMSTRIP_ROWS = 6
+FILMSTRIP_TILES_PER_SHEET = FILMSTRIP_COLUMNS * FILMSTRIP_ROWS
+FILMSTRIP_SHEET_SECONDS = FILMSTRIP_TILES_PER_SHEET // FILMSTRIP_FPS
+# Videos are only split into shards of at least this many seconds, shorter renders are not worth the extra processes
+SHARD_MIN_SECONDS = 600
+SHARD_DIRECTORY_PREFIX = "shard_"
+# Input name of a render whose source is written into the stdin of ffmpeg
+STDIN_INPUT = "pipe:0"
 
+# "png" renders lossless PNG sheets and re-encodes each one to WebP in a separate ffmpeg process.
+# "webp" encodes the WebP sheets directly in the decode pass, so no intermediate files are written.
+RENDER_MODE_PNG = "png"
+RENDER_MODE_WEBP = "webp"
+RENDER_MODES = (RENDER_MODE_PNG, RENDER_MODE_WEBP)
 
-def generate_filmstrip(input_file, project_id, content_id):
-    output_directory = OUTPUT_DIRECTORY.format(project_id, content_id)
-    os.makedirs(output_directory, exist_ok=True)
-    # Generate multiple images with filmstrip of the complete video file where each image contains 30 frames
+# libwebp encoder settings, "default" matches ffmpeg's libwebp defaults used by convert_png_to_webp.
+# The ffmpeg engine tiles the sheets with ffmpeg's tile filter, the numpy engine reads the scaled frames from ffmpeg
+# and composites and encodes the sheets in memory
+RENDER_ENGINE_FFMPEG = "ffmpeg"
+RENDER_ENGINE_NUMPY = "numpy"
+RENDER_ENGINES = (RENDER_ENGINE_FFMPEG, RENDER_ENGINE_NUMPY)
+DEFAULT_WEBP_PRESET = "default"
+WEBP_PRESETS = {
+    "default": {"quality": 75, "compression_level": 4},
+    "fast": {"quality": 75, "compression_level": 0},
+    "small": {"quality": 60, "compression_level": 6},
+    "high": {"quality": 90, "compression_level": 6},
+}
+
+
+# Frame sampling modes, every mode other than "exact" trades timestamp accuracy of the sampled frames for decode speed.
+# "fast_decode" skips the deblocking filter, "skip_nonref" also skips decoding frames no other frame references and
+# "keyframes" decodes keyframes only, so each sampled frame is the nearest preceding keyframe.
+SAMPLING_EXACT = "exact"
+SAMPLING_FAST_DECODE = "fast_decode"
+SAMPLING_SKIP_NONREF = "skip_nonref"
+SAMPLING_KEYFRAMES = "keyframes"
+SAMPLING_MODES = (SAMPLING_EXACT, SAMPLING_FAST_DECODE, SAMPLING_SKIP_NONREF, SAMPLING_KEYFRAMES)
+# Decoder options, they have to be placed before the input
+SAMPLING_DECODER_ARGS = {
+    SAMPLING_EXACT: [],
+    SAMPLING_FAST_DECODE: ["-skip_loop_filter", "all", "-flags2", "fast"],
+    SAMPLING_SKIP_NONREF: ["-skip_frame", "noref", "-skip_loop_filter", "all", "-flags2", "fast"],
+    SAMPLING_KEYFRAMES: ["-skip_frame", "nokey"],
+}
+# Only the beginning of the video is probed to estimate the frame and keyframe intervals
+SAMPLING_PROBE_SECONDS = 60
+
+
+def add_render_arguments(parser):
+    parser.add_argument("--render_engine", type=str, default=RENDER_ENGINE_FFMPEG, choices=RENDER_ENGINES)
+    parser.add_argument("--render_mode", type=str, default=RENDER_MODE_PNG, choices=RENDER_MODES)
+    parser.add_argument("--webp_preset", type=str, default=DEFAULT_WEBP_PRESET, choices=sorted(WEBP_PRESETS))
+    parser.add_argument("--sampling_mode", type=str, default=SAMPLING_EXACT, choices=SAMPLING_MODES)
+    # Maximum timestamp drift in seconds accepted for the sampled frames, the render falls back to the exact mode when
+    # the source would drift more than this
+    parser.add_argument("--sampling_tolerance", type=float, default=None)
+    # Long videos are split into up to this many time ranges that are rendered concurrently
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--filmstrip_format", type=str, default=FILMSTRIP_FORMAT_TILES, choices=FILMSTRIP_FORMATS)
+    # Size of the atlas chunks, by default every sheet of a filmstrip is packed into a single object
+    parser.add_argument("--atlas_chunk_bytes", type=int, default=0)
+
+
+def render_options_from_args(args):
+    return {
+        "render_engine": args.render_engine,
+        "render_mode": args.render_mode,
+        "webp_preset": args.webp_preset,
+        "sampling_mode": args.sampling_mode,
+        "sampling_tolerance": args.sampling_tolerance,
+        "shards": args.shards,
+    }
+
+
+def publish_options_from_args(args):
+    return {
+        "filmstrip_format": args.filmstrip_format,
+        "atlas_chunk_bytes": args.atlas_chunk_bytes,
+    }
+
+
+def ffmpeg_input_args(input_file, decoder_args=()):
+    # Remote inputs (presigned S3 URLs) are streamed, let ffmpeg reconnect instead of failing the whole render
+    if input_file.startswith(("http://", "https://")):
+        return ["-reconnect", "1", "-reconnect_on_network_error", "1", "-reconnect_delay_max", "10",
+                *decoder_args, "-i", input_file]
+    return [*decoder_args, "-i", input_file]
+
+
+def frame_filter(sampling_mode=SAMPLING_EXACT):
+    # The fast modes already give up accuracy, so they use the cheapest scaler as well
+    scale_flags = "" if sampling_mode == SAMPLING_EXACT else ":flags=fast_bilinear"
+    return f"fps={FILMSTRIP_FPS},scale={FILMSTRIP_TILE_WIDTH}:-1{scale_flags}"
+
+
+def filmstrip_filter(sampling_mode=SAMPLING_EXACT):
+    return f"{frame_filter(sampling_mode)},tile={FILMSTRIP_COLUMNS}x{FILMSTRIP_ROWS}"
+
+
+def probe_frame_intervals(input_file):
+    """
+    Read the packet timestamps of the first SAMPLING_PROBE_SECONDS of the video without decoding it.
+
+    :return: Tuple of the largest gap between two frames and the largest gap between two keyframes, in seconds.
+    """
     cmd = [
-        "ffmpeg",
-        "-i",
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-read_intervals",
+        f"%+{SAMPLING_PROBE_SECONDS}",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=p=0",
         input_file,
-        "-vf",
-        f"fps={FILMSTRIP_FPS},scale=200:-1,tile=5x6",
-        f"{output_directory}/filmstrip_%04d.png",
-        "-y",
     ]
+    output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    timestamps = []
+    keyframes = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.strip().partition(",")
+        if pts_time in ("", "N/A"):
+            continue
+        timestamps.append(float(pts_time))
+        if "K" in flags:
+            keyframes.append(float(pts_time))
+    timestamps.sort()
+    keyframes.sort()
+    frame_interval = max((b - a for a, b in zip(timestamps, timestamps[1:])), default=0.0)
+    if keyframes and timestamps:
+        # The stretch after the last keyframe counts as well, it is sampled from that keyframe
+        keyframe_gaps = [b - a for a, b in zip(keyframes, keyframes[1:])] + [timestamps[-1] - keyframes[-1]]
+        keyframe_interval = max(keyframe_gaps)
+    else:
+        keyframe_interval = float("inf")
+    return frame_interval, keyframe_interval
+
+
+def estimate_sampling_drift(input_file, sampling_mode):
+    if sampling_mode in (SAMPLING_EXACT, SAMPLING_FAST_DECODE):
+        return 0.0
+    frame_interval, keyframe_interval = probe_frame_intervals(input_file)
+    if sampling_mode == SAMPLING_SKIP_NONREF:
+        # Non-reference frames are never adjacent to each other in common GOP structures
+        return 2 * frame_interval
+    return keyframe_interval
+
+
+def resolve_input_sampling_mode(input_file, sampling_mode, sampling_tolerance=None, feed_input=None):
+    if feed_input is not None:
+        # A piped input can be read only once, so it can't be probed
+        return SAMPLING_EXACT if sampling_tolerance is not None else sampling_mode
+    return resolve_sampling_mode(input_file, sampling_mode, sampling_tolerance)
+
+
+def resolve_sampling_mode(input_file, sampling_mode, sampling_tolerance=None):
+    if sampling_mode == SAMPLING_EXACT or sampling_tolerance is None:
+        return sampling_mode
+    try:
+        drift = estimate_sampling_drift(input_file, sampling_mode)
+    except Exception as err:
+        logger.exception(f"Could not probe {input_file}, using exact sampling: {err}")
+        return SAMPLING_EXACT
+    if drift > sampling_tolerance:
+        logger.info(f"Sampling mode {sampling_mode} drifts up to {drift}s on {input_file}, "
+                    f"above the tolerance of {sampling_tolerance}s, using exact sampling")
+        return SAMPLING_EXACT
+    return sampling_mode
+
+
+def webp_encoder_args(webp_preset=DEFAULT_WEBP_PRESET):
+    preset = WEBP_PRESETS[webp_preset]
+    return [
+        "-c:v",
+        "libwebp",
+        "-quality",
+        str(preset["quality"]),
+        "-compression_level",
+        str(preset["compression_level"]),
+    ]
+
+
+def probe_duration(input_file):
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=duration",
+        "-of",
+        "default=noprint_wrappers=1:nokey=1",
+        input_file,
+    ]
+    output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    return float(output.strip())
+
+
+def filmstrip_shard_ranges(duration, shards, shard_min_seconds=SHARD_MIN_SECONDS):
+    """
+    Split the timeline into sheet aligned ranges so every shard renders complete sheets.
+
+    :return: List of (start second, number of sheets) tuples in timeline order.
+    """
+    total_sheets = math.ceil(duration / FILMSTRIP_SHEET_SECONDS)
+    shards = max(1, min(shards, math.floor(duration / shard_min_seconds), total_sheets))
+    sheets_per_shard = math.ceil(total_sheets / shards)
+    return [
+        (first_sheet * FILMSTRIP_SHEET_SECONDS, min(sheets_per_shard, total_sheets - first_sheet))
+        for first_sheet in range(0, total_sheets, sheets_per_shard)
+    ]
+
+
+def filmstrip_extension(render_mode):
+    return ".webp" if render_mode == RENDER_MODE_WEBP else ".png"
+
+
+def filmstrip_command(input_args, output_directory, render_mode, webp_preset, sampling_mode, output_args=()):
+    cmd = ["ffmpeg", *input_args, "-vf", filmstrip_filter(sampling_mode), *output_args]
+    if render_mode == RENDER_MODE_WEBP:
+        cmd += [*webp_encoder_args(webp_preset), "-f", "image2"]
+    return cmd + [f"{output_directory}/{FILMSTRIP_FILE_PREFIX}%04d{filmstrip_extension(render_mode)}", "-y"]
+
+
+def frame_command(input_args, sampling_mode):
+    # Scaled frames as rgb24 PPM images on stdout, for the numpy engine
+    return ["ffmpeg", "-v", "error", *input_args, "-vf", frame_filter(sampling_mode), "-pix_fmt", "rgb24",
+            "-c:v", "ppm", "-f", "image2pipe", "pipe:1"]
+
+
+def composite_filmstrip(input_file, webp_preset=DEFAULT_WEBP_PRESET, sampling_mode=SAMPLING_EXACT, feed_input=None):
+    """
+    Render the filmstrip sheets with the numpy engine.
+
+    :return: Tuple of the list of the WebP encoded sheets in timeline order and the wall and CPU time of ffmpeg.
+    """
+    preset = WEBP_PRESETS[webp_preset]
+    cmd = frame_command(ffmpeg_input_args(input_file, SAMPLING_DECODER_ARGS[sampling_mode]), sampling_mode)
     logger.info(f"command : {cmd}")
+    with render_slots.acquire() as (slot,):
+        return composite_sheets(render_slots.slot_command(slot, cmd), FILMSTRIP_COLUMNS, FILMSTRIP_ROWS,
+                                preset["quality"], preset["compression_level"], feed_input)
+
+
+def filmstrip_sheet_name(sheet_number, extension=".webp"):
+    # Same names as the image2 muxer pattern of filmstrip_command, numbered from 1
+    return f"{FILMSTRIP_FILE_PREFIX}{sheet_number:04d}{extension}"
+
+
+def write_filmstrip_sheets(output_directory, sheets):
+    for sheet_number, sheet in enumerate(sheets, start=1):
+        with open(os.path.join(output_directory, filmstrip_sheet_name(sheet_number)), "wb") as f:
+            f.write(sheet)
+
+
+def render_filmstrip_sheets(input_file, project_id, content_id, webp_preset=DEFAULT_WEBP_PRESET,
+                            sampling_mode=SAMPLING_EXACT, sampling_tolerance=None, feed_input=None):
+    """
+    Render the filmstrip sheets of a video in memory with the numpy engine, nothing is written to disk.
+
+    :return: Tuple of the list of WebP encoded sheets and the same stats as generate_filmstrip.
+    """
+    start_time = time.monotonic()
+    sampling_mode = resolve_input_sampling_mode(input_file, sampling_mode, sampling_tolerance, feed_input)
+    sheets, usage = composite_filmstrip(input_file, webp_preset, sampling_mode, feed_input)
+    stats = {
+        "render_engine": RENDER_ENGINE_NUMPY,
+        "render_mode": RENDER_MODE_WEBP,
+        "sampling_mode": sampling_mode,
+        "shards": 1,
+        "sheets": len(sheets),
+        "bytes_written": 0,
+        "ffmpeg_cpu_time": round(usage["cpu_time"], 3),
+        "wall_time": round(time.monotonic() - start_time, 3),
+    }
+    logger.info(f"Filmstrip render stats for {project_id}/{content_id}: {stats}")
+    return sheets, stats
+
+
+def run_ffmpeg_command(cmd):
+    """
+    Run ffmpeg without observing its metrics, shards run this in child processes whose metrics are lost.
+
+    :return: Dictionary with the wall and CPU time of the process.
+    """
+    start_time = time.monotonic()
+    process = subprocess.Popen(cmd)
+    returncode, usage = metrics.wait_process(process, start_time)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return usage
+
+
+def run_observed_ffmpeg_command(cmd):
+    usage = run_ffmpeg_command(cmd)
+    metrics.observe_process(usage)
+    return usage
+
+
+def run_ffmpeg_command_with_input(cmd, feed_input):
+    """
+    Run ffmpeg with a pipe as its stdin and call feed_input with the pipe, ffmpeg decodes while it is being written.
+
+    :return: Dictionary with the wall and CPU time of the process.
+    """
+    start_time = time.monotonic()
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        feed_input(process.stdin)
+        process.stdin.close()
+    except BrokenPipeError:
+        # ffmpeg exited early, its return code tells why
+        pass
+    except Exception:
+        process.kill()
+        process.wait()
+        raise
+    returncode, usage = metrics.wait_process(process, start_time)
+    metrics.observe_process(usage)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return usage
+
+
+def render_filmstrip_shards(input_args, output_directory, shard_ranges, render_mode, webp_preset, sampling_mode):
+    """
+    Render every shard into its own directory in a process pool, then move the sheets into the output directory
+    numbered in timeline order, so the result is named exactly like a single pass render.
+
+    :return: List of the wall and CPU times of the shard processes.
+    """
+    extension = filmstrip_extension(render_mode)
+    shard_directories = []
+    commands = []
+    for shard_index, (start_second, sheets) in enumerate(shard_ranges):
+        shard_directory = os.path.join(output_directory, f"{SHARD_DIRECTORY_PREFIX}{shard_index:03d}")
+        os.makedirs(shard_directory, exist_ok=True)
+        shard_directories.append(shard_directory)
+        shard_input_args = ["-ss", str(start_second)]
+        shard_output_args = []
+        if shard_index < len(shard_ranges) - 1:
+            # The fps filter can emit one extra frame at the cut, capping the sheets keeps the next shard aligned
+            shard_input_args += ["-t", str(sheets * FILMSTRIP_SHEET_SECONDS)]
+            shard_output_args = ["-frames:v", str(sheets)]
+        commands.append(filmstrip_command([*shard_input_args, *input_args], shard_directory, render_mode,
+                                          webp_preset, sampling_mode, shard_output_args))
+    logger.info(f"commands : {commands}")
+
     try:
-        subprocess.run(cmd, check=True)
-        convert_png_to_webp(output_directory)
+        with render_slots.acquire(len(commands)) as slots:
+            # With fewer slots than shards the shards take turns, there are never more processes than slots
+            commands = [render_slots.slot_command(slots[index % len(slots)], cmd) for index, cmd in enumerate(commands)]
+            # spawn, the entry scripts call this from worker threads and forking a threaded process is unsafe
+            with ProcessPoolExecutor(max_workers=len(slots),
+                                     mp_context=multiprocessing.get_context("spawn")) as executor:
+                usages = list(executor.map(run_ffmpeg_command, commands))
+        for usage in usages:
+            metrics.observe_process(usage)
+
+        sheet_number = 1
+        for shard_directory in shard_directories:
+            for file in list_filmstrip_files(shard_directory, extension):
+                os.replace(os.path.join(shard_directory, file),
+                           os.path.join(output_directory, filmstrip_sheet_name(sheet_number, extension)))
+                sheet_number += 1
+    finally:
+        for shard_directory in shard_directories:
+            shutil.rmtree(shard_directory, ignore_errors=True)
+    return usages
+
 
+def plan_filmstrip_shards(input_file, shards, shard_min_seconds=SHARD_MIN_SECONDS):
+    if shards <= 1:
+        return []
+    try:
+        return filmstrip_shard_ranges(probe_duration(input_file), shards, shard_min_seconds)
     except Exception as err:
+        logger.exception(f"Could not probe the duration of {input_file}, rendering it in a single pass: {err}")
+        return []
+
+
+def generate_filmstrip(input_file, project_id, content_id, render_mode=RENDER_MODE_PNG,
+                       webp_preset=DEFAULT_WEBP_PRESET, sampling_mode=SAMPLING_EXACT, sampling_tolerance=None,
+                       shards=1, shard_min_seconds=SHARD_MIN_SECONDS, feed_input=None,
+                       render_engine=RENDER_ENGINE_FFMPEG):
+    """
+    Render the filmstrip sheets of a video into the local output directory. The numpy engine always renders WebP
+    sheets in a single pass, render_mode and shards only apply to the ffmpeg engine.
+
+    :param feed_input: Optional function writing the video into the file object it is called with, the video is
+                       then read from the stdin of ffmpeg and input_file should be STDIN_INPUT.
+
+    :return: Dictionary with the render engine, render and sampling mode, number of shards and sheets, bytes written
+             to the scratch disk, the CPU time of the ffmpeg processes and the wall time of the job in seconds.
+    """
+    output_directory = OUTPUT_DIRECTORY.format(project_id, content_id)
+    os.makedirs(output_directory, exist_ok=True)
+    start_time = time.monotonic()
+    sampling_mode = resolve_input_sampling_mode(input_file, sampling_mode, sampling_tolerance, feed_input)
+    shard_ranges = []
+    if feed_input is None and render_engine == RENDER_ENGINE_FFMPEG:
+        shard_ranges = plan_filmstrip_shards(input_file, shards, shard_min_seconds)
+    if render_engine == RENDER_ENGINE_NUMPY:
+        render_mode = RENDER_MODE_WEBP
+    input_args = ffmpeg_input_args(input_file, SAMPLING_DECODER_ARGS[sampling_mode])
+    usages = []
+    try:
+        if render_engine == RENDER_ENGINE_NUMPY:
+            sheets, usage = composite_filmstrip(input_file, webp_preset, sampling_mode, feed_input)
+            usages.append(usage)
+            write_filmstrip_sheets(output_directory, sheets)
+        elif feed_input is not None:
+            cmd = filmstrip_command(input_args, output_directory, render_mode, webp_preset, sampling_mode)
+            logger.info(f"command : {cmd}")
+            with render_slots.acquire() as (slot,):
+                usages.append(run_ffmpeg_command_with_input(render_slots.slot_command(slot, cmd), feed_input))
+        elif len(shard_ranges) > 1:
+            usages += render_filmstrip_shards(input_args, output_directory, shard_ranges, render_mode, webp_preset,
+                                              sampling_mode)
+        else:
+            # Generate multiple images with filmstrip of the complete video file where each image contains 30 frames
+            cmd = filmstrip_command(input_args, output_directory, render_mode, webp_preset, sampling_mode)
+            logger.info(f"command : {cmd}")
+            with render_slots.acquire() as (slot,):
+                usages.append(run_observed_ffmpeg_command(render_slots.slot_command(slot, cmd)))
+        if render_mode == RENDER_MODE_PNG:
+            usages += convert_png_to_webp(output_directory, webp_preset)
+
+    except Exception as err:
+        # A failed render leaves a truncated filmstrip behind, fail the job instead of publishing it
         logger.exception(f"An error occurred while generating the film strip: {err}")
+        raise
+
+    stats = {
+        "render_engine": render_engine,
+        "render_mode": render_mode,
+        "sampling_mode": sampling_mode,
+        "shards": max(len(shard_ranges), 1),
+        "sheets": len(list_filmstrip_files(output_directory, ".webp")),
+        "bytes_written": filmstrip_bytes_written(output_directory),
+        "ffmpeg_cpu_time": round(sum(usage["cpu_time"] for usage in usages), 3),
+        "wall_time": round(time.monotonic() - start_time, 3),
+    }
+    logger.info(f"Filmstrip render stats for {project_id}/{content_id}: {stats}")
+    return stats
+
+
+def list_filmstrip_files(output_directory, extension):
+    if not os.path.isdir(output_directory):
+        return []
+    return sorted(
+        file for file in os.listdir(output_directory)
+        if file.startswith(FILMSTRIP_FILE_PREFIX) and file.endswith(extension)
+    )
+
+
+def filmstrip_bytes_written(output_directory):
+    # Counts the intermediate PNG sheets as well, they are scratch disk churn even though they are never uploaded
+    return sum(
+        os.path.getsize(os.path.join(output_directory, file))
+        for extension in (".png", ".webp")
+        for file in list_filmstrip_files(output_directory, extension)
+    )
+
+
+def convert_png_to_webp(output_directory, webp_preset=DEFAULT_WEBP_PRESET):
+    """
+    :return: List of the wall and CPU times of the conversions.
+    """
+    usages = []
+    with render_slots.acquire() as (slot,):
+        for root, _, files in os.walk(output_directory):
+            for file in files:
+                if file.endswith(".png"):
+                    file_path = os.path.join(root, file)
+                    cmd = [
+                        "ffmpeg",
+                        "-i",
+                        file_path,
+                        *webp_encoder_args(webp_preset),
+                        f"{output_directory}/{os.path.splitext(os.path.basename(file_path))[0]}.webp",
+                        "-y",
+                    ]
+                    usages.append(run_observed_ffmpeg_command(render_slots.slot_command(slot, cmd)))
+    return usages
+
+
+def upload_filmstrip_to_s3(project_id, content_id, filmstrip_format=FILMSTRIP_FORMAT_TILES, atlas_chunk_bytes=0):
+    """
+    Publish the WebP sheets rendered into the output directory of the filmstrip.
+    """
+    output_directory = OUTPUT_DIRECTORY.format(project_id, content_id)
+    tiles = [(file, os.path.join(output_directory, file)) for file in list_filmstrip_files(output_directory, ".webp")]
+    return publish_filmstrip(project_id, content_id, tiles, filmstrip_format, atlas_chunk_bytes)
+
+
+def upload_filmstrip_sheets(project_id, content_id, sheets, filmstrip_format=FILMSTRIP_FORMAT_TILES,
+                            atlas_chunk_bytes=0):
+    """
+    Publish sheets rendered in memory by render_filmstrip_sheets, without going through the disk.
+    """
+    tiles = [(filmstrip_sheet_name(sheet_number), sheet) for sheet_number, sheet in enumerate(sheets, start=1)]
+    return publish_filmstrip(project_id, content_id, tiles, filmstrip_format, atlas_chunk_bytes)
 
 
-def convert_png_to_webp(output_directory):
-    for root, _, files in os.walk(output_directory):
-        for file in files:
-            if file.endswith(".png"):
-                file_path = os.path.join(root, file)
-                cmd = [
-                    "ffmpeg",
-                    "-i",
-                    file_path,
-                    "-c:v",
-                    "libwebp",
-                    f"{output_directory}/{os.path.splitext(os.path.basename(file_path))[0]}.webp",
-                    "-y",
-                ]
-                subprocess.run(cmd, check=True)
-
-
-def upload_filmstrip_to_s3(project_id, content_id):
+def filmstrip_objects(prefix, tiles, filmstrip_format=FILMSTRIP_FORMAT_TILES, atlas_chunk_bytes=0):
+    """
+    :return: Tuple of the list of (key, bytes, content type) of the objects holding the sheets and the index.
+    """
+    if filmstrip_format == FILMSTRIP_FORMAT_ATLAS:
+        chunks, index = atlas.pack_atlas(
+            [read_tile(tile) for _, tile in tiles],
+            lambda chunk_number: prefix + FILMSTRIP_ATLAS_FILE.format(chunk_number), atlas_chunk_bytes,
+            FILMSTRIP_COLUMNS, FILMSTRIP_ROWS, FILMSTRIP_FPS,
+        )
+        return [(key, data, atlas.ATLAS_CONTENT_TYPE) for key, data in chunks], index
+    objects = [(prefix + file_name, read_tile(tile), TILE_CONTENT_TYPE) for file_name, tile in tiles]
+    return objects, filmstrip_index([key for key, _, _ in objects])
+
+
+def publish_filmstrip(project_id, content_id, tiles, filmstrip_format=FILMSTRIP_FORMAT_TILES, atlas_chunk_bytes=0):
+    """
+    Upload the tiles of a filmstrip, or the atlas they are packed into, through the shared transfer manager and then
+    its index, once every object is in S3, so readers never find an index pointing to missing objects. Objects whose
+    MD5 matches their ETag in S3, e.g. from an interrupted run, are not uploaded again.
+
+    :param tiles: List of (file name, tile) with the WebP bytes of the tile or the path of the file.
+    :return: Dictionary with the number of objects uploaded and skipped.
+    """
     try:
-        output_directory = OUTPUT_DIRECTORY.format(project_id, content_id)
-        with ThreadPoolExecutor(max_workers=NUM_PARALLEL_UPLOADS) as executor:
-            filmstrip_file_paths = []
-            for root, _, files in os.walk(output_directory):
-                for file in files:
-                    if file.endswith(".webp"):
-                        file_path = os.path.join(root, file)
-                        s3_file_key = S3_KEY_BASE_PATH.format(project_id, content_id, file)
-                        filmstrip_file_paths.append(s3_file_key)
-                        executor.submit(upload_files_to_s3, STATIC_ASSETS_BUCKET, s3_file_key, file_path)
-
-            filmstrip_index_filepath = os.path.join(output_directory, FILMSTRIP_INDEX_FILE)
-            s3_index_file_key = store_filmstrip_index_in_json(project_id, content_id, filmstrip_index_filepath,
-                                                              filmstrip_file_paths)
-            executor.submit(upload_files_to_s3, STATIC_ASSETS_BUCKET, s3_index_file_key, filmstrip_index_filepath)
+        prefix = S3_KEY_BASE_PATH.format(project_id, content_id, "")
+        etags = remote_etags(STATIC_ASSETS_BUCKET, prefix)
+        objects, filmstrip_index_data = filmstrip_objects(prefix, tiles, filmstrip_format, atlas_chunk_bytes)
+        futures = []
+        for s3_file_key, data, content_type in objects:
+            if etags.get(s3_file_key) != hashlib.md5(data).hexdigest():
+                futures.append(upload_object(STATIC_ASSETS_BUCKET, s3_file_key, data, content_type,
+                                             TILE_CACHE_CONTROL))
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as err:
+                errors.append(err)
+        if errors:
+            # A throttled upload requeues the job, the objects uploaded by now are skipped when it runs again
+            raise next((err for err in errors if throttle.is_throttling_error(err)), errors[0])
+
+        s3_index_file_key = prefix + FILMSTRIP_INDEX_FILE
+        index = json.dumps(filmstrip_index_data, indent=4).encode("utf-8")
+        if etags.get(s3_index_file_key) != hashlib.md5(index).hexdigest():
+            upload_object(STATIC_ASSETS_BUCKET, s3_index_file_key, index, INDEX_CONTENT_TYPE,
+                          INDEX_CACHE_CONTROL).result()
+        print(f"Filmstrip published to {STATIC_ASSETS_BUCKET}/{prefix} as {filmstrip_format}: {len(futures)} of "
+              f"{len(objects)} objects uploaded")
+        return {"uploaded": len(futures), "skipped": len(objects) - len(futures)}
 
     except Exception as err:
         logger.exception(f"An error occurred while uploading the film strip to S3 bucket: {err}")
+        # Raised so the pipeline fails or, when S3 throttled, requeues the job instead of losing it
+        raise
 
 
-def store_filmstrip_index_in_json(project_id, content_id, filmstrip_index_filepath, filmstrip_file_paths):
+def copy_filmstrip(source_project_id, source_content_id, project_id, content_id):
+    """
+    Copy a published filmstrip to the prefix of another content with server side copies, then write its index with
+    the keys of the copies. Objects already copied by an earlier attempt are skipped.
+    """
+    source_prefix = S3_KEY_BASE_PATH.format(source_project_id, source_content_id, "")
+    prefix = S3_KEY_BASE_PATH.format(project_id, content_id, "")
+    if prefix == source_prefix:
+        return
+    s3 = aws.s3_client()
+    with metrics.timer("s3_probe_seconds", operation="get_index"):
+        response = s3.get_object(Bucket=STATIC_ASSETS_BUCKET, Key=source_prefix + FILMSTRIP_INDEX_FILE)
+        source_index = json.loads(response["Body"].read())
+    source_etags = remote_etags(STATIC_ASSETS_BUCKET, source_prefix)
+    etags = remote_etags(STATIC_ASSETS_BUCKET, prefix)
+    source_keys = filmstrip_index_keys(source_index)
+    with ThreadPoolExecutor(max_workers=NUM_PARALLEL_UPLOADS) as executor:
+        futures = [
+            executor.submit(copy_object, STATIC_ASSETS_BUCKET, source_key, prefix + source_key[len(source_prefix):])
+            for source_key in source_keys
+            if etags.get(prefix + source_key[len(source_prefix):]) != source_etags.get(source_key)
+        ]
+        for future in futures:
+            future.result()
+
+    index = json.dumps(rebase_filmstrip_index(source_index, source_prefix, prefix), indent=4).encode("utf-8")
+    if etags.get(prefix + FILMSTRIP_INDEX_FILE) != hashlib.md5(index).hexdigest():
+        upload_object(STATIC_ASSETS_BUCKET, prefix + FILMSTRIP_INDEX_FILE, index, INDEX_CONTENT_TYPE,
+                      INDEX_CACHE_CONTROL).result()
+    print(f"Filmstrip copied from {STATIC_ASSETS_BUCKET}/{source_prefix} to {prefix}: {len(futures)} of "
+          f"{len(source_keys)} objects copied")
+
+
+def copy_object(bucket_name, source_key, s3_file_key):
+    s3 = aws.s3_client()
+    # Content-Type and Cache-Control are copied with the object
+    with throttle.get_limiter(f"s3:{bucket_name}").slot(), metrics.timer("copy_seconds"):
+        s3.copy_object(CopySource={"Bucket": bucket_name, "Key": source_key}, Bucket=bucket_name, Key=s3_file_key)
+
+
+def filmstrip_index_keys(index):
+    if atlas.is_atlas_index(index):
+        return list(index["chunks"])
+    return list(index[FILMSTRIP_INDEX_KEY])
+
+
+def rebase_filmstrip_index(index, source_prefix, prefix):
+    # The index of either format holds the full keys of the objects, they move to the prefix of the copy
+    keys = [prefix + key[len(source_prefix):] for key in filmstrip_index_keys(index)]
+    if atlas.is_atlas_index(index):
+        return dict(index, chunks=keys)
+    return filmstrip_index(keys)
+
+
+def read_tile(tile):
+    if isinstance(tile, bytes):
+        return tile
+    with open(tile, "rb") as f:
+        return f.read()
+
+
+def remote_etags(bucket_name, prefix):
+    """
+    :return: Dictionary of the ETag of every object under the prefix, one listing instead of a request per tile.
+    """
+    s3 = aws.s3_client()
+    etags = {}
+    with metrics.timer("s3_probe_seconds", operation="list_objects"):
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket_name, Prefix=prefix):
+            for s3_object in page.get("Contents", []):
+                etags[s3_object["Key"]] = s3_object["ETag"].strip('"')
+    return etags
+
+
+class UploadSubscriber(BaseSubscriber):
+    """
+    Gives the limiter slot of an upload back and records its metrics once the transfer manager finished it.
+    """
+
+    def __init__(self, limiter, start_time, size):
+        self.limiter = limiter
+        self.start_time = start_time
+        self.size = size
+
+    def on_done(self, future, **kwargs):
+        err = None
+        try:
+            future.result()
+        except Exception as upload_err:
+            err = upload_err
+        self.limiter.release(self.start_time, err)
+        metrics.observe("upload_seconds", time.monotonic() - self.start_time)
+        if err is None:
+            metrics.observe("upload_bytes", self.size)
+
+
+def upload_object(bucket_name, s3_file_key, data, content_type, cache_control):
+    """
+    Upload bytes through the transfer manager shared by the process, waits for a slot of the bucket's limiter.
+
+    :return: Future of the upload.
+    """
+    limiter = throttle.get_limiter(f"s3:{bucket_name}")
+    start_time = limiter.acquire()
+    try:
+        return aws.transfer_manager().upload(
+            io.BytesIO(data), bucket_name, s3_file_key,
+            extra_args={"ContentType": content_type, "CacheControl": cache_control},
+            subscribers=[UploadSubscriber(limiter, start_time, len(data))],
+        )
+    except Exception as err:
+        limiter.release(start_time, err)
+        raise
+
+
+def filmstrip_index(filmstrip_file_paths):
     # Creating dictionary to store the index files
     filmstrip_file_paths.sort()
-    data = {FILMSTRIP_INDEX_KEY: filmstrip_file_paths}
+    return {FILMSTRIP_INDEX_KEY: filmstrip_file_paths}
+
+
+def store_filmstrip_index_in_json(project_id, content_id, filmstrip_index_filepath, filmstrip_file_paths):
+    data = filmstrip_index(filmstrip_file_paths)
 
     with open(filmstrip_index_filepath, 'w') as json_file:
         json.dump(data, json_file, indent=4)
@@ -88,24 +735,21 @@ def store_filmstrip_index_in_json(project_id, content_id, filmstrip_index_filepa
     return s3_file_key
 
 
-def upload_files_to_s3(bucket_name, s3_file_key, local_file_name):
-    s3 = boto3.client('s3')
-    try:
-        s3.upload_file(local_file_name, bucket_name, s3_file_key)
-        print(f"File uploaded successfully to {bucket_name}/{s3_file_key}")
-    except FileNotFoundError:
-        print(f"The file {local_file_name} was not found.")
-    except NoCredentialsError:
-        print("Credentials not available or incorrect.")
+def filmstrip_index_is_complete(index):
+    # Index files of both formats, an atlas index lists sheets and chunks instead of the keys of the sheets
+    if atlas.is_atlas_index(index):
+        return len(index.get("sheets", [])) > 0 and len(index.get("chunks", [])) > 0
+    return len(index.get(FILMSTRIP_INDEX_KEY, [])) > 0
 
 
 def check_file_in_s3(bucket_name, s3_file_key):
     try:
-        s3 = boto3.client('s3')
-        response = s3.get_object(Bucket=bucket_name, Key=s3_file_key)
-        file_content = response['Body'].read().decode('utf-8')
+        s3 = aws.s3_client()
+        with metrics.timer("s3_probe_seconds", operation="get_index"):
+            response = s3.get_object(Bucket=bucket_name, Key=s3_file_key)
+            file_content = response['Body'].read().decode('utf-8')
         print(f"Successfully read JSON file from {bucket_name}/{s3_file_key}")
-        return len(json.loads(file_content)['filmstrip_file_names']) > 0
+        return filmstrip_index_is_complete(json.loads(file_content))
     except ClientError as e:
         if e.response['Error']['Code'] == '404':
             print(f"File not found: {s3_file_key}")
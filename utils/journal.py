@@ -0,0 +1,210 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+
+STATE_PENDING = "pending"
+STATE_DOWNLOADED = "downloaded"
+STATE_RENDERED = "rendered"
+STATE_UPLOADED = "uploaded"
+STATE_FAILED = "failed"
+# State a job reaches once the pipeline stage with this name finished
+STAGE_STATES = {
+    "fetch": STATE_DOWNLOADED,
+    "render": STATE_RENDERED,
+    "publish": STATE_UPLOADED,
+}
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_FLUSH_INTERVAL = 5
+DEFAULT_MAX_ATTEMPTS = 5
+# Failed jobs wait RETRY_BACKOFF_SECONDS * 2^(attempts - 1) before they are retried by a later run
+RETRY_BACKOFF_SECONDS = 300
+MAX_BACKOFF_EXPONENT = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    source TEXT NOT NULL,
+    project_id TEXT NOT NULL,
+    content_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    reason TEXT,
+    next_attempt_at REAL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (source, project_id, content_id)
+)
+"""
+INSERT_PENDING = """
+INSERT OR IGNORE INTO jobs (source, project_id, content_id, state, updated_at) VALUES (?, ?, ?, ?, ?)
+"""
+UPDATE_STATE = """
+INSERT INTO jobs (source, project_id, content_id, state, updated_at) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (source, project_id, content_id) DO UPDATE SET
+    state = excluded.state, reason = NULL, updated_at = excluded.updated_at
+"""
+UPDATE_FAILED = f"""
+INSERT INTO jobs (source, project_id, content_id, state, attempts, reason, next_attempt_at, updated_at)
+VALUES (?, ?, ?, '{STATE_FAILED}', 1, ?, ? + {RETRY_BACKOFF_SECONDS}, ?)
+ON CONFLICT (source, project_id, content_id) DO UPDATE SET
+    state = excluded.state,
+    attempts = jobs.attempts + 1,
+    reason = excluded.reason,
+    next_attempt_at = excluded.updated_at + {RETRY_BACKOFF_SECONDS} * (1 << MIN(jobs.attempts, {MAX_BACKOFF_EXPONENT})),
+    updated_at = excluded.updated_at
+"""
+SELECT_SKIPPED = f"""
+SELECT project_id, content_id FROM jobs WHERE source = ? AND (
+    state = '{STATE_UPLOADED}' OR (state = '{STATE_FAILED}' AND (attempts >= ? OR next_attempt_at > ?))
+)
+"""
+SELECT_FAILED = f"SELECT project_id, content_id FROM jobs WHERE source = ? AND state = '{STATE_FAILED}'"
+SELECT_PROGRESS = "SELECT state, COUNT(*) FROM jobs WHERE source = ? GROUP BY state"
+
+
+class JobJournal:
+    """
+    SQLite journal of the state of every item of a source, so an interrupted run can be resumed without
+    probing S3 again. Writes are buffered and committed in batches.
+    """
+
+    def __init__(self, path, source, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        :param path: Path of the SQLite database, created if it does not exist.
+        :param source: Name of the entry script, several sources can share one journal.
+        :param batch_size: Number of buffered updates that triggers a commit.
+        :param flush_interval: Seconds after which buffered updates are committed regardless of their number.
+        :param max_attempts: Failed items are not retried any more after this many attempts.
+        """
+        self.source = source
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.skipped = None
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets progress queries read the journal while the run keeps writing to it
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+
+    def load_skipped(self):
+        with self.lock:
+            self.skipped = {
+                (project_id, content_id)
+                for project_id, content_id in self.connection.execute(
+                    SELECT_SKIPPED, (self.source, self.max_attempts, time.time()))
+            }
+        print(f"Journal: {len(self.skipped)} items completed or backing off")
+
+    def filter_rows(self, rows, project_column, content_column):
+        """
+        Drop the rows that were uploaded by a previous run or whose failure is still backing off, and record the
+        remaining ones as pending.
+        """
+        if self.skipped is None:
+            self.load_skipped()
+        pending = [
+            row for row in rows
+            if (str(row[project_column]), str(row[content_column])) not in self.skipped
+        ]
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(INSERT_PENDING, [
+                (self.source, str(row[project_column]), str(row[content_column]), STATE_PENDING, now)
+                for row in pending
+            ])
+            self.connection.commit()
+        return pending
+
+    def mark_uploaded(self, pairs):
+        """
+        Record (project_id, content_id) pairs found in S3 as uploaded, later runs skip them without listing S3.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(UPDATE_STATE, [
+                (self.source, str(project_id), str(content_id), STATE_UPLOADED, now)
+                for project_id, content_id in pairs
+            ])
+            self.connection.commit()
+
+    def record_stage(self, job, stage):
+        state = STAGE_STATES.get(stage.name)
+        if state:
+            self._write(UPDATE_STATE, (self.source, str(job.project_id), str(job.content_id), state, time.time()))
+
+    def record_finish(self, job, err):
+        if err is not None:
+            now = time.time()
+            reason = f"{type(err).__name__}: {err}"
+            self._write(UPDATE_FAILED, (self.source, str(job.project_id), str(job.content_id), reason, now, now))
+
+    def _write(self, statement, params):
+        with self.lock:
+            self.buffer.append((statement, params))
+            if len(self.buffer) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        # Updates are applied in order, a job can go through several states within one batch
+        for statement, params in self.buffer:
+            self.connection.execute(statement, params)
+        self.connection.commit()
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def failed_items(self):
+        """
+        :return: Set of the (project_id, content_id) pairs whose last attempt failed.
+        """
+        with self.lock:
+            self._flush()
+            return set(self.connection.execute(SELECT_FAILED, (self.source,)).fetchall())
+
+    def progress(self):
+        with self.lock:
+            return dict(self.connection.execute(SELECT_PROGRESS, (self.source,)).fetchall())
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.connection.close()
+
+
+def add_journal_arguments(parser):
+    parser.add_argument("--journal", type=str, default=None, help="Path of the SQLite job journal to resume from")
+    parser.add_argument("--max_attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+
+
+def journal_from_args(args, source):
+    if not args.journal:
+        return None
+    return JobJournal(args.journal, source, max_attempts=args.max_attempts)
+
+
+if __name__ == "__main__":
+    # Progress of a running or finished migration, e.g. python3 -m utils.journal journal.db --source=uploads
+    parser = argparse.ArgumentParser()
+    parser.add_argument("journal", type=str)
+    parser.add_argument("--source", type=str, default=None)
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(f"file:{args.journal}?mode=ro", uri=True)
+    if args.source:
+        rows = connection.execute("SELECT ?, state, COUNT(*) FROM jobs WHERE source = ? GROUP BY state",
+                                  (args.source, args.source)).fetchall()
+    else:
+        rows = connection.execute("SELECT source, state, COUNT(*) FROM jobs GROUP BY source, state").fetchall()
+    progress = {}
+    for source, state, count in rows:
+        progress.setdefault(source, {})[state] = count
+    print(json.dumps(progress, indent=4))
@@ -1,21 +1,125 @@
 import abc
 import os
+import struct
+import time
 from enum import Enum
+import requests
 import yt_dlp
-import boto3
+
+from utils import aws, metrics, source_cache, throttle
+from utils.dedup import source_url_identity
+from utils.filmstrip import FILMSTRIP_TILE_WIDTH
 
 s3_video_file_key = "content-lab/filestack/custom_assets/{project_id}/{content_id}.mp4"
 VIDEO_OUTPUT_FILE = "downloads/{}/{}/input.mp4"
 STATIC_ASSETS_BUCKET = "staticassets.goldcast.com"
-
-
-def download_file_from_s3(s3_file_key, local_file_name):
-    s3 = boto3.client('s3')
-    s3.download_file(STATIC_ASSETS_BUCKET, s3_file_key, local_file_name)
+# The presigned URL has to outlive the whole decode, ffmpeg issues new range requests when it reconnects
+PRESIGNED_URL_EXPIRY = 6 * 60 * 60
+MP4_MAX_PROBED_BOXES = 16
+# The full profile downloads the source as it is published, the filmstrip profile only the smallest video stream
+# that still covers the tile width
+DOWNLOAD_PROFILE_FULL = "full"
+DOWNLOAD_PROFILE_FILMSTRIP = "filmstrip"
+DOWNLOAD_PROFILES = (DOWNLOAD_PROFILE_FULL, DOWNLOAD_PROFILE_FILMSTRIP)
+# Fragments of DASH/HLS sources downloaded at once by yt-dlp with the filmstrip profile
+FRAGMENT_CONCURRENCY = 8
+
+
+def download_file_from_s3(s3_file_key, local_file_name, head=None):
+    """
+    :param head: (ETag, size) of the object from s3_object_head when already known, saves a HEAD request.
+    """
+    cache = source_cache.get_cache()
+    if cache is None:
+        _download_file_from_s3(s3_file_key, local_file_name)
+    else:
+        # Keyed by the ETag and size, a replaced upload is downloaded again and copies of a file share the entry
+        cache.fetch(s3_object_identity(s3_file_key, head), local_file_name,
+                    lambda destination: _download_file_from_s3(s3_file_key, destination))
     print(f"{local_file_name} has size: {os.path.getsize(local_file_name)}")
     return local_file_name
 
 
+def _download_file_from_s3(s3_file_key, local_file_name):
+    s3 = aws.s3_client()
+    start_time = time.monotonic()
+    with throttle.get_limiter(f"s3:{STATIC_ASSETS_BUCKET}").slot():
+        s3.download_file(STATIC_ASSETS_BUCKET, s3_file_key, local_file_name)
+    metrics.observe_download("s3", os.path.getsize(local_file_name), time.monotonic() - start_time)
+
+
+def s3_object_head(s3_file_key):
+    """
+    :return: Tuple of the ETag and size of an object, from one HEAD request.
+    """
+    s3 = aws.s3_client()
+    with metrics.timer("s3_probe_seconds", operation="head_object"):
+        response = s3.head_object(Bucket=STATIC_ASSETS_BUCKET, Key=s3_file_key)
+    return response['ETag'].strip('"'), response['ContentLength']
+
+
+def s3_object_identity(s3_file_key, head=None):
+    """
+    :param head: (ETag, size) of the object from s3_object_head when already known, saves a HEAD request.
+    :return: Identity of the content of an object from its ETag and size, copies of the same file share it.
+    """
+    etag, size = head if head is not None else s3_object_head(s3_file_key)
+    return f"s3:{etag}:{size}"
+
+
+def url_content_length(url):
+    """
+    :return: Size in bytes from the Content-Length of a HEAD request, None when the server doesn't tell.
+    """
+    response = requests.head(url, allow_redirects=True, timeout=30)
+    if not response.ok or 'Content-Length' not in response.headers:
+        return None
+    return int(response.headers['Content-Length'])
+
+
+def generate_presigned_s3_url(s3_file_key):
+    s3 = aws.s3_client()
+    return s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': STATIC_ASSETS_BUCKET, 'Key': s3_file_key},
+        ExpiresIn=PRESIGNED_URL_EXPIRY,
+    )
+
+
+def is_streamable_mp4(s3_file_key):
+    """
+    Walk the top level MP4 boxes with ranged GETs and check whether the moov atom comes before mdat.
+
+    Files with the moov atom at the end cannot be decoded until the last byte is read, so they are
+    not worth streaming.
+
+    :param s3_file_key: Key of the MP4 object in the static assets bucket.
+    :return: True if the moov atom is found before any mdat box.
+    """
+    s3 = aws.s3_client()
+    offset = 0
+    for _ in range(MP4_MAX_PROBED_BOXES):
+        response = s3.get_object(Bucket=STATIC_ASSETS_BUCKET, Key=s3_file_key, Range=f"bytes={offset}-{offset + 15}")
+        header = response['Body'].read()
+        if len(header) < 8:
+            return False
+        box_size, box_type = struct.unpack(">I4s", header[:8])
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat":
+            return False
+        if box_size == 1:
+            # 64-bit box size stored right after the box type
+            if len(header) < 16:
+                return False
+            box_size = struct.unpack(">Q", header[8:16])[0]
+        if box_size < 8:
+            # Size 0 means the box extends to the end of the file, so there is no moov after it
+            return False
+        offset += box_size
+    return False
+
+
 class ImportSourceType(Enum):
     YOUTUBE = "YOUTUBE"
     HOSTED_URL = "HOSTED_URL"
@@ -35,6 +139,10 @@ class MediaProcessor:
             import_url=None,
             import_source_type=ImportSourceType.HOSTED_URL,
             ves_token="",
+            stream_source=False,
+            download_profile=DOWNLOAD_PROFILE_FULL,
+            min_width=FILMSTRIP_TILE_WIDTH,
+            source_head=None,
     ):
         self.project_id = project_id
         self.content_id = content_id
@@ -43,16 +151,22 @@ class MediaProcessor:
         self.import_url = import_url
         self.import_source_type = import_source_type
         self.ves_token = ves_token
+        self.stream_source = stream_source
+        self.download_profile = download_profile
+        self.min_width = min_width
+        # (ETag, size) of the uploaded video when the caller already looked it up
+        self.source_head = source_head
         self.input_file = None
 
     def process_media(self):
         os.makedirs(os.path.dirname(VIDEO_OUTPUT_FILE.format(self.project_id, self.content_id)), exist_ok=True)
         if not self.import_url:
             factory = VideoDownloadFactory(
-                self.project_id, self.content_id, self.media_type
+                self.project_id, self.content_id, self.media_type, self.stream_source, self.source_head
             )
         else:
-            factory = ImportUrlDownloadFactory(self.import_url, self.import_source_type, self.media_type, self.project_id, self.content_id)
+            factory = ImportUrlDownloadFactory(self.import_url, self.import_source_type, self.media_type,
+                                               self.project_id, self.content_id, self.download_profile, self.min_width)
 
         downloader = factory.create_downloader()
         return downloader.download()
@@ -60,24 +174,39 @@ class MediaProcessor:
 
 class VideoDownloadFactory(object):
 
-    def __init__(self, project_id, content_id, media_type):
+    def __init__(self, project_id, content_id, media_type, stream_source=False, source_head=None):
         self.project_id = project_id
         self.content_id = content_id
         self.media_type = media_type
+        self.stream_source = stream_source
+        self.source_head = source_head
 
     def create_downloader(self):
-        return VideoDownloader(self.project_id, self.content_id)
+        return VideoDownloader(self.project_id, self.content_id, self.stream_source, self.source_head)
 
 
 class VideoDownloader(object):
 
-    def __init__(self, project_id, content_id):
+    def __init__(self, project_id, content_id, stream_source=False, source_head=None):
         self.project_id = project_id
         self.content_id = content_id
+        self.stream_source = stream_source
+        self.source_head = source_head
 
     def download(self):
+        """
+        Return the input for ffmpeg, either a presigned URL that ffmpeg streams from or a local copy of the video.
+
+        Streaming is only used when the MP4 is fast-start, otherwise the video is downloaded as before.
+        """
         s3_file_key = s3_video_file_key.format(project_id=self.project_id, content_id=self.content_id)
-        return download_file_from_s3(s3_file_key, VIDEO_OUTPUT_FILE.format(self.project_id, self.content_id))
+        if self.stream_source:
+            if is_streamable_mp4(s3_file_key):
+                print(f"Streaming {s3_file_key} directly into ffmpeg")
+                return generate_presigned_s3_url(s3_file_key)
+            print(f"{s3_file_key} is not streamable (moov atom after mdat), downloading it instead")
+        return download_file_from_s3(s3_file_key, VIDEO_OUTPUT_FILE.format(self.project_id, self.content_id),
+                                     self.source_head)
 
 
 class BaseDownloader(abc.ABC):
@@ -85,36 +214,62 @@ class BaseDownloader(abc.ABC):
     Abstract base class for video downloaders.
     """
     YDL_OPTS: dict
+    # yt-dlp format of the filmstrip profile, {width} is the minimum width. The video-only formats come first, the
+    # last alternatives are the fallbacks of sources that don't publish video-only formats.
+    FILMSTRIP_FORMAT = "wv[width>={width}]/w[width>={width}]/b"
 
-    def __init__(self, url, media_type, project_id, content_id):
+    def __init__(self, url, media_type, project_id, content_id, download_profile=DOWNLOAD_PROFILE_FULL,
+                 min_width=FILMSTRIP_TILE_WIDTH):
         self.url = url
         self.media_type = media_type
         self.project_id = project_id
         self.content_id = content_id
+        self.download_profile = download_profile
+        self.min_width = min_width
 
     def download(self):
         return self._download_with_ydl()
 
+    def ydl_options(self):
+        # A copy, the class options are shared by every fetch worker
+        ydl_opts = dict(self.YDL_OPTS, outtmpl=VIDEO_OUTPUT_FILE.format(self.project_id, self.content_id))
+        if self.download_profile == DOWNLOAD_PROFILE_FILMSTRIP:
+            # A single video-only format, nothing to merge with an audio stream
+            ydl_opts['format'] = self.FILMSTRIP_FORMAT.format(width=self.min_width)
+            ydl_opts['concurrent_fragment_downloads'] = FRAGMENT_CONCURRENCY
+        return ydl_opts
+
     def _download_with_ydl(self):
         """
-        Download the video using yt-dlp with the provided options.
+        Download the video using yt-dlp with the options of the download profile.
 
-        :param ydl_opts: Options to configure yt-dlp for the download.
         :return: The path to the downloaded video file.
         """
-        self.YDL_OPTS['outtmpl'] = VIDEO_OUTPUT_FILE.format(self.project_id, self.content_id)
-        with yt_dlp.YoutubeDL(self.YDL_OPTS) as ydl:
-            ydl.extract_info(self.url, download=True)
-        return VIDEO_OUTPUT_FILE.format(self.project_id, self.content_id)
+        # Every extractor has its own limiter, a 429 from YouTube doesn't slow down the Vimeo downloads
+        start_time = time.monotonic()
+        output_file = VIDEO_OUTPUT_FILE.format(self.project_id, self.content_id)
+        cache = source_cache.get_cache()
+        cached = False
+        with throttle.get_limiter(f"yt-dlp:{type(self).__name__}").slot():
+            with yt_dlp.YoutubeDL(self.ydl_options()) as ydl:
+                if cache is None:
+                    ydl.extract_info(self.url, download=True)
+                else:
+                    # The format is only known once the formats of the video are listed, the profiles of a video
+                    # select different formats and have their own entries
+                    info = ydl.extract_info(self.url, download=False)
+                    key = f"yt-dlp:{source_url_identity(self.url)}:{info.get('format_id')}"
+                    cached = cache.fetch(key, output_file, lambda _: ydl.process_ie_result(info, download=True))
+        if os.path.exists(output_file) and not cached:
+            metrics.observe_download(f"yt-dlp:{type(self).__name__}", os.path.getsize(output_file),
+                                     time.monotonic() - start_time)
+        return output_file
 
 
 # Downloader for videos hosted on generic URLs.
 class HostedUrlDownloader(BaseDownloader):
     YDL_OPTS = {'outtmpl': VIDEO_OUTPUT_FILE}
 
-    def __init__(self, url, media_type, project_id, content_id):
-        super().__init__(url, media_type, project_id, content_id)
-
 
 # Downloader for YouTube videos.
 class YouTubeDownloader(BaseDownloader):
@@ -122,6 +277,9 @@ class YouTubeDownloader(BaseDownloader):
         'outtmpl': VIDEO_OUTPUT_FILE,
         'format': 'bestvideo[height<=1080][vcodec^=avc]+bestaudio[acodec^=mp4a]/best[height<=1080][vcodec^=avc]',
     }
+    # H.264 decodes faster than VP9 and AV1, the small renditions of those only when there is no H.264 one
+    FILMSTRIP_FORMAT = ('wv[width>={width}][vcodec^=avc]/wv[width>={width}]/w[width>={width}][vcodec^=avc]/'
+                        'best[height<=1080][vcodec^=avc]/b')
 
 
 # Downloader for videos from Vimeo.
@@ -131,6 +289,8 @@ class VimeoDownloader(BaseDownloader):
         'force_generic_extractor': True,
         'format': 'bestvideo[height<=1080][vcodec^=avc1]+bestaudio[acodec^=mp4a]/best[height<=1080][vcodec^=avc1]',
     }
+    # The generic extractor doesn't always report the width of progressive files, those are matched on the height
+    FILMSTRIP_FORMAT = 'wv[width>={width}]/w[width>={width}]/w[height>={width}]/best[height<=1080][vcodec^=avc1]/b'
 
 
 # Downloader for videos from Vimeo.
@@ -139,6 +299,7 @@ class WistiaDownloader(BaseDownloader):
         'outtmpl': VIDEO_OUTPUT_FILE,
         'format': 'bestvideo[vcodec^=h264][height<=1080]+bestaudio/best',
     }
+    FILMSTRIP_FORMAT = 'wv[width>={width}][vcodec^=h264]/wv[width>={width}]/w[width>={width}]/best'
 
 
 # Downloader for Zoom meeting recordings which are not password protected.
@@ -160,18 +321,22 @@ class ImportUrlDownloadFactory:
     }
 
     def __init__(self, import_url=None, import_source_type=ImportSourceType.HOSTED_URL, media_type="VIDEO", project_id=None,
-                 content_id=None):
+                 content_id=None, download_profile=DOWNLOAD_PROFILE_FULL, min_width=FILMSTRIP_TILE_WIDTH):
         """
         Initialize the factory with the import URL and source type.
 
         :param import_url: The URL of the video to be imported.
         :param import_source_type: The source type of the video.
+        :param download_profile: DOWNLOAD_PROFILE_FULL or DOWNLOAD_PROFILE_FILMSTRIP.
+        :param min_width: Minimum width in pixels of the video downloaded with the filmstrip profile.
         """
         self.import_url = import_url
         self.import_source_type = ImportSourceType(import_source_type)
         self.media_type = media_type
         self.project_id = project_id
         self.content_id = content_id
+        self.download_profile = download_profile
+        self.min_width = min_width
 
     def create_downloader(self):
         """
@@ -181,6 +346,7 @@ class ImportUrlDownloadFactory:
         """
         downloader_class = self.DOWNLOADERS.get(self.import_source_type)
         if downloader_class:
-            return downloader_class(self.import_url, self.media_type, self.project_id, self.content_id)
+            return downloader_class(self.import_url, self.media_type, self.project_id, self.content_id,
+                                    self.download_profile, self.min_width)
         else:
             raise NotImplementedError(f"Invalid import source type: {self.import_source_type}")
\ No newline at end of file
@@ -0,0 +1,219 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+METRIC_PREFIX = "filmstrip_"
+# Histogram buckets of durations in seconds and of sizes in bytes, metrics ending in _bytes use the latter
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+BYTES_BUCKETS = tuple(1024 ** 2 * size for size in (0.01, 0.1, 0.5, 1, 5, 10, 50, 100, 500, 1024, 5 * 1024))
+DEFAULT_WRITE_INTERVAL = 15
+
+_lock = threading.Lock()
+_registry = None
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms of one process, keyed by name and labels. Every update is appended to a JSON lines
+    file, and a Prometheus textfile with the current values is rewritten every interval seconds.
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_path=None, interval=DEFAULT_WRITE_INTERVAL):
+        """
+        :param jsonl_path: File every counter increment and observation is appended to as one JSON line.
+        :param prometheus_path: Textfile for the node exporter textfile collector, should end in .prom.
+        :param interval: Seconds between rewrites of the Prometheus textfile.
+        """
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.jsonl_file = open(jsonl_path, "a", buffering=1) if jsonl_path else None
+        self.stop = threading.Event()
+        self.writer = None
+        if prometheus_path:
+            self.writer = threading.Thread(target=self._write_periodically, name="metrics-writer", daemon=True)
+            self.writer.start()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self._append(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(BYTES_BUCKETS if name.endswith("_bytes") else SECONDS_BUCKETS)
+            self.histograms[key].observe(value)
+            self._append(name, value, labels)
+
+    def _append(self, name, value, labels):
+        if self.jsonl_file is not None:
+            self.jsonl_file.write(json.dumps({"time": round(time.time(), 3), "metric": name, "value": value,
+                                              "labels": labels}) + "\n")
+
+    def totals(self, name, label=None):
+        """
+        :return: Sum of the counter or histogram over all labels, or a dictionary of the sums per value of label.
+        """
+        with self.lock:
+            values = [(key, value) for key, value in self.counters.items() if key[0] == name]
+            values += [(key, histogram.sum) for key, histogram in self.histograms.items() if key[0] == name]
+        if label is None:
+            return sum(value for _, value in values)
+        totals = {}
+        for (_, labels), value in values:
+            label_value = dict(labels).get(label)
+            totals[label_value] = totals.get(label_value, 0) + value
+        return totals
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (histogram.buckets, list(histogram.counts), histogram.sum, histogram.count))
+                                for key, histogram in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+                typed.add(name)
+            lines.append(f"{METRIC_PREFIX}{name}{_label_text(labels)} {value}")
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip([*buckets, "+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{METRIC_PREFIX}{name}_bucket{_label_text(labels, le=bound)} {cumulative}")
+            lines.append(f"{METRIC_PREFIX}{name}_sum{_label_text(labels)} {total}")
+            lines.append(f"{METRIC_PREFIX}{name}_count{_label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        if not self.prometheus_path:
+            return
+        # The collector may read the file at any time, it only ever sees a complete one
+        temporary_path = f"{self.prometheus_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(temporary_path, self.prometheus_path)
+
+    def _write_periodically(self):
+        while not self.stop.wait(self.interval):
+            try:
+                self.write_prometheus()
+            except OSError as err:
+                print(f"Could not write the metrics to {self.prometheus_path}: {err}")
+
+    def close(self):
+        self.stop.set()
+        if self.writer is not None:
+            self.writer.join()
+        self.write_prometheus()
+        if self.jsonl_file is not None:
+            with self.lock:
+                self.jsonl_file.close()
+                self.jsonl_file = None
+
+
+def _label_text(labels, **extra):
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in pairs) + "}"
+
+
+def configure(jsonl_path=None, prometheus_path=None, interval=DEFAULT_WRITE_INTERVAL):
+    """
+    Write the metrics of this process to the given files. Without calling this, metrics are still collected in
+    memory for the run summary.
+    """
+    global _registry
+    with _lock:
+        if _registry is not None:
+            _registry.close()
+        _registry = MetricsRegistry(jsonl_path, prometheus_path, interval)
+        return _registry
+
+
+def registry():
+    global _registry
+    with _lock:
+        if _registry is None:
+            _registry = MetricsRegistry()
+        return _registry
+
+
+def close():
+    if _registry is not None:
+        _registry.close()
+
+
+def increment(name, value=1, **labels):
+    registry().increment(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry().observe(name, value, **labels)
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """
+    Observe the seconds the block takes in the histogram name, also when it raises.
+    """
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start_time, **labels)
+
+
+def wait_process(process, start_time):
+    """
+    Wait for a child process started at start_time (time.monotonic()). Unlike RUSAGE_CHILDREN the CPU time covers
+    this process only, not the other children running at the same time.
+
+    :return: Tuple of the return code and a dictionary with the wall and CPU time in seconds.
+    """
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    usage = {"wall_time": time.monotonic() - start_time, "cpu_time": rusage.ru_utime + rusage.ru_stime}
+    return process.returncode, usage
+
+
+def observe_process(usage, name="ffmpeg"):
+    observe(f"{name}_wall_seconds", usage["wall_time"])
+    observe(f"{name}_cpu_seconds", usage["cpu_time"])
+
+
+def observe_download(source, size, seconds):
+    observe("download_bytes", size, source=source)
+    observe("download_seconds", seconds, source=source)
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics_jsonl", type=str, default=None, help="Append every metric update to this file")
+    # e.g. /var/lib/node_exporter/textfile_collector/filmstrip.prom
+    parser.add_argument("--metrics_prom", type=str, default=None, help="Prometheus textfile with the current values")
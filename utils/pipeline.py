@@ -0,0 +1,404 @@
+import functools
+import heapq
+import itertools
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from utils import metrics, throttle
+from utils.dedup import unless_fanned_out
+from utils.cleanup import cleanup_directory
+from utils.filmstrip import (copy_filmstrip, generate_filmstrip, publish_options_from_args, render_filmstrip_sheets,
+                             upload_filmstrip_sheets, upload_filmstrip_to_s3, RENDER_ENGINE_NUMPY)
+
+logger = logging.getLogger(__name__)
+DEFAULT_FETCH_WORKERS = 8
+DEFAULT_RENDER_WORKERS = os.cpu_count() or 1
+DEFAULT_PUBLISH_WORKERS = 4
+# Each queue holds this many jobs per worker of the stage reading from it
+QUEUE_SIZE_PER_WORKER = 2
+# A job failing because a remote target throttled goes back into its stage after a backoff, doubling with every
+# requeue, until it was requeued this many times
+MAX_REQUEUES = 5
+REQUEUE_BACKOFF_SECONDS = 5.0
+# Seconds between the progress lines printed while the pipeline runs
+PROGRESS_INTERVAL_SECONDS = 60
+_STOP = object()
+
+
+class FilmstripJob:
+    """
+    One content item moving through the pipeline, the stages fill in the fields they produce.
+    """
+
+    def __init__(self, project_id, content_id, row=None):
+        self.project_id = project_id
+        self.content_id = content_id
+        self.row = row
+        self.input_file = None
+        # Set by fetches that stream the source, writes it into the stdin of ffmpeg during the render
+        self.input_feed = None
+        # WebP sheets rendered in memory by the numpy engine, None when the sheets are in the output directory
+        self.sheets = None
+        self.render_stats = None
+        # (ETag, size) of an uploaded source, looked up once and shared by the deduplication, the admission estimate
+        # and the source cache key
+        self.source_head = None
+        # (text, segment URLs, bandwidth) of the media playlist of a recording, read once for the admission estimate
+        # and the fetch
+        self.playlist = None
+        # Times the job went back into a stage after a throttling error
+        self.requeues = 0
+        # Set by SourceDeduplicator: the jobs of the same source waiting for this one, or the job whose published
+        # filmstrip this one copies instead of rendering it
+        self.source_identity = None
+        self.followers = []
+        self.fanout_source = None
+        self.fanout_error = None
+
+    def __repr__(self):
+        return f"FilmstripJob({self.project_id}/{self.content_id})"
+
+
+class Stage:
+    def __init__(self, name, func, workers=1):
+        """
+        :param name: Name used in logs and the run summary.
+        :param func: Called with each job, an exception fails the job and drops it from the pipeline. A throttling
+            error (see utils.throttle) requeues the job into the stage instead, up to MAX_REQUEUES times.
+        :param workers: Number of threads running this stage concurrently.
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+
+
+class Pipeline:
+    """
+    Runs jobs through a sequence of stages connected by bounded queues. Every stage has its own worker threads,
+    so downloads, ffmpeg renders and uploads of different jobs run at the same time.
+    """
+
+    def __init__(self, stages, on_finish=None, on_stage_done=None, progress_interval=PROGRESS_INTERVAL_SECONDS):
+        """
+        :param stages: Stages in the order every job goes through them.
+        :param on_finish: Called with the job and the exception (None on success) once a job leaves the pipeline.
+        :param on_stage_done: Called with the job and the stage every time a stage finished a job successfully.
+        :param progress_interval: Seconds between progress lines while the pipeline runs, None for none.
+        """
+        self.stages = stages
+        self.on_finish = on_finish
+        self.on_stage_done = on_stage_done
+        self.progress_interval = progress_interval
+        self.queues = [queue.Queue(maxsize=stage.workers * QUEUE_SIZE_PER_WORKER) for stage in stages]
+        self.lock = threading.Lock()
+        self.running_workers = [stage.workers for stage in stages]
+        self.processed = {stage.name: 0 for stage in stages}
+        self.busy_time = {stage.name: 0.0 for stage in stages}
+        self.failed = {stage.name: 0 for stage in stages}
+        self.requeued = {stage.name: 0 for stage in stages}
+        # Throttled jobs of every stage as (due time, sequence, job), the sequence keeps jobs due at once in order
+        self.delayed = [[] for _ in stages]
+        self.sequence = itertools.count()
+        self.start_time = None
+        self.succeeded = 0
+
+    def run(self, jobs):
+        """
+        Feed the jobs into the first stage and block until every job finished or failed.
+
+        :return: Dictionary with the number of jobs processed, failed and the busy time of every stage.
+        """
+        self.start_time = time.monotonic()
+        stop_progress = threading.Event()
+        if self.progress_interval:
+            threading.Thread(target=self._print_progress, args=(stop_progress,), name="pipeline-progress",
+                             daemon=True).start()
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(index,), name=f"{stage.name}-{worker}", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        for job in jobs:
+            self.queues[0].put(job)
+        for _ in range(self.stages[0].workers):
+            self.queues[0].put(_STOP)
+        for thread in threads:
+            thread.join()
+        stop_progress.set()
+
+        summary = self.progress()
+        summary.update({
+            "processed": dict(self.processed),
+            "failed": dict(self.failed),
+            "requeued": dict(self.requeued),
+            "busy_time": {name: round(busy_time, 3) for name, busy_time in self.busy_time.items()},
+            "failure_reasons": metrics.registry().totals("stage_failures_total", "reason"),
+            "limiters": throttle.summary(),
+        })
+        print(f"Pipeline summary: {summary}")
+        return summary
+
+    def progress(self):
+        """
+        :return: Dictionary with the wall time, the jobs that made it through every stage per second, the share of
+                 the wall time the workers of every stage were busy and the stage with the busiest workers.
+        """
+        wall_time = max(time.monotonic() - self.start_time, 1e-6)
+        with self.lock:
+            utilization = {stage.name: round(self.busy_time[stage.name] / (wall_time * stage.workers), 3)
+                           for stage in self.stages}
+            succeeded = self.succeeded
+        return {
+            "wall_time": round(wall_time, 3),
+            "succeeded": succeeded,
+            "items_per_second": round(succeeded / wall_time, 3),
+            "utilization": utilization,
+            # The stage whose workers are busy the largest share of the time limits the throughput, more workers
+            # there or less work per job speeds the whole pipeline up
+            "bottleneck": max(utilization, key=utilization.get),
+        }
+
+    def _print_progress(self, stop):
+        while not stop.wait(self.progress_interval):
+            print(f"Pipeline progress: {self.progress()}")
+
+    def _work(self, index):
+        stage = self.stages[index]
+        is_last_stage = index == len(self.stages) - 1
+        stopping = False
+        while True:
+            job = self._next_job(index, stopping)
+            if job is None:
+                # Stopped and no throttled job left to retry
+                break
+            if job is _STOP:
+                stopping = True
+                continue
+            start_time = time.monotonic()
+            try:
+                stage.func(job)
+            except Exception as err:
+                if throttle.is_throttling_error(err) and job.requeues < MAX_REQUEUES:
+                    self._requeue(index, job, start_time, err)
+                    continue
+                logger.exception(f"Stage {stage.name} failed for {job}: {err}")
+                metrics.increment("stage_failures_total", stage=stage.name, reason=type(err).__name__)
+                self._count(stage, start_time, failed=True)
+                self._finish(job, err)
+                continue
+            self._count(stage, start_time)
+            self._stage_done(job, stage)
+            if is_last_stage:
+                with self.lock:
+                    self.succeeded += 1
+                self._finish(job, None)
+            else:
+                self.queues[index + 1].put(job)
+
+        # The last worker of a stage to stop tells every worker of the next stage to stop
+        with self.lock:
+            self.running_workers[index] -= 1
+            stop_next_stage = self.running_workers[index] == 0 and not is_last_stage
+        if stop_next_stage:
+            for _ in range(self.stages[index + 1].workers):
+                self.queues[index + 1].put(_STOP)
+
+    def _next_job(self, index, stopping):
+        """
+        Return the next job of the stage, throttled jobs once their backoff is over, or None when the worker got
+        _STOP and no throttled job of the stage is left.
+        """
+        while True:
+            with self.lock:
+                delayed = self.delayed[index]
+                if delayed and delayed[0][0] <= time.monotonic():
+                    return heapq.heappop(delayed)[2]
+                wait = delayed[0][0] - time.monotonic() if delayed else None
+            if stopping:
+                if wait is None:
+                    return None
+                time.sleep(max(0.0, wait))
+                continue
+            try:
+                return self.queues[index].get(timeout=wait)
+            except queue.Empty:
+                continue
+
+    def _requeue(self, index, job, start_time, err):
+        stage = self.stages[index]
+        # Jitter keeps the throttled jobs from coming back all at once
+        delay = REQUEUE_BACKOFF_SECONDS * 2 ** job.requeues * random.uniform(0.5, 1.5)
+        job.requeues += 1
+        print(f"Stage {stage.name} was throttled for {job}, requeueing it in {delay:.1f}s "
+              f"({job.requeues}/{MAX_REQUEUES}): {err}")
+        with self.lock:
+            self.busy_time[stage.name] += time.monotonic() - start_time
+            self.requeued[stage.name] += 1
+            heapq.heappush(self.delayed[index], (time.monotonic() + delay, next(self.sequence), job))
+
+    def _count(self, stage, start_time, failed=False):
+        metrics.observe("stage_seconds", time.monotonic() - start_time, stage=stage.name)
+        metrics.increment("stage_jobs_total", stage=stage.name, outcome="failed" if failed else "succeeded")
+        with self.lock:
+            self.processed[stage.name] += 1
+            self.busy_time[stage.name] += time.monotonic() - start_time
+            if failed:
+                self.failed[stage.name] += 1
+
+    def _stage_done(self, job, stage):
+        if self.on_stage_done is None:
+            return
+        try:
+            self.on_stage_done(job, stage)
+        except Exception as err:
+            logger.exception(f"Recording stage {stage.name} of {job} failed: {err}")
+
+    def _finish(self, job, err):
+        if self.on_finish is None:
+            return
+        try:
+            self.on_finish(job, err)
+        except Exception as finish_err:
+            logger.exception(f"Finishing {job} failed: {finish_err}")
+
+
+def add_pipeline_arguments(parser, fetch_workers=DEFAULT_FETCH_WORKERS, render_workers=DEFAULT_RENDER_WORKERS,
+                           publish_workers=DEFAULT_PUBLISH_WORKERS):
+    parser.add_argument("--fetch_workers", type=int, default=fetch_workers)
+    parser.add_argument("--render_workers", type=int, default=render_workers)
+    parser.add_argument("--publish_workers", type=int, default=publish_workers)
+
+
+def jobs_from_rows(rows, project_column, content_column):
+    for row in rows:
+        yield FilmstripJob(row[project_column], row[content_column], row)
+
+
+def discover_jobs(row_batches, project_column, content_column, filters=()):
+    """
+    Turn batches of rows into jobs as the batches arrive, every filter drops the rows that need no work.
+
+    :param row_batches: Iterable of lists of rows, e.g. from utils.db.stream_row_batches.
+    :param filters: Callables taking (rows, project_column, content_column) and returning the rows to keep.
+    """
+    total_rows = 0
+    pending_rows = 0
+    for rows in row_batches:
+        total_rows += len(rows)
+        for row_filter in filters:
+            rows = row_filter(rows, project_column, content_column)
+        pending_rows += len(rows)
+        print(f"Discovered {total_rows} rows, {pending_rows} pending")
+        yield from jobs_from_rows(rows, project_column, content_column)
+
+
+def render_job(render_options, job):
+    if render_options.get("render_engine") == RENDER_ENGINE_NUMPY:
+        # The sheets stay in memory until the publish stage uploads them
+        job.sheets, job.render_stats = render_filmstrip_sheets(
+            job.input_file, job.project_id, job.content_id, webp_preset=render_options["webp_preset"],
+            sampling_mode=render_options["sampling_mode"], sampling_tolerance=render_options["sampling_tolerance"],
+            feed_input=job.input_feed,
+        )
+    else:
+        job.render_stats = generate_filmstrip(job.input_file, job.project_id, job.content_id,
+                                              feed_input=job.input_feed, **render_options)
+    metrics.increment("sheets_total", job.render_stats["sheets"], engine=job.render_stats["render_engine"])
+    metrics.observe("ffmpeg_job_cpu_seconds", job.render_stats["ffmpeg_cpu_time"])
+    # ffmpeg exits cleanly on a video without a decodable frame, don't publish an empty filmstrip
+    if not job.render_stats["sheets"]:
+        raise RuntimeError(f"No filmstrip sheets were rendered for {job}")
+
+
+def publish_job(publish_options, deduplicator, job):
+    if job.fanout_source is not None:
+        # The source was published by another job of the run, its filmstrip is copied server side
+        fan_out(deduplicator, job.fanout_source, [job])
+        if job.fanout_error is not None:
+            raise job.fanout_error
+        return
+    if job.sheets is not None:
+        upload_filmstrip_sheets(job.project_id, job.content_id, job.sheets, **publish_options)
+        job.sheets = None
+    else:
+        upload_filmstrip_to_s3(job.project_id, job.content_id, **publish_options)
+    if deduplicator is not None:
+        deduplicator.close(job, published=True)
+        fan_out(deduplicator, job, job.followers)
+
+
+def fan_out(deduplicator, source, jobs):
+    for job in jobs:
+        job.fanout_error = None
+        try:
+            copy_filmstrip(source.project_id, source.content_id, job.project_id, job.content_id)
+        except Exception as err:
+            logger.exception(f"Copying the filmstrip of {source} to {job} failed: {err}")
+            job.fanout_error = err
+        deduplicator.record_copy(job.fanout_error)
+
+
+def cleanup_job(job, err):
+    cleanup_directory(job.project_id, job.content_id)
+
+
+def finish_job(journal, admission, work_queue, watermark, deduplicator, job, err):
+    if deduplicator is not None:
+        deduplicator.close(job, published=False)
+    # Followers finish with the job, they fail with it when it failed before its filmstrip could be copied
+    for follower in job.followers:
+        follower_err = err if err is not None else follower.fanout_error
+        if journal is not None and follower_err is None:
+            # Followers skip the publish stage that records the upload, their filmstrip was copied by the job's
+            journal.mark_uploaded([(follower.project_id, follower.content_id)])
+        finish_job(journal, admission, work_queue, watermark, None, follower, follower_err)
+    if journal is not None:
+        journal.record_finish(job, err)
+    if watermark is not None:
+        watermark.record_finish(job, err)
+    cleanup_job(job, err)
+    # Released after the cleanup, the scratch space of the job is free again by then
+    if admission is not None:
+        admission.release(job)
+    # Acknowledged last, another worker must not lease the item while its scratch directory still exists here
+    if work_queue is not None:
+        work_queue.ack(job, err)
+
+
+def filmstrip_pipeline(fetch, render_options, args, journal=None, admission=None, work_queue=None, watermark=None,
+                       deduplicator=None):
+    """
+    Build the fetch -> render -> publish pipeline shared by the entry scripts.
+
+    :param fetch: Source specific function that sets job.input_file.
+    :param render_options: Keyword arguments for generate_filmstrip.
+    :param args: Parsed arguments of add_pipeline_arguments.
+    :param journal: Optional JobJournal recording the progress of every job.
+    :param admission: Optional AdmissionController, jobs then go through an admit stage before the fetch.
+    :param work_queue: Optional WorkQueue the jobs were leased from, every finished job is acknowledged to it.
+    :param watermark: Optional Watermark of an incremental run, failed jobs hold it back.
+    :param deduplicator: Optional SourceDeduplicator the jobs are filtered with, jobs of a source rendered by
+        another job only run the publish stage.
+    """
+    render = functools.partial(render_job, render_options)
+    if deduplicator is not None:
+        fetch = unless_fanned_out(fetch)
+        render = unless_fanned_out(render)
+    stages = [
+        Stage("fetch", fetch, args.fetch_workers),
+        Stage("render", render, args.render_workers),
+        Stage("publish", functools.partial(publish_job, publish_options_from_args(args), deduplicator),
+              args.publish_workers),
+    ]
+    if admission is not None:
+        admit = admission.admit if deduplicator is None else unless_fanned_out(admission.admit)
+        stages.insert(0, Stage("admit", admit, args.admission_workers))
+    on_finish = functools.partial(finish_job, journal, admission, work_queue, watermark, deduplicator)
+    return Pipeline(stages, on_finish=on_finish,
+                    on_stage_done=journal.record_stage if journal is not None else None)
@@ -1,53 +1,449 @@
 import asyncio
+import functools
 import os
-from urllib.parse import urljoin
+import re
+import statistics
+import threading
+import time
+from urllib.parse import urljoin, urlparse
 
 import aiohttp
 import requests
 
+from utils import metrics, source_cache, throttle
+
 OUTPUT_DIR = "downloads/{}/{}"
+HLS_BASE_URL = "{}/{}/vod/{}/{}/hls/{}"
+MASTER_PLAYLIST = "master.m3u8"
+# Rendition used when the master playlist can't be read or lists no rendition wide enough
+DEFAULT_RENDITION_PLAYLIST = "1500.m3u8"
+DEFAULT_RENDITION_BANDWIDTH = 1500 * 1000
+PLAYLIST_TIMEOUT = 30
+# Segment length assumed for playlists without #EXTINF durations
+DEFAULT_SEGMENT_SECONDS = 6
+MAX_CONNECTIONS = 64
+MAX_CONNECTIONS_PER_HOST = 16
+# Segments are read and written in large blocks, file writes run in a thread so they never block the event loop
+SEGMENT_BUFFER_SIZE = 1024 * 1024
+SEGMENT_RETRIES = 4
+# Other 4xx answers, e.g. 403 or 404, won't change on a retry
+RETRIED_CLIENT_STATUSES = {408, 429}
+RETRY_BACKOFF_SECONDS = 0.5
+SEGMENT_CONNECT_TIMEOUT = 10
+SEGMENT_READ_TIMEOUT = 30
+# A segment taking HEDGE_DELAY_FACTOR times the median segment time of its broadcast gets a second request,
+# whichever finishes first is kept
+HEDGE_DELAY_FACTOR = 3
+HEDGE_MIN_DELAY = 2.0
+HEDGE_MIN_SAMPLES = 5
+# Segments downloaded ahead of the one being piped into ffmpeg when streaming a recording
+STREAM_WINDOW_SEGMENTS = 8
+
+
+class SegmentFetcher:
+    """
+    Downloads HLS segments on one event loop running in a background thread, with one connection pooled
+    aiohttp session shared by every broadcast of the run. fetch() can be called from any thread.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_connections_per_host=MAX_CONNECTIONS_PER_HOST,
+                 retries=SEGMENT_RETRIES):
+        self.max_connections_per_host = max_connections_per_host
+        self.retries = retries
+        # Host -> semaphore shared by every broadcast fetched from the host, created and used on the event loop
+        self.semaphores = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="segment-fetcher", daemon=True)
+        self.thread.start()
+        self.session = self._run(self._create_session(max_connections, max_connections_per_host))
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _create_session(self, max_connections, max_connections_per_host):
+        connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_connections_per_host,
+                                         ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=SEGMENT_CONNECT_TIMEOUT,
+                                        sock_read=SEGMENT_READ_TIMEOUT)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, read_bufsize=SEGMENT_BUFFER_SIZE)
+
+    def fetch(self, urls, output_dir):
+        """
+        Download the segments into the output directory, named after the last part of their URL.
+
+        :return: Dictionary with the number of segments, bytes, seconds, hedged requests and the throughput.
+        """
+        return self._timed(self._fetch_all, urls, output_dir)
+
+    def stream(self, urls, write, window=STREAM_WINDOW_SEGMENTS):
+        """
+        Download the segments into memory, at most window of them ahead of the one being written, and pass them
+        to write in playlist order. write may block, e.g. on the stdin of ffmpeg, which throttles the download.
+
+        :return: Same dictionary as fetch.
+        """
+        return self._timed(self._stream_all, urls, write, window)
+
+    def _timed(self, fetch_all, urls, *args):
+        start_time = time.monotonic()
+        stats = {"segments": len(urls), "bytes": 0, "hedged": 0, "cached": 0}
+        self._run(fetch_all(urls, *args, stats))
+        seconds = max(time.monotonic() - start_time, 1e-6)
+        stats["seconds"] = round(seconds, 3)
+        stats["segments_per_second"] = round(len(urls) / seconds, 2)
+        stats["mb_per_second"] = round(stats["bytes"] / seconds / (1024 * 1024), 2)
+        return stats
+
+    def _semaphore(self, url):
+        host = urlparse(url).netloc
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.max_connections_per_host)
+        return self.semaphores[host]
+
+    async def _fetch_all(self, urls, output_dir, stats):
+        durations = []
+        tasks = [
+            self._fetch_segment(url, os.path.join(output_dir, url.split("/")[-1]), durations, stats)
+            for url in urls
+        ]
+        await asyncio.gather(*tasks)
+
+    async def _stream_all(self, urls, write, window, stats):
+        durations = []
+        tasks = {}
+
+        def schedule(index):
+            if index < len(urls):
+                tasks[index] = asyncio.ensure_future(self._read_segment(urls[index], durations, stats))
+
+        for index in range(window):
+            schedule(index)
+        try:
+            for index in range(len(urls)):
+                data = await tasks.pop(index)
+                schedule(index + window)
+                await asyncio.to_thread(write, data)
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
 
+    def _hedge_delay(self, durations):
+        if len(durations) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY, HEDGE_DELAY_FACTOR * statistics.median(durations))
 
-async def download_ts_file(session, url, output_dir):
-    filename = os.path.join(output_dir, url.split("/")[-1])
-    async with session.get(url) as response:
-        with open(filename, "wb") as f:
+    async def _hedged(self, attempt, durations, stats):
+        """
+        Run attempt(0), and attempt(1) next to it once the first one takes longer than the hedge delay.
+
+        :return: Tuple of the index and the result of the attempt that succeeded first.
+        """
+        start_time = time.monotonic()
+        attempts = [asyncio.ensure_future(attempt(0))]
+        done, _ = await asyncio.wait(attempts, timeout=self._hedge_delay(durations))
+        if not done:
+            stats["hedged"] += 1
+            attempts.append(asyncio.ensure_future(attempt(1)))
+
+        pending = set(attempts)
+        winner = None
+        error = None
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if winner is None:
+            raise error
+        durations.append(time.monotonic() - start_time)
+        return attempts.index(winner), winner.result()
+
+    async def _fetch_segment(self, url, filename, durations, stats):
+        # Segment URLs of a recording never change their content, the URL is the cache key
+        cache = source_cache.get_cache()
+        if cache is not None and await asyncio.to_thread(cache.get, f"hls:{url}", filename):
+            stats["cached"] += 1
+            return
+        temporary_files = [f"{filename}.part", f"{filename}.hedge"]
+        async with self._semaphore(url):
+            try:
+                index, size = await self._hedged(lambda i: self._download(url, temporary_files[i]), durations, stats)
+                await asyncio.to_thread(os.replace, temporary_files[index], filename)
+            finally:
+                for temporary_file in temporary_files:
+                    if os.path.exists(temporary_file):
+                        await asyncio.to_thread(os.remove, temporary_file)
+        if cache is not None:
+            await asyncio.to_thread(cache.put, f"hls:{url}", filename)
+        stats["bytes"] += size
+
+    async def _read_segment(self, url, durations, stats):
+        cache = source_cache.get_cache()
+        if cache is not None:
+            data = await asyncio.to_thread(cache.read, f"hls:{url}")
+            if data is not None:
+                stats["cached"] += 1
+                return data
+        buffers = [bytearray(), bytearray()]
+        async with self._semaphore(url):
+            index, _ = await self._hedged(lambda i: self._download(url, buffers[i]), durations, stats)
+        data = bytes(buffers[index])
+        if cache is not None:
+            await asyncio.to_thread(cache.put_bytes, f"hls:{url}", data)
+        stats["bytes"] += len(data)
+        return data
+
+    async def _download(self, url, target):
+        """
+        Download one segment into a file name or a bytearray, retries resume from the bytes already received with a
+        range request.
+
+        :return: Size of the segment in bytes.
+        """
+        in_memory = isinstance(target, bytearray)
+        for attempt in range(self.retries + 1):
+            if in_memory:
+                offset = len(target)
+            else:
+                offset = os.path.getsize(target) if os.path.exists(target) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            try:
+                async with self._limiter(url).async_slot():
+                    async with self.session.get(url, headers=headers) as response:
+                        if offset and response.status == 416:
+                            # Everything was received by the previous attempt
+                            return offset
+                        response.raise_for_status()
+                        if response.status != 206:
+                            offset = 0
+                        if not in_memory:
+                            return await self._write_response(response, target, offset)
+                        del target[offset:]
+                        async for chunk in response.content.iter_chunked(SEGMENT_BUFFER_SIZE):
+                            target += chunk
+                        return len(target)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                if attempt == self.retries or not is_retryable_error(err):
+                    raise
+                print(f"Retrying {url} after attempt {attempt + 1} failed: {err}")
+                await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+    def _limiter(self, url):
+        # The limit of a host never goes above the connections the session keeps to it
+        return throttle.get_limiter(f"hls:{urlparse(url).netloc}", throttle.AsyncAimdLimiter,
+                                    maximum=self.max_connections_per_host)
+
+    async def _write_response(self, response, filename, offset):
+        f = await asyncio.to_thread(open, filename, "ab" if offset else "wb")
+        try:
+            buffer = bytearray()
             while True:
-                chunk = await response.content.read(1024)
+                chunk = await response.content.read(SEGMENT_BUFFER_SIZE)
+                if chunk:
+                    buffer += chunk
+                if buffer and (not chunk or len(buffer) >= SEGMENT_BUFFER_SIZE):
+                    await asyncio.to_thread(f.write, bytes(buffer))
+                    offset += len(buffer)
+                    buffer = bytearray()
                 if not chunk:
                     break
-                f.write(chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+        return offset
 
+    def close(self):
+        self._run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
 
-async def download_all_ts_files(ts_urls, output_dir):
-    async with aiohttp.ClientSession() as session:
-        tasks = [download_ts_file(session, url, output_dir) for url in ts_urls]
-        await asyncio.gather(*tasks)
 
+def is_retryable_error(err):
+    # Network errors, timeouts, 5xx and throttling answers
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status >= 500 or err.status in RETRIED_CLIENT_STATUSES
+    return True
+
+
+_segment_fetcher = None
+_segment_fetcher_lock = threading.Lock()
+
+
+def get_segment_fetcher():
+    # One fetcher, and therefore one connection pool, for every broadcast of the run
+    global _segment_fetcher
+    with _segment_fetcher_lock:
+        if _segment_fetcher is None:
+            _segment_fetcher = SegmentFetcher()
+        return _segment_fetcher
+
+
+def close_segment_fetcher():
+    global _segment_fetcher
+    with _segment_fetcher_lock:
+        if _segment_fetcher is not None:
+            _segment_fetcher.close()
+            _segment_fetcher = None
 
-def download_m3u8_and_ts_files(event_id, broadcast_id, env, simulive_server):
-    m3u8_url = f"{simulive_server}/{env}/vod/{event_id}/{broadcast_id}/hls/1500.m3u8"
-    output_directory = OUTPUT_DIR.format(event_id, broadcast_id)
-    os.makedirs(output_directory, exist_ok=True)
 
+def recording_hls_url(event_id, broadcast_id, env, simulive_server, playlist):
+    return HLS_BASE_URL.format(simulive_server, env, event_id, broadcast_id, playlist)
+
+
+def parse_master_playlist(master_url, master_content):
+    """
+    :return: List of dictionaries with the absolute URL, bandwidth in bits/s, width and height of every rendition,
+             width and height are None when the playlist doesn't list a resolution.
+    """
+    renditions = []
+    attributes = None
+    for line in master_content.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            # Quoted values like CODECS="avc1.4d401f,mp4a.40.2" contain commas, drop them before splitting
+            attributes = dict(
+                attribute.split("=", 1)
+                for attribute in re.sub(r'"[^"]*"', '""', line.partition(":")[2]).split(",")
+                if "=" in attribute
+            )
+        elif line and not line.startswith("#") and attributes is not None:
+            width, _, height = attributes.get("RESOLUTION", "").partition("x")
+            renditions.append({
+                "url": urljoin(master_url, line),
+                "bandwidth": int(attributes.get("BANDWIDTH", 0)),
+                "width": int(width) if width.isdigit() else None,
+                "height": int(height) if height.isdigit() else None,
+            })
+            attributes = None
+    return renditions
+
+
+def select_rendition(renditions, min_width):
+    # The cheapest rendition that still has enough pixels for the filmstrip tiles
+    candidates = [rendition for rendition in renditions if rendition["width"] and rendition["width"] >= min_width]
+    return min(candidates, key=lambda rendition: rendition["bandwidth"], default=None)
+
+
+def playlist_duration(m3u8_content):
+    return sum(
+        float(line.partition(":")[2].split(",")[0])
+        for line in m3u8_content.splitlines() if line.startswith("#EXTINF:")
+    )
+
+
+def recording_playlist_url(event_id, broadcast_id, env, simulive_server, min_width=None):
+    """
+    Pick the media playlist of a recording. Without min_width, or when no rendition of the master playlist is at
+    least min_width pixels wide, this is the DEFAULT_RENDITION_PLAYLIST.
+
+    :return: Tuple of the media playlist URL and the bandwidth of the chosen and the default rendition in bits/s.
+    """
+    default_url = recording_hls_url(event_id, broadcast_id, env, simulive_server, DEFAULT_RENDITION_PLAYLIST)
+    if min_width is None:
+        return default_url, DEFAULT_RENDITION_BANDWIDTH, DEFAULT_RENDITION_BANDWIDTH
+
+    master_url = recording_hls_url(event_id, broadcast_id, env, simulive_server, MASTER_PLAYLIST)
+    try:
+        master_response = requests.get(master_url, timeout=PLAYLIST_TIMEOUT)
+        master_response.raise_for_status()
+        renditions = parse_master_playlist(master_url, master_response.text)
+    except Exception as ex:
+        print(f"Could not read the master playlist {master_url}, using {DEFAULT_RENDITION_PLAYLIST}: {ex}")
+        return default_url, DEFAULT_RENDITION_BANDWIDTH, DEFAULT_RENDITION_BANDWIDTH
+
+    default_bandwidth = next(
+        (rendition["bandwidth"] for rendition in renditions if rendition["url"] == default_url),
+        DEFAULT_RENDITION_BANDWIDTH,
+    )
+    rendition = select_rendition(renditions, min_width)
+    if rendition is None:
+        print(f"No rendition of {master_url} is {min_width}px wide, using {DEFAULT_RENDITION_PLAYLIST}")
+        return default_url, default_bandwidth, default_bandwidth
+    return rendition["url"], rendition["bandwidth"], default_bandwidth
+
+
+def read_recording_playlist(event_id, broadcast_id, env, simulive_server, min_width=None):
+    """
+    :return: Tuple of the media playlist text, the absolute URLs of its TS segments and the bandwidth of its rendition
+             in bits/s.
+    """
+    m3u8_url, bandwidth, default_bandwidth = recording_playlist_url(event_id, broadcast_id, env, simulive_server,
+                                                                    min_width)
+    default_url = recording_hls_url(event_id, broadcast_id, env, simulive_server, DEFAULT_RENDITION_PLAYLIST)
+    if m3u8_url != default_url:
+        try:
+            m3u8_content, ts_urls = read_playlist(m3u8_url)
+            if not ts_urls:
+                raise ValueError("the playlist lists no segments")
+        except Exception as ex:
+            # Every recording was migrated from the default rendition before renditions were picked
+            print(f"Could not use {m3u8_url} for {event_id}/{broadcast_id}, using {DEFAULT_RENDITION_PLAYLIST}: {ex}")
+            m3u8_url, bandwidth = default_url, default_bandwidth
+    if m3u8_url == default_url:
+        m3u8_content, ts_urls = read_playlist(m3u8_url)
+    if ts_urls and bandwidth != default_bandwidth:
+        duration = playlist_duration(m3u8_content)
+        bytes_saved = int((default_bandwidth - bandwidth) * duration / 8)
+        print(f"Using {m3u8_url} for {event_id}/{broadcast_id} ({bandwidth} bits/s), saves about {bytes_saved} "
+              f"bytes over {duration:.0f}s compared to {DEFAULT_RENDITION_PLAYLIST}")
+    return m3u8_content, ts_urls, bandwidth
+
+
+def read_playlist(m3u8_url):
+    """
+    :return: Tuple of the playlist text and the absolute URLs of its TS segments.
+    """
     try:
-        m3u8_response = requests.get(m3u8_url)
+        m3u8_response = requests.get(m3u8_url, timeout=PLAYLIST_TIMEOUT)
     except Exception as ex:
         print(f"Exception in opening the url: {m3u8_url} \n{ex}")
         raise ex
+    # A throttled or failed request must not read as a playlist without segments
+    m3u8_response.raise_for_status()
     m3u8_content = m3u8_response.text
 
     # Extract the URLs of the TS files
     ts_urls = [urljoin(m3u8_url, line.strip()) for line in m3u8_content.splitlines() if line.endswith(".ts")]
+    return m3u8_content, ts_urls
 
+
+def estimate_recording_bytes(playlist):
+    """
+    Estimate the download size of a recording from the bandwidth of its rendition and the length of its playlist.
+
+    :param playlist: Tuple returned by read_recording_playlist.
+    """
+    m3u8_content, ts_urls, bandwidth = playlist
+    duration = playlist_duration(m3u8_content) or len(ts_urls) * DEFAULT_SEGMENT_SECONDS
+    return int(bandwidth * duration / 8)
+
+
+def print_fetch_stats(event_id, broadcast_id, stats):
+    print(f"Fetched {stats['segments']} segments ({stats['bytes']} bytes) of {event_id}/{broadcast_id} in "
+          f"{stats['seconds']}s: {stats['segments_per_second']} segments/s, {stats['mb_per_second']} MB/s, "
+          f"{stats['hedged']} hedged, {stats['cached']} cached")
+
+
+def download_m3u8_and_ts_files(event_id, broadcast_id, playlist):
+    """
+    :param playlist: Tuple returned by read_recording_playlist.
+    """
+    output_directory = OUTPUT_DIR.format(event_id, broadcast_id)
+    os.makedirs(output_directory, exist_ok=True)
+
+    m3u8_content, ts_urls, _ = playlist
     if not ts_urls:
         return None
 
     # Download the TS files
-    try:
-        asyncio.run(download_all_ts_files(ts_urls, output_directory))
-    except Exception as e:
-        raise e
+    stats = get_segment_fetcher().fetch(ts_urls, output_directory)
+    print_fetch_stats(event_id, broadcast_id, stats)
+    metrics.observe_download("hls", stats["bytes"], stats["seconds"])
 
     # Update the M3U8 file to refer to the local TS files
     local_m3u8_content = ""
@@ -61,3 +457,24 @@ def download_m3u8_and_ts_files(event_id, broadcast_id, env, simulive_server):
     with open(local_m3u8_filename, "w") as f:
         f.write(local_m3u8_content)
     return local_m3u8_filename
+
+
+def pipe_ts_files(event_id, broadcast_id, ts_urls, stdin):
+    stats = get_segment_fetcher().stream(ts_urls, stdin.write)
+    print_fetch_stats(event_id, broadcast_id, stats)
+    # Includes the time spent waiting on ffmpeg to read the stream
+    metrics.observe_download("hls_stream", stats["bytes"], stats["seconds"])
+
+
+def stream_m3u8_and_ts_files(event_id, broadcast_id, playlist):
+    """
+    Download nothing yet, the segments of the playlist are fetched while ffmpeg reads them.
+
+    :param playlist: Tuple returned by read_recording_playlist.
+    :return: Function writing the TS segments in playlist order into the file object it is called with, usually the
+             stdin of ffmpeg, or None if the playlist has no segments.
+    """
+    _, ts_urls, _ = playlist
+    if not ts_urls:
+        return None
+    return functools.partial(pipe_ts_files, event_id, broadcast_id, ts_urls)
@@ -0,0 +1,123 @@
+import collections
+import contextlib
+import itertools
+import os
+import threading
+
+CPU_COUNT = os.cpu_count() or 1
+DEFAULT_FFMPEG_THREADS = 2
+
+_render_slots = None
+
+
+class RenderSlots:
+    """
+    Caps the number of ffmpeg processes running at once. Every process gets an explicit decode and filter thread
+    budget, and optionally a niceness and the CPUs of its slot.
+    """
+
+    def __init__(self, slots, threads, nice=None, pin=False):
+        """
+        :param slots: Maximum number of concurrent ffmpeg processes.
+        :param threads: Decoder and filter threads of every process.
+        :param nice: Niceness of the processes, None to keep the one of this process.
+        :param pin: Pin the process of slot i to CPUs i * threads to (i + 1) * threads - 1, wrapping around.
+        """
+        self.slots = max(1, slots)
+        self.threads = max(1, threads)
+        self.nice = nice
+        self.pin = pin
+        self.condition = threading.Condition()
+        self.free = list(range(self.slots))
+        # Tickets of the waiting acquirers in arrival order, slots are handed out first come first served so single
+        # slot acquirers can't keep a sharded render waiting for several free slots forever
+        self.tickets = itertools.count()
+        self.waiting = collections.deque()
+
+    @contextlib.contextmanager
+    def acquire(self, count=1):
+        """
+        Block until count slots are free, at most all of them, and every earlier acquirer got its slots. Hold them
+        while the block runs.
+
+        :return: List of the slot numbers held.
+        """
+        count = min(max(1, count), self.slots)
+        with self.condition:
+            ticket = next(self.tickets)
+            self.waiting.append(ticket)
+            try:
+                while self.waiting[0] != ticket or len(self.free) < count:
+                    self.condition.wait()
+            except BaseException:
+                # An interrupted acquirer leaves the line, the ones behind it must not wait for it forever
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+                raise
+            self.waiting.popleft()
+            held = self.free[:count]
+            del self.free[:count]
+            # The next acquirer in line may fit into the slots that are left
+            self.condition.notify_all()
+        try:
+            yield held
+        finally:
+            with self.condition:
+                self.free.extend(held)
+                self.condition.notify_all()
+
+    def slot_cpus(self, slot):
+        return sorted({(slot * self.threads + offset) % CPU_COUNT for offset in range(self.threads)})
+
+    def command(self, slot, cmd):
+        prefix = []
+        if self.pin:
+            prefix += ["taskset", "-c", ",".join(str(cpu) for cpu in self.slot_cpus(slot))]
+        if self.nice is not None:
+            prefix += ["nice", "-n", str(self.nice)]
+        # -threads before the first input sets the decoder threads of that input
+        return [*prefix, cmd[0], "-threads", str(self.threads), "-filter_threads", str(self.threads), *cmd[1:]]
+
+
+def configure(slots=None, threads=DEFAULT_FFMPEG_THREADS, nice=None, pin=False):
+    """
+    Schedule the ffmpeg processes of this process, by default with as many slots as the thread budget fits into the
+    cores. Without calling this, ffmpeg runs unscheduled with its own thread defaults.
+    """
+    global _render_slots
+    if slots is None:
+        slots = CPU_COUNT // max(1, threads)
+    _render_slots = RenderSlots(slots, threads, nice, pin)
+    return _render_slots
+
+
+def reset():
+    global _render_slots
+    _render_slots = None
+
+
+@contextlib.contextmanager
+def acquire(count=1):
+    """
+    Hold render slots while the block runs ffmpeg, yields the slot numbers for slot_command. Yields count
+    unscheduled slots (None) when the scheduler is not configured.
+    """
+    if _render_slots is None:
+        yield [None] * max(1, count)
+        return
+    with _render_slots.acquire(count) as held:
+        yield held
+
+
+def slot_command(slot, cmd):
+    if slot is None or _render_slots is None:
+        return cmd
+    return _render_slots.command(slot, cmd)
+
+
+def add_render_slot_arguments(parser):
+    # Concurrent ffmpeg processes, by default the number of cores divided by --ffmpeg_threads
+    parser.add_argument("--render_slots", type=int, default=None)
+    parser.add_argument("--ffmpeg_threads", type=int, default=DEFAULT_FFMPEG_THREADS)
+    parser.add_argument("--ffmpeg_nice", type=int, default=None)
+    parser.add_argument("--pin_ffmpeg", action="store_true")
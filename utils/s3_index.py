@@ -0,0 +1,103 @@
+import functools
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import aws, metrics
+from utils.filmstrip import FILMSTRIP_INDEX_FILE, FILMSTRIP_INDEX_KEY, S3_KEY_BASE_PATH, STATIC_ASSETS_BUCKET, \
+    check_file_in_s3
+
+FILMSTRIP_PROJECT_PREFIX = "content-lab/filmstrip/{}/"
+NUM_PARALLEL_LISTINGS = 10
+# An index file no larger than one without any sheet is treated as missing, same as check_file_in_s3 does
+EMPTY_INDEX_SIZE = len(json.dumps({FILMSTRIP_INDEX_KEY: []}, indent=4))
+
+
+def list_project_filmstrips(s3, bucket_name, project_id):
+    """
+    List the filmstrip prefix of one project and collect the contents that have a non-empty index file.
+
+    :return: Set of (project_id, content_id) tuples.
+    """
+    prefix = FILMSTRIP_PROJECT_PREFIX.format(project_id)
+    completed = set()
+    paginator = s3.get_paginator('list_objects_v2')
+    with metrics.timer("s3_probe_seconds", operation="list_objects"):
+        pages = list(paginator.paginate(Bucket=bucket_name, Prefix=prefix))
+    for page in pages:
+        for s3_object in page.get('Contents', []):
+            key_parts = s3_object['Key'][len(prefix):].split('/')
+            if len(key_parts) == 2 and key_parts[1] == FILMSTRIP_INDEX_FILE and s3_object['Size'] > EMPTY_INDEX_SIZE:
+                completed.add((str(project_id), key_parts[0]))
+    return completed
+
+
+def verify_completed_sample(bucket_name, completed, sample_size):
+    """
+    Read and parse the index file of a random sample of the completed filmstrips.
+
+    :return: The completed set without the sampled filmstrips whose index file is invalid.
+    """
+    sample = random.sample(sorted(completed), min(sample_size, len(completed)))
+    with ThreadPoolExecutor(max_workers=NUM_PARALLEL_LISTINGS) as executor:
+        results = list(executor.map(
+            lambda pair: check_file_in_s3(bucket_name, S3_KEY_BASE_PATH.format(*pair, FILMSTRIP_INDEX_FILE)),
+            sample,
+        ))
+    invalid = {pair for pair, is_valid in zip(sample, results) if not is_valid}
+    print(f"Deep verified {len(sample)} filmstrip index files, {len(invalid)} invalid")
+    return completed - invalid
+
+
+class CompletedFilmstripIndex:
+    """
+    Set of completed filmstrips, filled with one paginated listing per project the first time a project shows up
+    in a batch of rows.
+    """
+
+    def __init__(self, bucket_name=STATIC_ASSETS_BUCKET, deep_verify_sample=0, on_completed=None):
+        """
+        :param bucket_name: Bucket the filmstrips are stored in.
+        :param deep_verify_sample: Number of listed index files to read and validate over the run, 0 to skip.
+        :param on_completed: Called with the (project_id, content_id) pairs of the rows filtered out as completed.
+        """
+        self.bucket_name = bucket_name
+        self.remaining_verifications = deep_verify_sample
+        self.on_completed = on_completed
+        self.listed_projects = set()
+        self.completed = set()
+
+    def add_projects(self, project_ids):
+        s3 = aws.s3_client()
+        project_ids = sorted({str(project_id) for project_id in project_ids} - self.listed_projects)
+        if not project_ids:
+            return
+        completed = set()
+        with ThreadPoolExecutor(max_workers=NUM_PARALLEL_LISTINGS) as executor:
+            for project_completed in executor.map(functools.partial(list_project_filmstrips, s3, self.bucket_name),
+                                                  project_ids):
+                completed |= project_completed
+        print(f"Found {len(completed)} completed filmstrips in {len(project_ids)} projects")
+        if self.remaining_verifications > 0 and completed:
+            sample_size = min(self.remaining_verifications, len(completed))
+            self.remaining_verifications -= sample_size
+            completed = verify_completed_sample(self.bucket_name, completed, sample_size)
+        self.listed_projects.update(project_ids)
+        self.completed |= completed
+
+    def filter_rows(self, rows, project_column, content_column):
+        """
+        :return: The rows without a completed filmstrip.
+        """
+        self.add_projects(row[project_column] for row in rows)
+        pending = []
+        skipped = []
+        for row in rows:
+            pair = (str(row[project_column]), str(row[content_column]))
+            if pair in self.completed:
+                skipped.append(pair)
+            else:
+                pending.append(row)
+        if skipped and self.on_completed is not None:
+            self.on_completed(skipped)
+        return pending
@@ -0,0 +1,136 @@
+import argparse
+import json
+import math
+import re
+import subprocess
+import time
+
+from utils.filmstrip import FILMSTRIP_FPS, SAMPLING_DECODER_ARGS, SAMPLING_EXACT, SAMPLING_MODES, \
+    ffmpeg_input_args, filmstrip_filter
+
+PTS_TIME_PATTERN = re.compile(r"\bpts_time:\s*(-?[\d.]+)")
+
+
+def decoded_frame_timestamps(input_file, sampling_mode):
+    # showinfo runs before the fps filter, so it logs every frame the decoder produced in this mode
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-nostats",
+        *ffmpeg_input_args(input_file, SAMPLING_DECODER_ARGS[sampling_mode]),
+        "-an",
+        "-vf",
+        "showinfo",
+        "-f",
+        "null",
+        "-",
+    ]
+    result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    return sorted(float(pts_time) for pts_time in PTS_TIME_PATTERN.findall(result.stderr))
+
+
+def sampled_frame_timestamps(decoded_timestamps, duration):
+    """
+    Replay the frame selection of ffmpeg's fps filter on a list of decoded frame timestamps.
+
+    Every frame is rounded to the nearest output slot, the last frame of a slot wins and empty slots repeat the
+    previous frame.
+
+    :return: The source timestamp used for each sampled frame.
+    """
+    slots = max(math.ceil(duration * FILMSTRIP_FPS), 1)
+    chosen = [None] * slots
+    for pts_time in decoded_timestamps:
+        slot = math.floor(pts_time * FILMSTRIP_FPS + 0.5)
+        if 0 <= slot < slots:
+            chosen[slot] = pts_time
+    previous = decoded_timestamps[0] if decoded_timestamps else 0.0
+    for slot in range(slots):
+        if chosen[slot] is None:
+            chosen[slot] = previous
+        previous = chosen[slot]
+    return chosen
+
+
+def time_filmstrip_decode(input_file, sampling_mode):
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-nostats",
+        *ffmpeg_input_args(input_file, SAMPLING_DECODER_ARGS[sampling_mode]),
+        "-an",
+        "-vf",
+        filmstrip_filter(sampling_mode),
+        "-f",
+        "null",
+        "-",
+    ]
+    start_time = time.monotonic()
+    subprocess.run(cmd, check=True, capture_output=True)
+    return time.monotonic() - start_time
+
+
+def compare_sampling_modes(input_file, sampling_modes=SAMPLING_MODES):
+    """
+    Compare the sampled frame timestamps and decode time of each sampling mode with the exact mode.
+
+    :return: Dictionary keyed by sampling mode with the decode time, number of decoded frames and the mean and
+             maximum drift of the sampled frames in seconds.
+    """
+    exact_decoded = decoded_frame_timestamps(input_file, SAMPLING_EXACT)
+    if not exact_decoded:
+        raise ValueError(f"No video frames decoded from {input_file}")
+    frame_interval = (exact_decoded[-1] - exact_decoded[0]) / max(len(exact_decoded) - 1, 1)
+    duration = exact_decoded[-1] + frame_interval
+    exact_sampled = sampled_frame_timestamps(exact_decoded, duration)
+
+    report = {}
+    for sampling_mode in sampling_modes:
+        decoded = exact_decoded if sampling_mode == SAMPLING_EXACT else \
+            decoded_frame_timestamps(input_file, sampling_mode)
+        sampled = sampled_frame_timestamps(decoded, duration)
+        drifts = [abs(a - b) for a, b in zip(sampled, exact_sampled)]
+        report[sampling_mode] = {
+            "decode_time": round(time_filmstrip_decode(input_file, sampling_mode), 3),
+            "decoded_frames": len(decoded),
+            "sampled_frames": len(sampled),
+            "mean_drift": round(sum(drifts) / len(drifts), 3),
+            "max_drift": round(max(drifts), 3),
+        }
+    return report
+
+
+def recommend_sampling_mode(reports, tolerance):
+    """
+    Pick the sampling mode with the lowest total decode time whose drift stays within the tolerance on every input.
+    """
+    candidates = []
+    for sampling_mode in SAMPLING_MODES:
+        results = [report[sampling_mode] for report in reports if sampling_mode in report]
+        if len(results) != len(reports):
+            continue
+        if max(result["max_drift"] for result in results) <= tolerance:
+            candidates.append((sum(result["decode_time"] for result in results), sampling_mode))
+    return min(candidates)[1] if candidates else SAMPLING_EXACT
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", nargs="+", help="Sample videos of one source type, local paths or URLs")
+    parser.add_argument("--source_type", type=str, default="uploads")
+    parser.add_argument("--tolerance", type=float, default=1.0)
+    parser.add_argument("--modes", type=str, nargs="+", default=list(SAMPLING_MODES), choices=SAMPLING_MODES)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    reports = [compare_sampling_modes(input_file, args.modes) for input_file in args.inputs]
+    result = {
+        "source_type": args.source_type,
+        "tolerance": args.tolerance,
+        "inputs": dict(zip(args.inputs, reports)),
+        "recommended_mode": recommend_sampling_mode(reports, args.tolerance),
+    }
+    print(json.dumps(result, indent=4))
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump(result, json_file, indent=4)
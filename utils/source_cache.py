@@ -0,0 +1,288 @@
+import argparse
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from utils import metrics
+
+GB = 1024 ** 3
+DEFAULT_MAX_GB = 50
+CACHE_INDEX_FILE = "index.db"
+# Writers of other processes are waited for this long before SQLite gives up
+BUSY_TIMEOUT_SECONDS = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+CREATE_LAST_USED_INDEX = "CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)"
+TOUCH_ENTRY = """
+INSERT INTO entries (digest, size, last_used) VALUES (?, ?, ?)
+ON CONFLICT (digest) DO UPDATE SET size = excluded.size, last_used = excluded.last_used
+"""
+SELECT_TOTAL_SIZE = "SELECT COALESCE(SUM(size), 0) FROM entries"
+SELECT_LEAST_RECENTLY_USED = "SELECT digest, size FROM entries ORDER BY last_used LIMIT ?"
+DELETE_ENTRY = "DELETE FROM entries WHERE digest = ?"
+EVICTION_BATCH = 100
+
+_lock = threading.Lock()
+_cache = None
+
+
+class SourceCache:
+    """
+    Content-addressed cache of downloaded sources and segments on a local disk, shared by every process using the same
+    directory. Keys name the content, e.g. the S3 key with its ETag or a segment URL. Files are added by renaming a
+    complete copy into place, so a reader never sees a partial one, and the least recently used files are evicted
+    once the cache grows past its size cap.
+
+    Destinations are hard links to the cached file where the filesystem allows, they must be replaced, not written to
+    in place, which is what boto3, yt-dlp and the segment fetcher do.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        for subdirectory in ("objects", "tmp", "locks"):
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "hit_bytes": 0, "filled_bytes": 0, "evictions": 0, "evicted_bytes": 0}
+        self.connection = sqlite3.connect(os.path.join(directory, CACHE_INDEX_FILE), timeout=BUSY_TIMEOUT_SECONDS,
+                                          isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(SCHEMA)
+        self.connection.execute(CREATE_LAST_USED_INDEX)
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def _touch(self, digest, size):
+        with self.lock:
+            self.connection.execute(TOUCH_ENTRY, (digest, size, time.time()))
+
+    def _count(self, outcome, size=0):
+        with self.lock:
+            if outcome == "hit":
+                self.stats["hits"] += 1
+                self.stats["hit_bytes"] += size
+            else:
+                self.stats["misses"] += 1
+        metrics.increment("source_cache_requests_total", outcome=outcome)
+
+    def _lookup(self, key, destination):
+        digest = self.digest(key)
+        try:
+            _link_or_copy(self._path(digest), destination)
+        except FileNotFoundError:
+            return False
+        size = os.path.getsize(destination)
+        self._touch(digest, size)
+        self._count("hit", size)
+        return True
+
+    def get(self, key, destination):
+        """
+        Place the cached file of the key at destination.
+
+        :return: True on a hit, False when the key is not cached.
+        """
+        if self._lookup(key, destination):
+            return True
+        self._count("miss")
+        return False
+
+    def read(self, key):
+        """
+        :return: The cached bytes of the key, None when it is not cached.
+        """
+        digest = self.digest(key)
+        try:
+            with open(self._path(digest), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._count("miss")
+            return None
+        self._touch(digest, len(data))
+        self._count("hit", len(data))
+        return data
+
+    def fetch(self, key, destination, download):
+        """
+        Place the cached file of the key at destination, or call download(destination) and add the file to the
+        cache. Workers filling the same key at the same time wait for the first one instead of downloading it again.
+
+        :return: True on a hit, False when the file was downloaded.
+        """
+        if self._lookup(key, destination):
+            return True
+        with self._key_lock(self.digest(key)):
+            if self._lookup(key, destination):
+                return True
+            self._count("miss")
+            download(destination)
+            # e.g. yt-dlp merging the streams into another container, nothing to cache
+            if os.path.exists(destination):
+                self.put(key, destination)
+        return False
+
+    def put(self, key, path):
+        """
+        Add a complete file to the cache under the key.
+        """
+        digest = self.digest(key)
+        temporary_path = os.path.join(self.directory, "tmp", f"{digest}.{os.getpid()}.{threading.get_ident()}")
+        _link_or_copy(path, temporary_path)
+        self._commit(digest, temporary_path)
+
+    def put_bytes(self, key, data):
+        digest = self.digest(key)
+        temporary_path = os.path.join(self.directory, "tmp", f"{digest}.{os.getpid()}.{threading.get_ident()}")
+        with open(temporary_path, "wb") as f:
+            f.write(data)
+        self._commit(digest, temporary_path)
+
+    def _commit(self, digest, temporary_path):
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(temporary_path)
+        # The rename is atomic, readers find the previous file or the complete new one
+        os.replace(temporary_path, path)
+        self._touch(digest, size)
+        with self.lock:
+            self.stats["filled_bytes"] += size
+        metrics.increment("source_cache_filled_bytes_total", size)
+        self._evict()
+
+    def _evict(self):
+        with self.lock:
+            total_size = self.connection.execute(SELECT_TOTAL_SIZE).fetchone()[0]
+        while total_size > self.max_bytes:
+            with self.lock:
+                entries = self.connection.execute(SELECT_LEAST_RECENTLY_USED, (EVICTION_BATCH,)).fetchall()
+            if not entries:
+                break
+            for digest, size in entries:
+                if total_size <= self.max_bytes:
+                    break
+                try:
+                    # Destinations linked to the file keep their copy
+                    os.remove(self._path(digest))
+                except FileNotFoundError:
+                    pass
+                with self.lock:
+                    self.connection.execute(DELETE_ENTRY, (digest,))
+                    self.stats["evictions"] += 1
+                    self.stats["evicted_bytes"] += size
+                total_size -= size
+
+    def _key_lock(self, digest):
+        return _FileLock(os.path.join(self.directory, "locks", f"{digest}.lock"))
+
+    def size(self):
+        """
+        :return: Bytes of the cached files.
+        """
+        with self.lock:
+            return self.connection.execute(SELECT_TOTAL_SIZE).fetchone()[0]
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size_gb"] = round(self.connection.execute(SELECT_TOTAL_SIZE).fetchone()[0] / GB, 3)
+        requests = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / requests, 3) if requests else None
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class _FileLock:
+    """
+    Exclusive lock held by one thread of one process at a time, every acquisition opens the file on its own.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def _link_or_copy(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError as err:
+        # Other filesystem or one without hard links
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        shutil.copyfile(source, destination)
+
+
+def configure(directory, max_gb=DEFAULT_MAX_GB):
+    """
+    Cache the downloads of this process in directory, None to disable the cache.
+    """
+    global _cache
+    with _lock:
+        if _cache is not None:
+            _cache.close()
+        _cache = SourceCache(directory, int(max_gb * GB)) if directory else None
+        return _cache
+
+
+def get_cache():
+    return _cache
+
+
+def summary():
+    return _cache.summary() if _cache is not None else None
+
+
+def close():
+    configure(None)
+
+
+def add_source_cache_arguments(parser):
+    # e.g. /mnt/cache/filmstrip_sources, on the same filesystem as downloads/ the cached files are hard links and the
+    # room the cache can still grow by is taken off the default disk budget of the admission
+    parser.add_argument("--source_cache", type=str, default=None, help="Directory of the downloaded source cache")
+    parser.add_argument("--source_cache_gb", type=float, default=DEFAULT_MAX_GB)
+
+
+if __name__ == "__main__":
+    # Size and entries of a cache, e.g. python3 -m utils.source_cache /mnt/cache/filmstrip_sources
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", type=str)
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(f"file:{os.path.join(args.directory, CACHE_INDEX_FILE)}?mode=ro", uri=True)
+    entries, size, oldest = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(last_used) FROM entries"
+                                               ).fetchone()
+    print(json.dumps({"entries": entries, "size_gb": round(size / GB, 3),
+                      "least_recently_used_age_hours": round((time.time() - oldest) / 3600, 1) if oldest else None},
+                     indent=4))
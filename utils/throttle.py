@@ -0,0 +1,198 @@
+import asyncio
+import contextlib
+import threading
+import time
+
+# Error codes and HTTP statuses remote targets answer with when they want fewer requests
+THROTTLING_ERROR_CODES = {
+    "SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequests",
+    "TooManyRequestsException", "ServiceUnavailable", "RequestThrottled", "503", "429",
+}
+THROTTLING_STATUSES = {429, 503}
+THROTTLING_MESSAGES = ("HTTP Error 429", "HTTP Error 503", "Too Many Requests")
+
+DEFAULT_INITIAL_CONCURRENCY = 4
+DEFAULT_MIN_CONCURRENCY = 1
+DEFAULT_MAX_CONCURRENCY = 64
+# The limit is multiplied by this on a throttling signal, at most once per cooldown since the requests in flight at
+# the old limit are throttled together
+DECREASE_FACTOR = 0.5
+DECREASE_COOLDOWN_SECONDS = 2.0
+# The limit only grows while the average latency stays within this factor of the best average seen, and the error
+# rate below the maximum
+LATENCY_TOLERANCE = 2.0
+MAX_ERROR_RATE = 0.05
+# Weight of the latest request in the moving averages
+EWMA_WEIGHT = 0.1
+
+
+def is_throttling_error(err):
+    """
+    Tell whether an exception of boto3, requests, aiohttp or yt-dlp means that the remote target is throttling.
+    """
+    response = getattr(err, "response", None)
+    if isinstance(response, dict):
+        # botocore ClientError
+        error = response.get("Error", {})
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        return error.get("Code") in THROTTLING_ERROR_CODES or status in THROTTLING_STATUSES
+    if getattr(response, "status_code", None) in THROTTLING_STATUSES:
+        # requests HTTPError
+        return True
+    if getattr(err, "status", None) in THROTTLING_STATUSES:
+        # aiohttp ClientResponseError
+        return True
+    # yt-dlp only keeps the message of the HTTP error
+    return any(message in str(err) for message in THROTTLING_MESSAGES)
+
+
+class AimdLimiter:
+    """
+    Concurrency limit of one remote target, raised additively while requests succeed with a healthy latency and
+    error rate, and cut multiplicatively when the target throttles.
+    """
+
+    def __init__(self, target, initial=DEFAULT_INITIAL_CONCURRENCY, minimum=DEFAULT_MIN_CONCURRENCY,
+                 maximum=DEFAULT_MAX_CONCURRENCY):
+        self.target = target
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.peak_limit = self.limit
+        self.latency = None
+        self.best_latency = None
+        self.error_rate = 0.0
+        self.last_decrease = 0.0
+        self.requests = 0
+        self.throttles = 0
+        self.errors = 0
+        self.condition = threading.Condition()
+
+    def _has_room(self):
+        return self.in_flight < max(self.minimum, int(self.limit))
+
+    def _record(self, latency, throttled, failed):
+        self.requests += 1
+        if throttled:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self.last_decrease >= DECREASE_COOLDOWN_SECONDS:
+                self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+                self.last_decrease = now
+            return
+        self.error_rate += EWMA_WEIGHT * ((1.0 if failed else 0.0) - self.error_rate)
+        if failed:
+            self.errors += 1
+            return
+        self.latency = latency if self.latency is None else self.latency + EWMA_WEIGHT * (latency - self.latency)
+        self.best_latency = self.latency if self.best_latency is None else min(self.best_latency, self.latency)
+        if self.error_rate <= MAX_ERROR_RATE and self.latency <= LATENCY_TOLERANCE * self.best_latency:
+            # One more request in flight per round of successful requests at the current limit
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.peak_limit = max(self.peak_limit, self.limit)
+
+    def acquire(self):
+        """
+        Wait for a request slot of the target, for requests that finish on another thread.
+
+        :return: Start time to pass to release.
+        """
+        with self.condition:
+            while not self._has_room():
+                self.condition.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, start_time, err=None):
+        """
+        Give back a slot taken with acquire, the outcome of the request adjusts the limit.
+        """
+        throttled = err is not None and is_throttling_error(err)
+        with self.condition:
+            self.in_flight -= 1
+            self._record(time.monotonic() - start_time, throttled, err is not None and not throttled)
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Hold one request slot of the target while the block runs, the outcome of the block adjusts the limit.
+        """
+        start_time = self.acquire()
+        err = None
+        try:
+            yield
+        except Exception as block_err:
+            err = block_err
+            raise
+        finally:
+            self.release(start_time, err)
+
+    def summary(self):
+        return {
+            "limit": round(self.limit, 1),
+            "peak_limit": round(self.peak_limit, 1),
+            "requests": self.requests,
+            "throttles": self.throttles,
+            "errors": self.errors,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+        }
+
+
+class AsyncAimdLimiter(AimdLimiter):
+    """
+    AimdLimiter for coroutines running on one event loop.
+    """
+
+    def __init__(self, target, **kwargs):
+        super().__init__(target, **kwargs)
+        self.async_condition = None
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self):
+        if self.async_condition is None:
+            self.async_condition = asyncio.Condition()
+        async with self.async_condition:
+            await self.async_condition.wait_for(self._has_room)
+            self.in_flight += 1
+        start_time = time.monotonic()
+        throttled = False
+        failed = False
+        cancelled = False
+        try:
+            yield
+        except asyncio.CancelledError:
+            # The losing request of a hedge says nothing about the health of the target
+            cancelled = True
+            raise
+        except Exception as err:
+            throttled = is_throttling_error(err)
+            failed = True
+            raise
+        finally:
+            async with self.async_condition:
+                self.in_flight -= 1
+                if not cancelled:
+                    self._record(time.monotonic() - start_time, throttled, failed and not throttled)
+                self.async_condition.notify_all()
+
+
+_lock = threading.Lock()
+_limiters = {}
+
+
+def get_limiter(target, limiter_class=AimdLimiter, **kwargs):
+    """
+    Return the limiter of a remote target shared by every thread of this process, e.g. "s3:<bucket>" or
+    "yt-dlp:<extractor>". The keyword arguments only apply when the limiter is created.
+    """
+    with _lock:
+        if target not in _limiters:
+            _limiters[target] = limiter_class(target, **kwargs)
+        return _limiters[target]
+
+
+def summary():
+    with _lock:
+        return {target: limiter.summary() for target, limiter in _limiters.items()}
@@ -0,0 +1,198 @@
+import argparse
+import datetime
+import json
+import sqlite3
+import threading
+import time
+
+from utils.work_queue import QUEUE_MODE_COORDINATOR
+
+# Rows committed late, e.g. by a transaction that started before the previous run, are still picked up when their
+# timestamp is at most this far behind the mark
+DEFAULT_OVERLAP_SECONDS = 600
+# SQLAlchemy dialect name of the replicas, the window is computed by the database
+POSTGRES_DIALECT = "postgresql"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS watermarks (
+    source TEXT PRIMARY KEY,
+    mark_time TEXT NOT NULL,
+    mark_id TEXT NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+SELECT_MARK = "SELECT mark_time, mark_id FROM watermarks WHERE source = ?"
+UPDATE_MARK = """
+INSERT INTO watermarks (source, mark_time, mark_id, updated_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (source) DO UPDATE SET
+    mark_time = excluded.mark_time, mark_id = excluded.mark_id, updated_at = excluded.updated_at
+"""
+
+
+class Watermark:
+    """
+    Persisted high-water mark of a source, the (time, id) of the newest row up to which every row was published.
+    Incremental runs only query the rows past the mark. The mark advances once the run finished, up to the first
+    row that is still failing, so a failed row is queried again until it succeeds or drops out of the --days window.
+    """
+
+    def __init__(self, path, source, time_column, id_column, overlap_seconds=DEFAULT_OVERLAP_SECONDS,
+                 done_when_scheduled=False, held_items=None):
+        """
+        :param path: Path of the SQLite database, e.g. the job journal, created if it does not exist.
+        :param source: Name of the entry script, several sources can share one database.
+        :param time_column: Column of the query the rows are ordered by, e.g. created_at.
+        :param id_column: Column breaking ties between rows with the same time, selected as the content column.
+        :param overlap_seconds: Rows this far behind the mark are queried again.
+        :param done_when_scheduled: Count rows as done once they are scheduled, e.g. published to a work queue that
+            retries them from then on.
+        :param held_items: Optional callable returning the (project_id, content_id) pairs that hold the mark back on
+            top of the failures of this run, e.g. JobJournal.failed_items.
+        """
+        self.source = source
+        self.time_column = time_column
+        self.id_column = id_column
+        self.overlap_seconds = overlap_seconds
+        self.done_when_scheduled = done_when_scheduled
+        self.held_items = held_items
+        self.lock = threading.Lock()
+        # (project_id, content_id) -> (time, id) of every row the query returned
+        self.keys = {}
+        self.pending = set()
+        self.failed = set()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+        self.mark = self._load()
+
+    def _load(self):
+        row = self.connection.execute(SELECT_MARK, (self.source,)).fetchone()
+        if row is None:
+            return None
+        mark_time, mark_id = row
+        return datetime.datetime.fromisoformat(mark_time), json.loads(mark_id)
+
+    def condition(self, days, dialect=POSTGRES_DIALECT):
+        """
+        :return: SQL condition selecting the rows of the last days past the mark, less the overlap.
+        """
+        window = window_condition(self.time_column, days, dialect)
+        if self.mark is None:
+            return window
+        mark_time, mark_id = self.mark
+        if self.overlap_seconds:
+            since = mark_time - datetime.timedelta(seconds=self.overlap_seconds)
+            return f"{window} and {self.time_column} >= '{since.isoformat(sep=' ')}'"
+        return f"{window} and ({self.time_column}, {self.id_column}) > ('{mark_time.isoformat(sep=' ')}', '{mark_id}')"
+
+    def track_rows(self, rows, project_column, content_column):
+        """
+        Row filter recording every row of the query, goes before the filters that drop completed rows.
+        """
+        with self.lock:
+            for row in rows:
+                if row.get(self.time_column) is not None:
+                    self.keys[(str(row[project_column]), str(row[content_column]))] = (
+                        row[self.time_column], _row_id(row[content_column]))
+        return rows
+
+    def schedule_rows(self, rows, project_column, content_column):
+        """
+        Row filter recording the rows that became jobs, goes after every other filter. The rows dropped in between
+        were completed already.
+        """
+        if not self.done_when_scheduled:
+            with self.lock:
+                self.pending.update((str(row[project_column]), str(row[content_column])) for row in rows)
+        return rows
+
+    def record_finish(self, job, err):
+        item = (str(job.project_id), str(job.content_id))
+        with self.lock:
+            self.pending.discard(item)
+            if err is not None:
+                self.failed.add(item)
+
+    def advance(self):
+        """
+        Move the mark to the newest row with every row up to it done, call once the run finished.
+
+        :return: The new mark, or None if it didn't move.
+        """
+        held = set(self.held_items()) if self.held_items is not None else set()
+        with self.lock:
+            held |= self.pending | self.failed
+            mark = None
+            for item, key in sorted(self.keys.items(), key=lambda entry: entry[1]):
+                if item in held:
+                    break
+                mark = key
+        if mark is None or (self.mark is not None and mark <= self.mark):
+            print(f"Watermark {self.source}: stays at {self._format(self.mark)}")
+            return None
+        mark_time, mark_id = mark
+        self.connection.execute(UPDATE_MARK, (self.source, mark_time.isoformat(), json.dumps(mark_id), time.time()))
+        self.connection.commit()
+        print(f"Watermark {self.source}: advanced from {self._format(self.mark)} to {self._format(mark)}")
+        self.mark = mark
+        return mark
+
+    @staticmethod
+    def _format(mark):
+        return "none" if mark is None else f"{mark[0].isoformat()} {mark[1]}"
+
+    def close(self):
+        self.connection.close()
+
+
+def _row_id(value):
+    # UUIDs sort like their text, integer ids have to stay numbers to sort like in the database
+    return value if isinstance(value, int) else str(value)
+
+
+def window_condition(time_column, days, dialect=POSTGRES_DIALECT):
+    if dialect == POSTGRES_DIALECT:
+        return f"{time_column} >= NOW() - INTERVAL '{int(days)} days'"
+    # SQLite fixtures have no INTERVAL, their times are naive UTC text written with a space like the literal
+    since = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - datetime.timedelta(days=int(days))
+    return f"{time_column} >= '{since.isoformat(sep=' ', timespec='seconds')}'"
+
+
+def query_condition(watermark, time_column, days, dialect=POSTGRES_DIALECT):
+    """
+    :param dialect: Name of the SQLAlchemy dialect of the engine the query runs on, e.g. engine.dialect.name.
+    :return: SQL condition selecting the rows of the last days, only the ones past the mark in incremental runs.
+    """
+    if watermark is None:
+        return window_condition(time_column, days, dialect)
+    return watermark.condition(days, dialect)
+
+
+def add_watermark_arguments(parser):
+    # With --watermark only the rows past the mark of the previous run are queried, --days still bounds the window
+    parser.add_argument("--watermark", type=str, default=None, help="Path of the SQLite database of the marks")
+    parser.add_argument("--overlap_seconds", type=int, default=DEFAULT_OVERLAP_SECONDS)
+
+
+def watermark_from_args(args, source, time_column, id_column, journal=None):
+    if not args.watermark:
+        return None
+    # A coordinator only publishes the rows, the queue retries them until they are done
+    done_when_scheduled = bool(args.queue) and args.queue_mode == QUEUE_MODE_COORDINATOR
+    if args.shard is not None:
+        # Every shard only tracks its own rows, a shared mark would move past the rows other shards haven't published
+        source = f"{source}:{args.shard[0]}/{args.shard[1]}"
+    return Watermark(args.watermark, source, time_column, id_column, args.overlap_seconds, done_when_scheduled,
+                     journal.failed_items if journal is not None else None)
+
+
+if __name__ == "__main__":
+    # Marks of every source, e.g. python3 -m utils.watermark journal.db
+    parser = argparse.ArgumentParser()
+    parser.add_argument("watermark", type=str)
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(f"file:{args.watermark}?mode=ro", uri=True)
+    marks = {source: {"time": mark_time, "id": json.loads(mark_id), "updated_at": updated_at}
+             for source, mark_time, mark_id, updated_at in connection.execute("SELECT * FROM watermarks")}
+    print(json.dumps(marks, indent=4))
@@ -0,0 +1,542 @@
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+
+from utils.pipeline import FilmstripJob
+
+QUEUE_MODE_COORDINATOR = "coordinator"
+QUEUE_MODE_WORKER = "worker"
+QUEUE_MODES = (QUEUE_MODE_COORDINATOR, QUEUE_MODE_WORKER)
+ITEM_PENDING = "pending"
+ITEM_LEASED = "leased"
+ITEM_DONE = "done"
+ITEM_FAILED = "failed"
+# A lease that isn't renewed for this long goes back to the other workers, e.g. when its worker died. The leases of
+# a running worker are renewed every third of it, so it only has to outlast a stalled heartbeat
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_LEASE_BATCH = 4
+DEFAULT_POLL_SECONDS = 5
+DEFAULT_MAX_ATTEMPTS = 5
+# Failed items wait RETRY_BACKOFF_SECONDS * 2^(attempts - 1) before another worker can lease them
+RETRY_BACKOFF_SECONDS = 60
+MAX_BACKOFF_EXPONENT = 6
+# Writers of other processes are waited for this long before SQLite gives up
+BUSY_TIMEOUT_SECONDS = 60
+POSTGRES_URL_PREFIXES = ("postgresql://", "postgresql+psycopg2://", "postgres://")
+# Serializes the schema creation of workers starting at the same time, CREATE TABLE IF NOT EXISTS races otherwise
+POSTGRES_SCHEMA_LOCK = 0x66696c6d
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue_items (
+    queue TEXT NOT NULL,
+    project_id TEXT NOT NULL,
+    content_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    available_at REAL NOT NULL,
+    reason TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (queue, project_id, content_id)
+);
+CREATE INDEX IF NOT EXISTS queue_items_available ON queue_items (queue, state, available_at);
+CREATE TABLE IF NOT EXISTS queues (
+    queue TEXT PRIMARY KEY,
+    sealed INTEGER NOT NULL DEFAULT 0
+);
+"""
+INSERT_ITEM = f"""
+INSERT OR IGNORE INTO queue_items (queue, project_id, content_id, payload, state, available_at, updated_at)
+VALUES (?, ?, ?, ?, '{ITEM_PENDING}', ?, ?)
+"""
+# Leases that ran out on their last attempt, e.g. items crashing every worker that leases them
+FAIL_EXPIRED = f"""
+UPDATE queue_items SET state = '{ITEM_FAILED}', lease_owner = NULL, reason = 'Lease expired', updated_at = ?
+WHERE queue = ? AND state = '{ITEM_LEASED}' AND available_at <= ? AND attempts >= ?
+"""
+# Pending items and leases that ran out, oldest first
+SELECT_AVAILABLE = f"""
+SELECT project_id, content_id, payload FROM queue_items
+WHERE queue = ? AND state IN ('{ITEM_PENDING}', '{ITEM_LEASED}') AND available_at <= ?
+ORDER BY available_at LIMIT ?
+"""
+LEASE_ITEM = f"""
+UPDATE queue_items SET state = '{ITEM_LEASED}', lease_owner = ?, attempts = attempts + 1, available_at = ?,
+    updated_at = ?
+WHERE queue = ? AND project_id = ? AND content_id = ?
+"""
+RENEW_LEASES = f"""
+UPDATE queue_items SET available_at = ?, updated_at = ?
+WHERE queue = ? AND state = '{ITEM_LEASED}' AND lease_owner = ?
+"""
+ACK_ITEM = f"""
+UPDATE queue_items SET state = '{ITEM_DONE}', reason = NULL, updated_at = ?
+WHERE queue = ? AND project_id = ? AND content_id = ? AND state = '{ITEM_LEASED}' AND lease_owner = ?
+"""
+NACK_ITEM = f"""
+UPDATE queue_items SET
+    state = CASE WHEN attempts >= ? THEN '{ITEM_FAILED}' ELSE '{ITEM_PENDING}' END,
+    lease_owner = NULL,
+    reason = ?,
+    available_at = ? + {RETRY_BACKOFF_SECONDS} * (1 << MIN(attempts - 1, {MAX_BACKOFF_EXPONENT})),
+    updated_at = ?
+WHERE queue = ? AND project_id = ? AND content_id = ? AND state = '{ITEM_LEASED}' AND lease_owner = ?
+"""
+SELECT_UNFINISHED = f"""
+SELECT COUNT(*) FROM queue_items WHERE queue = ? AND state IN ('{ITEM_PENDING}', '{ITEM_LEASED}')
+"""
+SELECT_PROGRESS = "SELECT state, COUNT(*) FROM queue_items WHERE queue = ? GROUP BY state"
+
+POSTGRES_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS queue_items (
+        queue TEXT NOT NULL,
+        project_id TEXT NOT NULL,
+        content_id TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_owner TEXT,
+        available_at DOUBLE PRECISION NOT NULL,
+        reason TEXT,
+        updated_at DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (queue, project_id, content_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS queue_items_available ON queue_items (queue, state, available_at)",
+    "CREATE TABLE IF NOT EXISTS queues (queue TEXT PRIMARY KEY, sealed INTEGER NOT NULL DEFAULT 0)",
+]
+POSTGRES_INSERT_ITEM = f"""
+INSERT INTO queue_items (queue, project_id, content_id, payload, state, available_at, updated_at)
+VALUES (:queue, :project_id, :content_id, :payload, '{ITEM_PENDING}', :now, :now)
+ON CONFLICT DO NOTHING
+"""
+POSTGRES_SEAL = """
+INSERT INTO queues (queue, sealed) VALUES (:queue, :sealed)
+ON CONFLICT (queue) DO UPDATE SET sealed = excluded.sealed
+"""
+POSTGRES_SELECT_DRAINED = f"""
+SELECT COALESCE((SELECT sealed FROM queues WHERE queue = :queue), 0),
+    (SELECT COUNT(*) FROM queue_items WHERE queue = :queue AND state IN ('{ITEM_PENDING}', '{ITEM_LEASED}'))
+"""
+POSTGRES_FAIL_EXPIRED = f"""
+UPDATE queue_items SET state = '{ITEM_FAILED}', lease_owner = NULL, reason = 'Lease expired', updated_at = :now
+WHERE (queue, project_id, content_id) IN (
+    SELECT queue, project_id, content_id FROM queue_items
+    WHERE queue = :queue AND state = '{ITEM_LEASED}' AND available_at <= :now AND attempts >= :max_attempts
+    FOR UPDATE SKIP LOCKED
+)
+"""
+# Rows locked by the lease of another worker are skipped instead of waited for, no two workers lease an item
+POSTGRES_LEASE_ITEMS = f"""
+UPDATE queue_items SET state = '{ITEM_LEASED}', lease_owner = :owner, attempts = attempts + 1,
+    available_at = :until, updated_at = :now
+WHERE (queue, project_id, content_id) IN (
+    SELECT queue, project_id, content_id FROM queue_items
+    WHERE queue = :queue AND state IN ('{ITEM_PENDING}', '{ITEM_LEASED}') AND available_at <= :now
+    ORDER BY available_at LIMIT :count
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING project_id, content_id, payload
+"""
+POSTGRES_RENEW_LEASES = f"""
+UPDATE queue_items SET available_at = :until, updated_at = :now
+WHERE queue = :queue AND state = '{ITEM_LEASED}' AND lease_owner = :owner
+"""
+POSTGRES_ACK_ITEM = f"""
+UPDATE queue_items SET state = '{ITEM_DONE}', reason = NULL, updated_at = :now
+WHERE queue = :queue AND project_id = :project_id AND content_id = :content_id AND state = '{ITEM_LEASED}'
+    AND lease_owner = :owner
+"""
+POSTGRES_NACK_ITEM = f"""
+UPDATE queue_items SET
+    state = CASE WHEN attempts >= :max_attempts THEN '{ITEM_FAILED}' ELSE '{ITEM_PENDING}' END,
+    lease_owner = NULL,
+    reason = :reason,
+    available_at = :now + {RETRY_BACKOFF_SECONDS} * (1 << LEAST(attempts - 1, {MAX_BACKOFF_EXPONENT})),
+    updated_at = :now
+WHERE queue = :queue AND project_id = :project_id AND content_id = :content_id AND state = '{ITEM_LEASED}'
+    AND lease_owner = :owner
+"""
+POSTGRES_SELECT_PROGRESS = "SELECT state, COUNT(*) FROM queue_items WHERE queue = :queue GROUP BY state"
+
+
+def shard_of(project_id, content_id, shards):
+    """
+    Shard of an item, the same on every host and Python process unlike hash().
+    """
+    digest = hashlib.sha1(f"{project_id}/{content_id}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards
+
+
+def parse_shard(value):
+    """
+    Parse --shard i/N into (i, N), shards are numbered from 0.
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a shard like 0/4, got {value}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard {value} is out of range, expected 0/{count} to {count - 1}/{count}")
+    return index, count
+
+
+class ShardFilter:
+    """
+    Row filter keeping the items of one shard, put before any filter that probes S3 so every host only probes
+    its own items.
+    """
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    def filter_rows(self, rows, project_column, content_column):
+        return [row for row in rows
+                if shard_of(row[project_column], row[content_column], self.count) == self.index]
+
+
+class WorkQueue:
+    """
+    Work queue in a SQLite database. A coordinator publishes the items once, any number of worker processes lease
+    them in small batches, renew their leases while they work and acknowledge every item when it finished or
+    failed. Items whose lease ran out, e.g. because their worker died, are leased again by the other workers.
+
+    SQLite locking needs the database on a local disk, workers on several hosts share a PostgresWorkQueue instead.
+    """
+
+    def __init__(self, path, queue, worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 lease_batch=DEFAULT_LEASE_BATCH, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        :param path: Path of the SQLite database, created if it does not exist.
+        :param queue: Name of the entry script, several queues can share one database.
+        :param worker_id: Owner of the leases of this process, the host name and pid by default.
+        :param lease_seconds: Seconds a lease lasts without being renewed.
+        :param lease_batch: Items leased at once when the pipeline asks for the next job.
+        :param max_attempts: Items failing this many times are marked failed instead of being leased again.
+        """
+        self.queue = queue
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.lease_batch = lease_batch
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.acked = 0
+        self.nacked = 0
+        self.lost_leases = 0
+        self._connect(path)
+
+    def _connect(self, path):
+        # Autocommit, every lease runs in its own BEGIN IMMEDIATE transaction so no two workers lease an item
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def publish(self, jobs, batch_size=500):
+        """
+        Add the jobs to the queue, items already in it keep their state.
+
+        :return: Number of jobs published.
+        """
+        published = 0
+        batch = []
+        for job in jobs:
+            # Rows hold datetimes and UUIDs, workers only read them as strings
+            payload = json.dumps(job.row or {}, default=str)
+            batch.append((str(job.project_id), str(job.content_id), payload))
+            if len(batch) >= batch_size:
+                published += self._publish_batch(batch)
+                batch = []
+        published += self._publish_batch(batch)
+        return published
+
+    def _publish_batch(self, batch):
+        if not batch:
+            return 0
+        self._insert(batch, time.time())
+        print(f"Queue {self.queue}: published {len(batch)} items")
+        return len(batch)
+
+    def _insert(self, batch, now):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(INSERT_ITEM, [
+                (self.queue, project_id, content_id, payload, now, now) for project_id, content_id, payload in batch
+            ])
+            self.connection.execute("COMMIT")
+
+    def seal(self, sealed=True):
+        """
+        Tell the workers that no more items are coming, they stop once every item is done or failed.
+        """
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO queues (queue, sealed) VALUES (?, ?)",
+                                    (self.queue, int(sealed)))
+
+    def is_drained(self):
+        with self.lock:
+            sealed = self.connection.execute("SELECT sealed FROM queues WHERE queue = ?", (self.queue,)).fetchone()
+            unfinished = self.connection.execute(SELECT_UNFINISHED, (self.queue,)).fetchone()[0]
+        return bool(sealed and sealed[0]) and unfinished == 0
+
+    def lease(self, count):
+        """
+        :return: List of (project_id, content_id, row) leased by this worker, empty when nothing is available.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(FAIL_EXPIRED, (now, self.queue, now, self.max_attempts))
+                items = self.connection.execute(SELECT_AVAILABLE, (self.queue, now, count)).fetchall()
+                self.connection.executemany(LEASE_ITEM, [
+                    (self.worker_id, now + self.lease_seconds, now, self.queue, project_id, content_id)
+                    for project_id, content_id, _ in items
+                ])
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return [(project_id, content_id, json.loads(payload)) for project_id, content_id, payload in items]
+
+    def renew(self):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(RENEW_LEASES, (now + self.lease_seconds, now, self.queue, self.worker_id))
+
+    def ack(self, job, err):
+        """
+        Mark the item of a finished job done, or give it back for a retry when the job failed.
+        """
+        now = time.time()
+        if err is None:
+            updated = self._ack_item(str(job.project_id), str(job.content_id), now)
+        else:
+            updated = self._nack_item(str(job.project_id), str(job.content_id), f"{type(err).__name__}: {err}", now)
+        with self.lock:
+            if err is None:
+                self.acked += 1
+            else:
+                self.nacked += 1
+            if not updated:
+                # The lease ran out and another worker took the item over, its result counts
+                self.lost_leases += 1
+        if not updated:
+            print(f"Lost the lease of {job} before acknowledging it")
+
+    def _ack_item(self, project_id, content_id, now):
+        with self.lock:
+            cursor = self.connection.execute(ACK_ITEM, (now, self.queue, project_id, content_id, self.worker_id))
+        return cursor.rowcount > 0
+
+    def _nack_item(self, project_id, content_id, reason, now):
+        with self.lock:
+            cursor = self.connection.execute(
+                NACK_ITEM, (self.max_attempts, reason, now, now, self.queue, project_id, content_id, self.worker_id))
+        return cursor.rowcount > 0
+
+    def leased_jobs(self, poll_seconds=DEFAULT_POLL_SECONDS):
+        """
+        Yield jobs leased from the queue as the pipeline asks for them, until the queue is sealed and every item is
+        done or failed. A background thread renews the leases of this worker meanwhile.
+        """
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(stop,), name="queue-heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            while True:
+                items = self.lease(self.lease_batch)
+                for project_id, content_id, row in items:
+                    yield FilmstripJob(project_id, content_id, row)
+                if items:
+                    continue
+                if self.is_drained():
+                    return
+                # Other workers still hold leases that may run out, or the coordinator is still publishing
+                time.sleep(poll_seconds)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    def _heartbeat(self, stop):
+        while not stop.wait(self.lease_seconds / 3):
+            try:
+                self.renew()
+            except Exception as err:
+                # The next beat tries again, the lease lasts three of them
+                print(f"Could not renew the leases of {self.worker_id}: {err}")
+
+    def progress(self):
+        with self.lock:
+            return dict(self.connection.execute(SELECT_PROGRESS, (self.queue,)).fetchall())
+
+    def summary(self):
+        return {"worker_id": self.worker_id, "acked": self.acked, "nacked": self.nacked,
+                "lost_leases": self.lost_leases, "queue": self.progress()}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class PostgresWorkQueue(WorkQueue):
+    """
+    Work queue in a Postgres database, for workers on any number of hosts. Same operations as the SQLite queue,
+    every operation is one short transaction and leases take their rows with FOR UPDATE SKIP LOCKED, so concurrent
+    workers neither wait for each other nor lease the same item.
+    """
+
+    def _connect(self, url):
+        """
+        :param url: SQLAlchemy URL of the database, e.g. postgresql://migration@queue-db/filmstrip. The password can
+            come from PGPASSWORD or ~/.pgpass instead of the URL.
+        """
+        # A worker uses one connection at a time, the heartbeat thread a second one
+        self.engine = create_engine(url, pool_size=2, max_overflow=2, pool_pre_ping=True)
+        with self.engine.begin() as connection:
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": POSTGRES_SCHEMA_LOCK})
+            for statement in POSTGRES_SCHEMA:
+                connection.execute(text(statement))
+
+    def _insert(self, batch, now):
+        with self.engine.begin() as connection:
+            connection.execute(text(POSTGRES_INSERT_ITEM), [
+                {"queue": self.queue, "project_id": project_id, "content_id": content_id, "payload": payload,
+                 "now": now}
+                for project_id, content_id, payload in batch
+            ])
+
+    def seal(self, sealed=True):
+        with self.engine.begin() as connection:
+            connection.execute(text(POSTGRES_SEAL), {"queue": self.queue, "sealed": int(sealed)})
+
+    def is_drained(self):
+        with self.engine.begin() as connection:
+            sealed, unfinished = connection.execute(text(POSTGRES_SELECT_DRAINED), {"queue": self.queue}).one()
+        return bool(sealed) and unfinished == 0
+
+    def lease(self, count):
+        now = time.time()
+        with self.engine.begin() as connection:
+            connection.execute(text(POSTGRES_FAIL_EXPIRED),
+                               {"queue": self.queue, "now": now, "max_attempts": self.max_attempts})
+            items = connection.execute(text(POSTGRES_LEASE_ITEMS), {
+                "queue": self.queue, "owner": self.worker_id, "now": now, "until": now + self.lease_seconds,
+                "count": count,
+            }).fetchall()
+        return [(project_id, content_id, json.loads(payload)) for project_id, content_id, payload in items]
+
+    def renew(self):
+        now = time.time()
+        with self.engine.begin() as connection:
+            connection.execute(text(POSTGRES_RENEW_LEASES), {
+                "queue": self.queue, "owner": self.worker_id, "now": now, "until": now + self.lease_seconds})
+
+    def _ack_item(self, project_id, content_id, now):
+        with self.engine.begin() as connection:
+            result = connection.execute(text(POSTGRES_ACK_ITEM), {
+                "queue": self.queue, "project_id": project_id, "content_id": content_id, "owner": self.worker_id,
+                "now": now})
+        return result.rowcount > 0
+
+    def _nack_item(self, project_id, content_id, reason, now):
+        with self.engine.begin() as connection:
+            result = connection.execute(text(POSTGRES_NACK_ITEM), {
+                "queue": self.queue, "project_id": project_id, "content_id": content_id, "owner": self.worker_id,
+                "now": now, "reason": reason, "max_attempts": self.max_attempts})
+        return result.rowcount > 0
+
+    def progress(self):
+        with self.engine.begin() as connection:
+            return dict(connection.execute(text(POSTGRES_SELECT_PROGRESS), {"queue": self.queue}).fetchall())
+
+    def close(self):
+        self.engine.dispose()
+
+
+def is_postgres_url(location):
+    return location.startswith(POSTGRES_URL_PREFIXES)
+
+
+def open_work_queue(location, queue, *args, **kwargs):
+    """
+    :param location: Path of a SQLite database, or the URL of a Postgres database shared by several hosts.
+    :return: WorkQueue or PostgresWorkQueue, the other arguments are the ones of WorkQueue.
+    """
+    if is_postgres_url(location):
+        return PostgresWorkQueue(location, queue, *args, **kwargs)
+    return WorkQueue(location, queue, *args, **kwargs)
+
+
+def add_work_queue_arguments(parser):
+    # Only process the items hashing to shard i of N, e.g. --shard 0/4 on the first of four hosts
+    parser.add_argument("--shard", type=parse_shard, default=None)
+    # With --queue the coordinator publishes the items of the query and the workers pull them from the queue
+    parser.add_argument("--queue", type=str, default=None,
+                        help="Path of a SQLite work queue, or postgresql://... for workers on several hosts")
+    parser.add_argument("--queue_mode", type=str, default=QUEUE_MODE_WORKER, choices=QUEUE_MODES)
+    parser.add_argument("--worker_id", type=str, default=None)
+    parser.add_argument("--lease_seconds", type=int, default=DEFAULT_LEASE_SECONDS)
+    parser.add_argument("--lease_batch", type=int, default=DEFAULT_LEASE_BATCH)
+
+
+def work_queue_from_args(args, queue):
+    if not args.queue:
+        return None
+    # --max_attempts comes from the journal arguments where the script has them
+    max_attempts = getattr(args, "max_attempts", DEFAULT_MAX_ATTEMPTS)
+    return open_work_queue(args.queue, queue, args.worker_id, args.lease_seconds, args.lease_batch, max_attempts)
+
+
+def shard_filters_from_args(args):
+    if args.shard is None:
+        return []
+    return [ShardFilter(*args.shard).filter_rows]
+
+
+def run_jobs(args, work_queue, discover, run):
+    """
+    Run the jobs of an entry script in the mode given by the arguments.
+
+    :param work_queue: WorkQueue from work_queue_from_args, None to run the discovered jobs in this process.
+    :param discover: Called without arguments, returns the jobs of the query, only called when not a queue worker.
+    :param run: Called with the jobs to process, e.g. Pipeline.run.
+    """
+    if work_queue is None:
+        return run(discover())
+    if args.queue_mode == QUEUE_MODE_COORDINATOR:
+        # Workers started before this run keep polling until the new items are published
+        work_queue.seal(False)
+        published = work_queue.publish(discover())
+        work_queue.seal()
+        print(f"Queue {work_queue.queue}: {published} items published, progress {work_queue.progress()}")
+        return None
+    result = run(work_queue.leased_jobs())
+    print(f"Queue summary: {work_queue.summary()}")
+    return result
+
+
+if __name__ == "__main__":
+    # Progress of a queue, e.g. python3 -m utils.work_queue queue.db uploads
+    parser = argparse.ArgumentParser()
+    parser.add_argument("queue_path", type=str)
+    parser.add_argument("queue", type=str)
+    args = parser.parse_args()
+
+    if is_postgres_url(args.queue_path):
+        work_queue = PostgresWorkQueue(args.queue_path, args.queue)
+        print(json.dumps(work_queue.progress(), indent=4))
+        work_queue.close()
+    else:
+        connection = sqlite3.connect(f"file:{args.queue_path}?mode=ro", uri=True)
+        print(json.dumps(dict(connection.execute(SELECT_PROGRESS, (args.queue,)).fetchall()), indent=4))